@@ -0,0 +1,3 @@
+from .dataset_catalog import DatasetCatalog, parse_filename
+
+__all__ = ["DatasetCatalog", "parse_filename"]
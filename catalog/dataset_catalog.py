@@ -0,0 +1,346 @@
+"""
+On-disk catalog of the NetCDF files of the CICA-ATLAS datasets.
+
+The catalog is a sqlite index of every ``*.nc`` file below the registered
+roots, with the project, variable, domain, model, experiment, grid, frequency
+and year range parsed from the file name. It is updated incrementally: a
+directory is only listed again when its mtime changed (files were added or
+removed), otherwise its entries and subdirectories are taken from the index,
+so refreshing a large tree costs one ``stat`` per directory instead of a full
+listing and glob of every directory on the Lustre/GPFS metadata servers.
+
+Usage:
+    from catalog import DatasetCatalog
+
+    catalog = DatasetCatalog("/path/to/catalog.sqlite")
+    catalog.update("/gpfs/projects/meteo/DATA/FAO/final_products/")
+    files = catalog.glob("/gpfs/projects/meteo/DATA/FAO/final_products/**/tas_*.nc", recursive=True)
+    files = catalog.query(project="CORDEX", variable="tas", experiment="historical", years=(1971, 2000))
+"""
+
+import os
+import re
+import sqlite3
+
+
+FREQUENCIES = ["1hr", "3hr", "6hr", "day", "mon", "year", "yr", "sem", "seas", "fx"]
+
+# Longest names first so that e.g. CORDEX-CORE is not parsed as CORDEX
+PROJECTS = sorted([
+    "CORDEX-CORE", "CORDEX-EUR-11", "CORDEX", "CERRA-Land", "CERRA-land", "CERRA",
+    "ERA5-Land", "ERA5-land", "ERA5", "E-OBS", "EOBS", "CMIP5", "CMIP6",
+    "CPC", "BERKELEY", "ORAS5", "SSTSAT", "CARRA",
+], key=len, reverse=True)
+
+EXPERIMENT_RE = re.compile(r"^(historical|evaluation|piControl|rcp\d{2}|ssp\d{3})$")
+DOMAIN_RE = re.compile(r"^[A-Z]{3}-\d{2}i?$")
+GRID_RE = re.compile(r"^(gr\d{2,3}|gn|gr)$")
+ENSEMBLE_RE = re.compile(r"^r\d+i\d+p\d+(f\d+)?$")
+PERIOD_RE = re.compile(r"^(\d{4})(\d{2})?(\d{2})?(?:-(\d{4})(\d{2})?(\d{2})?)?$")
+
+FIELDS = ["project", "variable", "domain", "model", "experiment", "grid", "frequency", "start_year", "end_year"]
+
+
+def parse_filename(path):
+    """
+    Parse the dataset attributes of a NetCDF file from its name and directory.
+
+    Parameters:
+    - path: str, path of the file, e.g.
+      ``.../pr_gr006_mon_CERRA_day_198501_198512.nc`` or
+      ``.../tas_AFR-22_MOHC-HadGEM2-ES_historical_r1i1p1_GERICS-REMO2015_v1_day_19700101-19701231.nc``
+
+    Returns:
+    - dict with the keys of FIELDS; attributes that cannot be parsed are None.
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    tokens = os.path.splitext(parts[-1])[0].split("_")
+    info = dict.fromkeys(FIELDS)
+
+    for token in tokens + parts[-2::-1]:
+        if info["project"] is None:
+            info["project"] = next((project for project in PROJECTS if token.startswith(project)), None)
+        if info["domain"] is None and DOMAIN_RE.match(token):
+            info["domain"] = token
+        if info["experiment"] is None and EXPERIMENT_RE.match(token):
+            info["experiment"] = token
+        if info["grid"] is None and GRID_RE.match(token):
+            info["grid"] = token
+        if info["frequency"] is None and token in FREQUENCIES:
+            info["frequency"] = token
+
+    # The variable is the first token, unless the name starts with the project
+    name_tokens = [token for token in tokens if token not in PROJECTS]
+    info["variable"] = name_tokens[0] if name_tokens else None
+
+    # Year range from the trailing period tokens (198501_198512, 19700101-19701231, 1970)
+    years = []
+    for token in reversed(tokens):
+        match = PERIOD_RE.match(token)
+        if not match:
+            break
+        years.extend(int(year) for year in (match.group(1), match.group(4)) if year)
+    if years:
+        info["start_year"], info["end_year"] = min(years), max(years)
+
+    # CORDEX-like names: <gcm>_[<experiment>_]<ensemble>_<rcm parts...>_<frequency|grid|period>
+    ensemble_index = next((i for i, token in enumerate(tokens) if ENSEMBLE_RE.match(token)), None)
+    if ensemble_index is not None and ensemble_index > 0:
+        gcm_index = ensemble_index - 1
+        if EXPERIMENT_RE.match(tokens[gcm_index]) and gcm_index > 0:
+            gcm_index -= 1
+        rcm_parts = []
+        for token in tokens[ensemble_index + 1:]:
+            if token in FREQUENCIES or GRID_RE.match(token) or PERIOD_RE.match(token) or EXPERIMENT_RE.match(token):
+                break
+            rcm_parts.append(token)
+        info["model"] = "_".join([tokens[gcm_index], tokens[ensemble_index]] + rcm_parts)
+
+    return info
+
+
+class DatasetCatalog:
+    """
+    Sqlite index of NetCDF files, updated incrementally by directory mtime.
+
+    Parameters:
+    - db_path: str, path of the sqlite database (created if missing).
+    - auto_update: bool, refresh the part of the tree a query touches before
+      answering it (one ``stat`` per directory). With False, queries are
+      answered from the index only and ``update`` must be called explicitly.
+    """
+
+    def __init__(self, db_path, auto_update=True):
+        self.db_path = db_path
+        self.auto_update = auto_update
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY, parent TEXT, mtime REAL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, directory TEXT, name TEXT,
+                project TEXT, variable TEXT, domain TEXT, model TEXT, experiment TEXT,
+                grid TEXT, frequency TEXT, start_year INTEGER, end_year INTEGER,
+                size INTEGER, mtime REAL
+            );
+            CREATE INDEX IF NOT EXISTS directories_parent ON directories(parent);
+            CREATE INDEX IF NOT EXISTS files_directory ON files(directory);
+            CREATE INDEX IF NOT EXISTS files_variable ON files(variable, project, domain, experiment);
+            """
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- Update ---
+    def update(self, *roots):
+        """
+        Index (or refresh) the NetCDF files below each root directory.
+
+        Only directories whose mtime changed since the last update are listed
+        again; unchanged directories are traversed from the index.
+
+        Returns:
+        - int, number of directories that were listed.
+        """
+        listed = 0
+        with self.connection:
+            for root in roots:
+                root = os.path.abspath(root)
+                if not os.path.isdir(root):
+                    self._forget(root)
+                    continue
+                if self._stored_mtime(root) is False:
+                    self.connection.execute(
+                        "INSERT INTO directories (path, parent, mtime) VALUES (?, NULL, NULL)", (root,))
+                stack = [root]
+                while stack:
+                    directory = stack.pop()
+                    try:
+                        mtime = os.stat(directory).st_mtime
+                    except FileNotFoundError:
+                        self._forget(directory)
+                        continue
+                    if self._stored_mtime(directory) == mtime:
+                        stack.extend(row[0] for row in self.connection.execute(
+                            "SELECT path FROM directories WHERE parent = ?", (directory,)))
+                        continue
+                    stack.extend(self._list_directory(directory, mtime))
+                    listed += 1
+        return listed
+
+    def _stored_mtime(self, directory):
+        """Return the indexed mtime of a directory, or False if it is not indexed."""
+        row = self.connection.execute("SELECT mtime FROM directories WHERE path = ?", (directory,)).fetchone()
+        return False if row is None else row[0]
+
+    def _list_directory(self, directory, mtime):
+        """Re-list one directory: replace its files and return its subdirectories."""
+        subdirs, files = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(os.path.join(directory, entry.name))
+                elif entry.name.endswith(".nc"):
+                    stat = entry.stat()
+                    info = parse_filename(entry.path)
+                    files.append((entry.path, directory, entry.name, *[info[field] for field in FIELDS],
+                                  stat.st_size, stat.st_mtime))
+
+        self.connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+        self.connection.executemany(
+            f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * (5 + len(FIELDS)))})", files)
+
+        known = {row[0] for row in self.connection.execute(
+            "SELECT path FROM directories WHERE parent = ?", (directory,))}
+        for removed in known - set(subdirs):
+            self._forget(removed)
+        self.connection.executemany(
+            "INSERT INTO directories (path, parent, mtime) VALUES (?, ?, NULL) "
+            "ON CONFLICT(path) DO UPDATE SET parent = excluded.parent",
+            [(subdir, directory) for subdir in subdirs])
+        self.connection.execute("UPDATE directories SET mtime = ? WHERE path = ?", (mtime, directory))
+        return subdirs
+
+    def _forget(self, directory):
+        """Remove a directory and everything below it from the index."""
+        below = _escape_glob(directory) + os.sep + "*"
+        self.connection.execute("DELETE FROM files WHERE directory = ? OR directory GLOB ?", (directory, below))
+        self.connection.execute("DELETE FROM directories WHERE path = ? OR path GLOB ?", (directory, below))
+
+    # --- Queries ---
+    def glob(self, pattern, recursive=False):
+        """
+        Return the sorted files matching a glob pattern, like ``glob.glob``.
+
+        ``*`` and ``?`` do not match across directories nor a leading ``.``
+        (hidden files and directories); with ``recursive``, ``**`` matches any
+        number of directories, otherwise it is a ``*``. Paths have the form of
+        the pattern: relative patterns give paths relative to the current
+        directory.
+        """
+        absolute = os.path.abspath(pattern)
+        if self.auto_update:
+            self.update(_literal_prefix(absolute))
+        regex = re.compile(_glob_to_regex(absolute, recursive))
+        prefix = _escape_glob(_literal_prefix(absolute))
+        rows = self.connection.execute("SELECT path FROM files WHERE path GLOB ?", (prefix + "*",))
+        written = _written_prefix(pattern)
+        base = os.path.abspath(written or os.curdir)
+        return sorted(os.path.join(written, os.path.relpath(path, base))
+                      for (path,) in rows if regex.match(path))
+
+    def rglob(self, root, name_pattern):
+        """Return the sorted files below ``root`` whose name matches ``name_pattern``, like ``Path.rglob``."""
+        root = os.path.abspath(root)
+        if self.auto_update:
+            self.update(root)
+        rows = self.connection.execute(
+            "SELECT path FROM files WHERE path GLOB ? AND name GLOB ?",
+            (_escape_glob(root) + os.sep + "*", name_pattern))
+        return sorted(path for (path,) in rows)
+
+    def query(self, root=None, years=None, **filters):
+        """
+        Return the sorted files matching the parsed attributes.
+
+        Parameters:
+        - root: str, optional, only files below this directory.
+        - years: (start, end), optional, only files whose year range overlaps it.
+        - filters: attribute=value pairs among FIELDS (e.g. variable="tas").
+        """
+        unknown = set(filters) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown catalog fields: {sorted(unknown)}. Available fields: {FIELDS}")
+        conditions, values = [], []
+        if root is not None:
+            root = os.path.abspath(root)
+            if self.auto_update:
+                self.update(root)
+            conditions.append("path GLOB ?")
+            values.append(_escape_glob(root) + os.sep + "*")
+        for field, value in filters.items():
+            conditions.append(f"{field} = ?")
+            values.append(value)
+        if years is not None:
+            conditions.append("start_year <= ? AND end_year >= ?")
+            values.extend([years[1], years[0]])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return [row[0] for row in self.connection.execute(f"SELECT path FROM files {where} ORDER BY path", values)]
+
+    def directories(self, root=None, **filters):
+        """Return the sorted directories holding files that match ``query(root, **filters)``."""
+        return sorted({os.path.dirname(path) for path in self.query(root=root, **filters)})
+
+    def file_info(self, path):
+        """Return the indexed attributes, size and mtime of a file, or None if it is not indexed."""
+        cursor = self.connection.execute("SELECT * FROM files WHERE path = ?", (os.path.abspath(path),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+
+def _escape_glob(path):
+    """Escape the sqlite GLOB special characters of a literal path."""
+    return re.sub(r"([\[\]*?])", r"[\1]", path)
+
+
+def _literal_prefix(pattern):
+    """Return the deepest directory of a glob pattern without wildcards."""
+    parts = pattern.split(os.sep)
+    literal = []
+    for part in parts[:-1]:
+        if any(char in part for char in "*?["):
+            break
+        literal.append(part)
+    return os.sep.join(literal) or os.sep
+
+
+def _written_prefix(pattern):
+    """Return the directory of a glob pattern without wildcards as written ('' for the current directory)."""
+    literal = []
+    for part in pattern.split(os.sep)[:-1]:
+        if any(char in part for char in "*?["):
+            break
+        literal.append(part)
+    return os.sep.join(literal) or (os.sep if os.path.isabs(pattern) else "")
+
+
+def _glob_to_regex(pattern, recursive=False):
+    """Translate a glob pattern with ``glob.glob`` semantics into a regex."""
+    sep = re.escape(os.sep)
+    regex = ""
+    for i, part in enumerate(pattern.split(os.sep)):
+        if part == "**" and recursive:
+            regex += f"(?:{sep}(?!\\.)[^{sep}]+)*" if i else f"(?:(?!\\.)[^{sep}]+{sep})*"
+            continue
+        regex += sep if i else ""
+        if not part.startswith("."):
+            # Wildcards do not match a leading dot
+            regex += r"(?!\.)"
+        j = 0
+        while j < len(part):
+            char = part[j]
+            if char == "*":
+                regex += f"[^{sep}]*"
+            elif char == "?":
+                regex += f"[^{sep}]"
+            elif char == "[" and "]" in part[j + 2:]:
+                end = part.index("]", j + 2)
+                body = part[j + 1:end]
+                regex += "[^" + body[1:] + "]" if body.startswith("!") else "[" + body + "]"
+                j = end
+            else:
+                regex += re.escape(char)
+            j += 1
+    return regex + r"\Z"
@@ -13,11 +13,16 @@ For parameter modifications, see:
 """
 
 import os
+import sys
 import logging
 from ruamel.yaml import YAML
 from typing import Dict, Any, List, Optional
 from Product_configs import get_version_config, get_output_path, check_existing_files
 
+# The dataset catalog lives at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from catalog import DatasetCatalog
+
 # Import from unified parameter files
 from parameters import (
     # Project functions (from projects.py)
@@ -45,6 +50,7 @@ from parameters import (
     get_time_aggregation,
     get_period_aggregation,
     get_time_filters_variable,
+    get_output_encoding,
     
     # Cluster resources (from cluster_resources.py)
     get_cluster_resources,
@@ -238,6 +244,9 @@ class Product_Config:
             product_config['chunksize']['lon'] = chunk_config['lon']
         if 'chunknum' in product_config:
             product_config['chunknum'] = chunk_config['chunknum']
+
+        # Output encoding (compression, chunking, precision) of the product files
+        product_config['encoding'] = {self.variable: get_output_encoding(self.variable)}
         
         return config
     
@@ -334,7 +343,7 @@ def produce_climatology_product(project, var, experiment, root, cfile_climatolog
 
 
 def produce_trends_product(project, var, experiment, root, cfile_trends, 
-                           jobfile, version):
+                           jobfile, version, catalog=None):
     """Produce trends product for a variable."""
     if not is_observation_project(project):
         logger.debug(f"Skipping trends for {project} (not an observation dataset)")
@@ -343,7 +352,7 @@ def produce_trends_product(project, var, experiment, root, cfile_trends,
     path_data = get_output_path(version, "trends", project, var)
     is_obs = True
     
-    if check_existing_files(path_data, var, experiment, project, is_obs):
+    if check_existing_files(path_data, var, experiment, project, is_obs, catalog=catalog):
         return
     
     logger.info(f"Producing trends for {project}/{var}/{experiment}")
@@ -398,6 +407,7 @@ if __name__ == "__main__":
     climatology = version_config.climatology
     input_folder = version_config.input_folder
     output_folder = version_config.output_folder
+    catalog = DatasetCatalog(version_config.catalog) if version_config.catalog else None
 
     logger.info(f"Starting product generation for version: {version}")
     logger.info(f"Projects to process: {project_list}")
@@ -441,7 +451,7 @@ if __name__ == "__main__":
                 if is_observation_project(project) and trends:
                     produce_trends_product(
                         project, var, experiment, root, 
-                        cfile_trends, jobfile, version
+                        cfile_trends, jobfile, version, catalog=catalog
                     )
                     
                 for set in list_set:
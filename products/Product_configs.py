@@ -12,6 +12,7 @@ class VersionConfig:
     input_folder: str
     output_folder: str
     experiments: Optional[List[str]] = None
+    catalog: Optional[str] = None  # sqlite dataset catalog used instead of globbing (see catalog/)
 
 
 # Version configurations
@@ -183,7 +184,7 @@ def get_output_path(version: str, product_type: str, project: str, var: str) ->
 def check_existing_files(path_data: str, var: str, experiment: str, 
                         project: str, is_observation: bool, 
                         file_extension: str = "nc", set_name: str = None,
-                        return_pattern: bool = False) -> bool:
+                        return_pattern: bool = False, catalog=None) -> bool:
     """
     Check if output files already exist.
     
@@ -205,6 +206,9 @@ def check_existing_files(path_data: str, var: str, experiment: str,
         Set name for temporal series
     return_pattern : bool, optional
         If True, return the search pattern along with the result
+    catalog : DatasetCatalog, optional
+        Dataset catalog answering the search instead of ``Path.rglob``
+        (``.nc`` files only, other extensions are always searched on disk)
         
     Returns
     -------
@@ -233,7 +237,10 @@ def check_existing_files(path_data: str, var: str, experiment: str,
         else:
             pattern = f'*{var}*{experiment}*.{file_extension}'
     
-    file_list = list(path.rglob(pattern))
+    if catalog is not None and file_extension == "nc":
+        file_list = catalog.rglob(str(path), pattern)
+    else:
+        file_list = list(path.rglob(pattern))
     
     exists = len(file_list) > 0
     
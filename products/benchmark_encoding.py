@@ -0,0 +1,148 @@
+"""
+Benchmark of the output encoding policy on synthetic data.
+
+Writes a synthetic field with several encodings (the engine defaults, a few
+compression levels and the policy returned by get_output_encoding) and reports
+file size, write time, full read time and the maximum error introduced by
+the dtype downcast and quantisation.
+
+Usage:
+    python benchmark_encoding.py --var tas --shape 120 400 400 --repeat 3
+    python benchmark_encoding.py --var pr --workdir /lustre/.../scratch
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+from parameters import get_output_encoding
+
+
+def synthetic_field(var, shape, seed=0):
+    """
+    Build a synthetic (time, lat, lon) field with a land-sea mask.
+
+    Quantised variables get a smooth temperature-like field; the others a
+    precipitation-like field (gamma distributed with dry days).
+    """
+    rng = np.random.default_rng(seed)
+    ntime, nlat, nlon = shape
+    lat = np.linspace(30, 72, nlat)
+    lon = np.linspace(-25, 45, nlon)
+    time_index = np.arange(ntime)
+    if get_output_encoding(var)["significant_digits"] is not None:
+        base = 30 - 0.6 * (lat[:, None] - 30) + 2 * np.sin(np.deg2rad(lon[None, :]) * 4)
+        season = 10 * np.sin(2 * np.pi * time_index / 12)
+        data = base[None] + season[:, None, None] + rng.normal(0, 0.5, shape)
+    else:
+        data = rng.gamma(0.8, 4.0, shape) * (rng.random(shape) > 0.4)
+    # Roughly a third of the domain is ocean (NaN), as in land-only products
+    mask = (np.sin(np.deg2rad(lon[None, :]) * 3) + np.cos(np.deg2rad(lat[:, None]) * 5)) > 0.6
+    data[:, mask] = np.nan
+    return xr.DataArray(
+        data.astype("float64"), name=var, dims=("time", "lat", "lon"),
+        coords={"time": time_index, "lat": lat, "lon": lon},
+    )
+
+
+def to_xarray_encoding(policy, da):
+    """Translate an encoding policy into the xarray/netCDF4 encoding of ``da``."""
+    encoding = {}
+    if policy.get("dtype"):
+        encoding["dtype"] = policy["dtype"]
+    if policy.get("compression") == "zlib":
+        encoding["zlib"] = True
+    elif policy.get("compression"):
+        encoding["compression"] = policy["compression"]
+    if policy.get("compression"):
+        encoding["complevel"] = policy.get("complevel", 4)
+        encoding["shuffle"] = policy.get("shuffle", True)
+    if policy.get("significant_digits") is not None:
+        encoding["significant_digits"] = policy["significant_digits"]
+    if policy.get("chunksizes"):
+        encoding["chunksizes"] = tuple(
+            min(policy["chunksizes"].get(dim, size), size) for dim, size in da.sizes.items()
+        )
+    return encoding
+
+
+def candidate_encodings(var):
+    """Return the encodings compared by the benchmark, by name."""
+    policy = get_output_encoding(var)
+    lossless = dict(policy, significant_digits=None)
+    return {
+        "engine default": {},
+        "float32": {"dtype": "float32"},
+        "zlib1+shuffle": dict(lossless, complevel=1),
+        "zlib4+shuffle": dict(lossless, complevel=4),
+        "zlib9+shuffle": dict(lossless, complevel=9),
+        "zlib4 no shuffle": dict(lossless, shuffle=False),
+        "policy": policy,
+        "policy zstd": dict(policy, compression="zstd", complevel=3),
+    }
+
+
+def run_benchmark(var, shape, repeat, workdir):
+    """Write and read the synthetic field with every candidate encoding."""
+    da = synthetic_field(var, shape)
+    results = []
+    for name, policy in candidate_encodings(var).items():
+        path = os.path.join(workdir, f"bench_{var}_{name.replace(' ', '_').replace('+', '_')}.nc")
+        encoding = {var: to_xarray_encoding(policy, da)}
+        write_times, read_times = [], []
+        try:
+            for _ in range(repeat):
+                if os.path.exists(path):
+                    os.remove(path)
+                start = time.perf_counter()
+                da.to_dataset().to_netcdf(path, encoding=encoding, engine="netcdf4")
+                write_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                with xr.open_dataset(path, engine="netcdf4") as ds:
+                    values = ds[var].values
+                read_times.append(time.perf_counter() - start)
+        except Exception as exc:
+            # e.g. zstd without the netCDF-C plugin, or quantisation with netCDF-C < 4.9
+            results.append((name, None, None, None, None, f"unavailable ({type(exc).__name__})"))
+            continue
+        error = float(np.nanmax(np.abs(values - da.values)))
+        results.append((name, os.path.getsize(path), min(write_times), min(read_times), error, ""))
+        os.remove(path)
+    return results
+
+
+def print_results(results, var, shape):
+    """Print the benchmark table."""
+    reference = next(size for name, size, *_ in results if name == "engine default")
+    print(f"Variable {var}, shape {shape}, policy {get_output_encoding(var)}")
+    print(f"{'encoding':<18} {'size MB':>9} {'ratio':>6} {'write s':>8} {'read s':>8} {'max err':>10}")
+    for name, size, write_time, read_time, error, note in results:
+        if size is None:
+            print(f"{name:<18} {note}")
+            continue
+        print(f"{name:<18} {size / 1e6:>9.2f} {reference / size:>6.2f} "
+              f"{write_time:>8.3f} {read_time:>8.3f} {error:>10.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark output encodings on synthetic data")
+    parser.add_argument("--var", default="tas", help="Variable whose encoding policy is benchmarked")
+    parser.add_argument("--shape", nargs=3, type=int, default=[120, 400, 400],
+                        metavar=("TIME", "LAT", "LON"), help="Shape of the synthetic field")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions (best time is reported)")
+    parser.add_argument("--workdir", default=None,
+                        help="Directory for the test files, e.g. on Lustre (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = run_benchmark(args.var, tuple(args.shape), args.repeat, workdir)
+    print_results(results, args.var, tuple(args.shape))
+
+
+if __name__ == "__main__":
+    main()
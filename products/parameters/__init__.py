@@ -79,6 +79,13 @@ from .variables_workflow import (
     NUM_ALL_VAR,
     ALL_VAR_PROJECT,
     
+    # Output encoding
+    DEFAULT_OUTPUT_ENCODING,
+    OUTPUT_ENCODING,
+    OUTPUT_TIME_CHUNK,
+    OUTPUT_SPATIAL_CHUNK,
+    get_output_encoding,
+    
     # Functions
     get_project_variables,
 )
@@ -193,6 +200,11 @@ __all__ = [
     "get_period_aggregation",
     "ANNUAL_ONLY_VARS",
     "get_time_filters_variable",
+    "DEFAULT_OUTPUT_ENCODING",
+    "OUTPUT_ENCODING",
+    "OUTPUT_TIME_CHUNK",
+    "OUTPUT_SPATIAL_CHUNK",
+    "get_output_encoding",
     "VAR_NOT_CALCULATED",
     "URBAN_VARS",
     "LAND_ONLY_VARS",
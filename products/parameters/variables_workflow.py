@@ -31,6 +31,7 @@ VAR_TO_PIPELINE_INDEX= {
     "psl": "pslcica",
     "pethg": "pethg85cicamean"
 }
+PIPELINE_INDEX_TO_VAR = {pipeline: var for var, pipeline in VAR_TO_PIPELINE_INDEX.items()}
 
 TEMPORAL_AGG_MAPPING = {
     "cdd": ["YS"],
@@ -62,6 +63,44 @@ TEMPORAL_AGG_MAPPING = {
     "evspsbl": ["MS"],
 }
 
+# =============================================================================
+# OUTPUT ENCODING
+# =============================================================================
+
+# Default encoding of the NetCDF outputs, with the xarray/netCDF4 encoding names:
+# - compression: "zlib" (portable) or "zstd" (needs the netCDF-C zstd plugin)
+# - complevel: compression level
+# - shuffle: byte shuffle filter before compression
+# - dtype: output dtype (float64 results are downcast)
+# - significant_digits: decimal digits kept by quantisation, None for lossless
+# - chunksizes: chunk shape per dimension of the output (see get_output_encoding),
+#   capped to the dimension length
+DEFAULT_OUTPUT_ENCODING = {
+    "compression": "zlib",
+    "complevel": 4,
+    "shuffle": True,
+    "dtype": "float32",
+    "significant_digits": None,
+}
+# Chunk length along time and along each spatial dimension (lat/lon or y/x)
+OUTPUT_TIME_CHUNK = 12
+OUTPUT_SPATIAL_CHUNK = 128
+
+# Smooth fields are quantised: far below their accuracy, but it lets the
+# compressor drop the noisy trailing mantissa bits
+_SMOOTH_FIELD_ENCODING = {"significant_digits": 4}
+
+# Per-variable overrides of DEFAULT_OUTPUT_ENCODING, by base variable name
+# (bias-adjusted, aliased and pipeline names are resolved by get_output_encoding).
+# Shared with the workflow cfiles (workflow/generation_scripts/variables.py)
+OUTPUT_ENCODING = {
+    **{var: _SMOOTH_FIELD_ENCODING for var in [
+        "t", "tn", "tx", "tnn", "txx", "dtr", "tas", "tasmin", "tasmax",
+        "sfcwind", "rsds", "rlds", "huss", "clt", "sst",
+    ]},
+    "psl": {"significant_digits": 5},
+}
+
 MONTHLY_INPUT_INDEXES = [
     "spei6", "spi6", "spei6extremedry", "spei6severedry", 
     "spei6extremewet", "spei6severewet", "spi6extremedry", 
@@ -348,6 +387,31 @@ def temporal_agg(var: str):
         raise ValueError(f"Variable '{var}' not found in temporal aggregation mapping.")
     return agg
 
+def get_output_encoding(var: str, dims=("time", "lat", "lon")) -> dict:
+    """
+    Return the output encoding policy for a given variable.
+
+    Parameters
+    ----------
+    var : str
+        Variable name, possibly bias adjusted (e.g. "tasbaisimip"), aliased
+        (e.g. "r") or a pipeline name (e.g. "pslcica").
+    dims : sequence of str
+        Dimensions of the output, e.g. ("time", "lat", "lon") or ("time", "y", "x").
+
+    Returns
+    -------
+    dict
+        DEFAULT_OUTPUT_ENCODING updated with the variable's entry in OUTPUT_ENCODING,
+        with chunksizes keyed by ``dims``.
+    """
+    base_var = index_only(normalize_variable_name(var))
+    base_var = PIPELINE_INDEX_TO_VAR.get(base_var, base_var)
+    encoding = dict(DEFAULT_OUTPUT_ENCODING)
+    encoding["chunksizes"] = {dim: OUTPUT_TIME_CHUNK if dim == "time" else OUTPUT_SPATIAL_CHUNK for dim in dims}
+    encoding.update(OUTPUT_ENCODING.get(base_var, {}))
+    return encoding
+
 def index_only(index):
     """Extract base variable name by removing bias adjustment suffix."""
     if "ba" in index:
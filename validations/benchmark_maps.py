@@ -0,0 +1,104 @@
+"""
+Benchmark of map rendering: maps.single_map/triple_map against map_renderer.
+
+Renders a series of synthetic fields on the same grid (as the years of a
+domain) with the functions of maps.py, which build a new figure per map
+(drawing the regular grid as a pcolormesh, as before, and as a coarsened
+image), and with the reused figures of map_renderer, and reports maps per
+second.
+
+Usage:
+    python benchmark_maps.py --maps 20 --shape 1069 1069
+    python benchmark_maps.py --layout single --workdir /lustre/.../scratch
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import xarray as xr
+
+import maps
+from map_renderer import save_single_map, save_triple_map
+
+
+def synthetic_fields(n, shape, seed=0):
+    """``n`` temperature-like (lat, lon) fields over Europe with a sea mask."""
+    rng = np.random.default_rng(seed)
+    nlat, nlon = shape
+    lat = np.linspace(30, 72, nlat)
+    lon = np.linspace(-25, 45, nlon)
+    base = 30 - 0.6 * (lat[:, None] - 30) + 2 * np.sin(np.deg2rad(lon[None, :]) * 4)
+    mask = (np.sin(np.deg2rad(lon[None, :]) * 3) + np.cos(np.deg2rad(lat[:, None]) * 5)) > 0.6
+    fields = []
+    for _ in range(n):
+        data = base + rng.normal(0, 1, shape)
+        data[mask] = np.nan
+        fields.append(xr.DataArray(data, dims=("lat", "lon"), coords={"lat": lat, "lon": lon}, name="tas"))
+    return fields
+
+
+def render_maps(fields, layout, workdir):
+    """Figures of maps.py, one new figure per map."""
+    for i, field in enumerate(fields):
+        if layout == "single":
+            fig = maps.single_map(field, year=i, var1_name="tas", units="K")
+        else:
+            fig = maps.triple_map(field, field + 0.5, year=i, var1_name="tas", var2_name="tas", units="K", diff=True)
+        plt.savefig(os.path.join(workdir, f"maps_{i}.png"), bbox_inches='tight')
+        plt.close(fig)
+
+
+def render_renderer(fields, layout, workdir):
+    """Reused figures of map_renderer."""
+    for i, field in enumerate(fields):
+        path = os.path.join(workdir, f"renderer_{i}.png")
+        if layout == "single":
+            save_single_map(path, field, year=i, var1_name="tas", units="K")
+        else:
+            save_triple_map(path, field, field + 0.5, year=i, var1_name="tas", var2_name="tas", units="K", diff=True)
+
+
+def run_benchmark(n, shape, layout, workdir):
+    fields = synthetic_fields(n, shape)
+    results = []
+    for name, function, raster in [("pcolormesh", render_maps, False), ("raster", render_maps, True),
+                                   ("map_renderer", render_renderer, True)]:
+        maps.RASTER_REGULAR_GRIDS = raster
+        start = time.perf_counter()
+        function(fields, layout, workdir)
+        elapsed = time.perf_counter() - start
+        results.append((name, elapsed, n / elapsed))
+    maps.RASTER_REGULAR_GRIDS = True
+    return results
+
+
+def print_results(results, n, shape, layout):
+    print(f"{n} {layout} maps, grid {shape}")
+    print(f"{'renderer':<14} {'total s':>8} {'maps/s':>8} {'speed-up':>9}")
+    reference = results[0][1]
+    for name, elapsed, rate in results:
+        print(f"{name:<14} {elapsed:>8.2f} {rate:>8.2f} {reference / elapsed:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark map rendering on synthetic data")
+    parser.add_argument("--maps", type=int, default=20, help="Number of maps rendered by each method")
+    parser.add_argument("--shape", nargs=2, type=int, default=[1069, 1069], metavar=("LAT", "LON"),
+                        help="Shape of the synthetic fields")
+    parser.add_argument("--layout", choices=["single", "triple"], default="triple", help="Figure layout")
+    parser.add_argument("--workdir", default=None, help="Directory for the PNG files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = run_benchmark(args.maps, tuple(args.shape), args.layout, workdir)
+    print_results(results, args.maps, tuple(args.shape), args.layout)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,165 @@
+import hashlib
+import os
 import xarray as xr
 import numpy as np
-def calculate_climatology_for_period(file_list, variable, start_date, end_date, preprocess=None):
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from durations import decode_durations
+from dataset_pool import open_pooled
+
+SEASONS = ["DJF", "MAM", "JJA", "SON"]
+# Accumulator groups: 0 = whole period, 1-12 = months, 13-16 = seasons
+MONTH_TO_SEASON = {12: 0, 1: 0, 2: 0, 3: 1, 4: 1, 5: 1, 6: 2, 7: 2, 8: 2, 9: 3, 10: 3, 11: 3}
+N_GROUPS = 1 + 12 + len(SEASONS)
+
+# Time steps read at once from a file, bounding the memory of the reduction
+TIME_BLOCK = 31
+
+
+class ClimatologyAccumulator:
+    """
+    NaN-aware running sum, count and (optionally) sum of squares.
+
+    One accumulator per group (whole period, each month, each season), so the
+    annual, monthly and seasonal climatologies come out of the same pass.
+    Accumulators of different files can be merged in any order.
+    """
+
+    def __init__(self, shape, with_squares=False):
+        self.sum = np.zeros((N_GROUPS, *shape))
+        self.count = np.zeros((N_GROUPS, *shape), dtype="int64")
+        self.sumsq = np.zeros((N_GROUPS, *shape)) if with_squares else None
+
+    def add(self, values, months):
+        """Add a block of time steps, ``values`` of shape (time, ...) and their months."""
+        values = np.asarray(values, dtype="float64")
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0.0)
+        for group, selection in self._groups(months):
+            self.sum[group] += filled[selection].sum(axis=0)
+            self.count[group] += valid[selection].sum(axis=0)
+            if self.sumsq is not None:
+                self.sumsq[group] += (filled[selection] ** 2).sum(axis=0)
+
+    @staticmethod
+    def _groups(months):
+        months = np.asarray(months)
+        yield 0, slice(None)
+        for month in np.unique(months):
+            selection = months == month
+            yield int(month), selection
+        seasons = np.vectorize(MONTH_TO_SEASON.get)(months)
+        for season in np.unique(seasons):
+            yield 13 + int(season), seasons == season
+
+    def merge(self, other):
+        self.sum += other.sum
+        self.count += other.count
+        if self.sumsq is not None:
+            self.sumsq += other.sumsq
+        return self
+
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0, self.sum / self.count, np.nan)
+
+    def std(self):
+        if self.sumsq is None:
+            raise ValueError("The accumulator was created without sum of squares (with_squares=False).")
+        mean = self.mean()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = np.where(self.count > 0, self.sumsq / self.count, np.nan) - mean ** 2
+        return np.sqrt(np.clip(variance, 0, None))
+
+
+def partial_climatology(path, variable, start_date, end_date, with_squares=False):
+    """
+    Accumulate one file, reading the selected period in blocks of TIME_BLOCK steps.
+
+    Returns:
+    - (accumulator, template, units): template is the first time step (coordinates
+      of the result), None if the file has no time step in the period.
+    """
+    with xr.open_dataset(path) as ds:
+        da = ds[variable].sel(time=slice(start_date, end_date))
+        units = da.attrs.get("units", "days")
+        if da.sizes["time"] == 0:
+            return None, None, units
+        template = da.isel(time=0, drop=True)
+        accumulator = ClimatologyAccumulator(template.shape, with_squares=with_squares)
+        for start in range(0, da.sizes["time"], TIME_BLOCK):
+            block = decode_durations(da.isel(time=slice(start, start + TIME_BLOCK)), variable)
+            accumulator.add(block.values, block["time"].dt.month.values)
+        return accumulator, template.load(), units
+
+
+def _partial_climatologies(args, workers=1):
+    """
+    partial_climatology of each file, yielded as soon as it is ready (in a
+    pool of ``workers`` processes if workers > 1), so the caller can merge it
+    and drop it before the next one.
+    """
+    if workers <= 1:
+        for arg in args:
+            yield partial_climatology(*arg)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(partial_climatology, *arg) for arg in args}
+        for future in as_completed(futures):
+            # Drop the reference of the future, so its result is freed once merged
+            futures.discard(future)
+            yield future.result()
+
+
+def stream_climatology(file_list, variable, start_date, end_date, workers=1, with_squares=False):
+    """
+    Streaming climatology of a period over a list of files.
+
+    Files are walked in time order (sorted paths) and reduced one block at a
+    time, so memory is bounded by one block and the accumulators regardless
+    of the period length. With ``workers > 1`` the files are reduced in a
+    process pool. Each partial accumulator is merged into a running one as
+    soon as it arrives and dropped, so memory does not grow with the number
+    of files either.
+
+    Returns:
+    - result: dict with ``annual`` (lat, lon), ``monthly`` (month, lat, lon)
+      and ``seasonal`` (season, lat, lon) means, plus ``annual_std``,
+      ``monthly_std`` and ``seasonal_std`` if with_squares.
+    - units: str
+    """
+    file_list = sorted(file_list)
+    args = [(path, variable, start_date, end_date, with_squares) for path in file_list]
+    accumulator = template = units = None
+    for partial, partial_template, partial_units in _partial_climatologies(args, workers):
+        if partial is None:
+            continue
+        if accumulator is None:
+            accumulator, template, units = partial, partial_template, partial_units
+        else:
+            accumulator.merge(partial)
+        del partial
+    if accumulator is None:
+        raise ValueError(f"No time steps of {variable} between {start_date} and {end_date} in {len(file_list)} files.")
+
+    statistics = {"": accumulator.mean()}
+    if with_squares:
+        statistics["_std"] = accumulator.std()
+
+    result = {}
+    for suffix, values in statistics.items():
+        result[f"annual{suffix}"] = template.copy(data=values[0])
+        result[f"monthly{suffix}"] = xr.concat(
+            [template.copy(data=values[month]) for month in range(1, 13)], dim="month"
+        ).assign_coords(month=np.arange(1, 13))
+        result[f"seasonal{suffix}"] = xr.concat(
+            [template.copy(data=values[13 + season]) for season in range(len(SEASONS))], dim="season"
+        ).assign_coords(season=SEASONS)
+    return result, units
+
+
+def calculate_climatology_for_period(file_list, variable, start_date, end_date, preprocess=None, workers=1,
+                                     dataset="", cache=None):
     """
     Calculate climatology for a preselected period from a list of files.
 
@@ -9,32 +168,116 @@ def calculate_climatology_for_period(file_list, variable, start_date, end_date,
     - variable: Variable name to select from the dataset.
     - start_date: Start date for the period (e.g., "1990-01-01").
     - end_date: End date for the period (e.g., "1990-12-31").
-    - preprocess: Optional preprocess function for xarray.open_mfdataset.
+    - preprocess: Optional preprocess function for xarray.open_mfdataset. If
+      given, the files are opened together as before; otherwise the
+      climatology is computed by the streaming reducer (stream_climatology).
+    - workers: Number of processes reducing files in parallel (streaming only).
+    - dataset: Dataset name, part of the cache key.
+    - cache: Optional ClimatologyCache reusing earlier results (streaming only).
 
     Returns:
     - Climatology (e.g., mean) for the selected period.
     """
-    def _select_time(ds):
-        """Preprocess function to select the desired time period."""
-        ds= ds.sel(time=slice(start_date, end_date))
-        if variable in ["r01mm","r10mm","r20mm","cdd","avg_lds_wt1","max_lds_wt1","nd_thre_cold_tn0","nd_thre_cold_tn20","nd_thre_hot_tx30","nd_thre_rain50","nd_thre_rain100","nhw_tx40_dur6","nhw_tx40_dur3"]:
-            ds[variable].values = ds[variable].values.astype('timedelta64[D]')
-            ds[variable] = ds[variable] / np.timedelta64(1, 'D')
-        return ds
-
-    # Use the provided preprocess function or the default time selection
     if preprocess is None:
+        result, units = cached_climatology(file_list, variable, start_date, end_date, dataset=dataset,
+                                           cache=cache, workers=workers)
+        return result["annual"], units
 
-        preprocess = _select_time
-
-    # Open the dataset
-    ds = xr.open_mfdataset(file_list, preprocess=preprocess,concat_dim='time', combine='nested')
+    # Open the dataset (pooled, shared with the other plots of the process)
+    ds = open_pooled(file_list, preprocess=preprocess, concat_dim='time', combine='nested')
 
     # Calculate climatology (e.g., mean)
-    climatology = ds[variable].mean(dim="time")
+    climatology = decode_durations(ds[variable], variable).mean(dim="time")
 
     if "units" not in ds[variable].attrs:
         units="days"
     else:
         units=ds[variable].attrs["units"]
-    return climatology, units
\ No newline at end of file
+    return climatology, units
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cica-atlas-tools", "climatology")
+
+
+class ClimatologyCache:
+    """
+    Disk cache of stream_climatology results, one NetCDF file per entry.
+
+    The key combines the dataset, variable, reference period, whether the
+    standard deviations are included, the sorted file list and the file
+    mtimes, so a change in any input file invalidates the entry. The cache is
+    bounded in size; the least recently used entries are evicted first.
+
+    Parameters:
+    - cache_dir: str, directory of the cache.
+    - max_gb: float, maximum size of the cache in GB.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_gb=20):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(dataset, variable, start_date, end_date, file_list, with_squares=False):
+        digest = hashlib.sha256(f"{dataset}|{variable}|{start_date}|{end_date}|{with_squares}".encode())
+        for path in sorted(file_list):
+            digest.update(f"|{path}|{os.stat(path).st_mtime}".encode())
+        return digest.hexdigest()[:24]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"climatology_{key}.nc")
+
+    def get(self, key):
+        """Return (result, units) of a cached entry, or None."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with xr.open_dataset(path) as ds:
+            ds = ds.load()
+        os.utime(path)  # most recently used
+        return {name: ds[name] for name in ds.data_vars}, ds.attrs.get("units", "")
+
+    def put(self, key, result, units):
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        ds = xr.Dataset({name: da.drop_vars([c for c in da.coords if c not in da.dims and c not in ("lat", "lon")])
+                         for name, da in result.items()})
+        ds.attrs["units"] = units
+        ds.to_netcdf(tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_gb."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("climatology_") and name.endswith(".nc"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+
+def cached_climatology(file_list, variable, start_date, end_date, dataset="", cache=None,
+                       workers=1, with_squares=False):
+    """
+    stream_climatology through a ClimatologyCache (no caching if cache is None).
+
+    Returns:
+    - result, units: as stream_climatology.
+    """
+    if cache is None:
+        return stream_climatology(file_list, variable, start_date, end_date, workers=workers, with_squares=with_squares)
+    key = cache.key(dataset, variable, start_date, end_date, file_list, with_squares=with_squares)
+    cached = cache.get(key)
+    if cached is not None:
+        print(f"    Climatology of {dataset} {variable} {start_date}/{end_date} read from cache")
+        return cached
+    result, units = stream_climatology(file_list, variable, start_date, end_date, workers=workers, with_squares=with_squares)
+    cache.put(key, result, units)
+    return result, units
@@ -0,0 +1,140 @@
+"""
+Global colour-scale limits per (domain, dataset, variable), computed once.
+
+Without an entry in ``maps.scale_abs``, every map gets the scale of its own
+field, so colour bars are not comparable across years. A pre-pass
+(``generate_plots.py --color-scales``) reduces every field of the year range
+once into a ScaleAccumulator (count, min, max and a quantile sketch, which
+merge across fields), and stores the limits (min, max and PERCENTILES) in a
+small JSON. The render stage reads them instead of scanning each field.
+
+Usage:
+    from color_scale import ScaleAccumulator, save_color_scales, load_color_scales, scale_from_limits
+
+    accumulator = ScaleAccumulator()
+    accumulator.add(field)
+    save_color_scales("color_scales.json", {scale_key("EUR", "CERRA", "tas"): accumulator.limits()})
+    vscale = scale_from_limits(load_color_scales("color_scales.json")[scale_key("EUR", "CERRA", "tas")])
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+PERCENTILES = [1, 2, 5, 95, 98, 99]
+# Quantiles kept per field; merged sketches give the global percentiles
+SKETCH_POINTS = 1001
+# Percentiles bounding the robust scale
+ROBUST_PERCENTILES = (2, 98)
+
+
+def scale_key(domain, dataset, variable):
+    return f"{domain}|{dataset}|{variable}"
+
+
+class ScaleAccumulator:
+    """
+    Count, min, max and quantile sketch of the values of many fields.
+
+    Each field is scanned once (one sort of its finite values); the sketches
+    of fields of different sizes are merged weighted by their counts.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketches = []
+
+    def add(self, data):
+        values = np.asarray(data, dtype="float64").ravel()
+        values = np.sort(values[np.isfinite(values)])
+        if values.size == 0:
+            return self
+        self.count += values.size
+        self.min = min(self.min, values[0])
+        self.max = max(self.max, values[-1])
+        positions = np.linspace(0, values.size - 1, min(SKETCH_POINTS, values.size))
+        self.sketches.append((values.size, np.interp(positions, np.arange(values.size), values)))
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketches.extend(other.sketches)
+        return self
+
+    def percentiles(self, q):
+        """
+        Approximate percentiles ``q`` (0-100) of all the values added: the
+        count-weighted CDF of the sketches (piecewise linear between their
+        quantiles), inverted.
+        """
+        points = np.unique(np.concatenate([sketch for _, sketch in self.sketches]))
+        cdf = np.zeros(len(points))
+        for size, sketch in self.sketches:
+            cdf += size * np.interp(points, sketch, np.linspace(0, 1, len(sketch)), left=0, right=1)
+        cdf /= self.count
+        return np.interp(np.asarray(q) / 100, cdf, points)
+
+    def limits(self):
+        """JSON-serialisable limits: count, min, max and p<q> for q in PERCENTILES."""
+        if self.count == 0:
+            return {"count": 0}
+        limits = {"count": int(self.count), "min": float(self.min), "max": float(self.max)}
+        for q, value in zip(PERCENTILES, self.percentiles(PERCENTILES)):
+            limits[f"p{q}"] = float(value)
+        return limits
+
+
+def merge_limits(*limits):
+    """Limits covering several entries (e.g. the two datasets of a triple map)."""
+    limits = [entry for entry in limits if entry and entry.get("count")]
+    if not limits:
+        return None
+    merged = {"count": sum(entry["count"] for entry in limits),
+              "min": min(entry["min"] for entry in limits),
+              "max": max(entry["max"] for entry in limits)}
+    for q in PERCENTILES:
+        values = [entry[f"p{q}"] for entry in limits]
+        merged[f"p{q}"] = min(values) if q < 50 else max(values)
+    return merged
+
+
+def scale_from_limits(limits, robust=True):
+    """
+    [vmin, vmax] as maps.load_scale (symmetric if there are negative values,
+    from 0 otherwise), bounded by the ROBUST_PERCENTILES or by 0.9 of the
+    absolute maximum as load_scale if not ``robust``.
+    """
+    if not limits or not limits.get("count"):
+        return None
+    if robust:
+        low, high = limits[f"p{ROBUST_PERCENTILES[0]}"], limits[f"p{ROBUST_PERCENTILES[1]}"]
+        max_abs = max(abs(low), abs(high))
+    else:
+        max_abs = 0.9 * max(abs(limits["min"]), abs(limits["max"]))
+    vmin = -max_abs if limits["min"] < 0 else 0
+    return [vmin, max_abs]
+
+
+def load_color_scales(path):
+    """Limits stored in a color scales JSON, {} if the file does not exist."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_color_scales(path, scales):
+    """Add or replace the given entries of a color scales JSON."""
+    stored = load_color_scales(path)
+    stored.update(scales)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
@@ -0,0 +1,122 @@
+"""
+Process-wide pool of open xarray datasets, shared by all the plot types.
+
+The plots of a ``generate_plots.py`` run read the same collections year after
+year: the timeseries open every version with ``open_mfdataset`` for each
+year and the maps reopen their multi-year files for each plot. The pool keeps
+the opened datasets (lazy, dask-backed for multi-file collections) in an LRU
+keyed by the file list, the chunking and the open options, so a collection
+is opened (and its coordinates decoded) once per process instead of once per
+plot.
+
+The pool is bounded by the number of files held open (MAX_OPEN_FILES); the
+least recently used datasets are closed first. Its datasets are lazy (the data
+are read by the users of the pool, not kept in it), so their memory is that of
+the decoded coordinates and is not bounded separately.
+
+Datasets of the pool are shared: use ``.copy()`` before assigning variables.
+
+Usage:
+    from dataset_pool import open_pooled, close_pool
+
+    ds = open_pooled(files, concat_dim='time', combine='nested')   # open_mfdataset
+    ds = open_pooled(path)                                          # open_dataset
+    close_pool()
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+
+
+MAX_OPEN_FILES = 256
+
+_pool = OrderedDict()
+_lock = threading.RLock()
+_stats = {"hits": 0, "opens": 0, "evictions": 0}
+
+
+def configure(max_open_files=None):
+    """Change the bound of the pool (e.g. in each worker process), evicting what no longer fits."""
+    global MAX_OPEN_FILES
+    with _lock:
+        if max_open_files is not None:
+            MAX_OPEN_FILES = max_open_files
+        _evict()
+
+
+def _freeze(value):
+    """Hashable form of an option (dicts and lists of open_mfdataset/chunks)."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def pool_key(files, chunks=None, **kwargs):
+    """Key of a collection: absolute file paths, chunking and open options."""
+    if isinstance(files, (str, os.PathLike)):
+        paths = os.path.abspath(files)
+    else:
+        paths = tuple(os.path.abspath(path) for path in files)
+    return paths, _freeze(chunks), _freeze(kwargs)
+
+
+def _files(key):
+    return 1 if isinstance(key[0], str) else len(key[0])
+
+
+def _evict():
+    """Close the least recently used datasets until the pool fits its bound (the newest is kept)."""
+    while len(_pool) > 1 and sum(_files(key) for key in _pool) > MAX_OPEN_FILES:
+        _, oldest = _pool.popitem(last=False)
+        oldest.close()
+        _stats["evictions"] += 1
+
+
+def open_pooled(files, chunks=None, **kwargs):
+    """
+    Open a file (xr.open_dataset) or a list of files (xr.open_mfdataset), reusing
+    the dataset of the pool if the same collection was opened before.
+
+    Parameters:
+    - files: str, a single file, or list of str, a multi-file collection.
+    - chunks: dask chunks; None opens a single file without dask (as
+      xr.open_dataset) and a collection with one chunk per file (as
+      xr.open_mfdataset).
+    - kwargs: further options of xr.open_dataset/xr.open_mfdataset.
+
+    Returns:
+    - ds: xarray.Dataset, shared with the other users of the pool.
+    """
+    key = pool_key(files, chunks, **kwargs)
+    with _lock:
+        if key in _pool:
+            _pool.move_to_end(key)
+            _stats["hits"] += 1
+            return _pool[key]
+        if isinstance(files, (str, os.PathLike)):
+            ds = xr.open_dataset(files, chunks=chunks, **kwargs)
+        else:
+            ds = xr.open_mfdataset(list(files), chunks={} if chunks is None else chunks, **kwargs)
+        _pool[key] = ds
+        _stats["opens"] += 1
+        _evict()
+        return ds
+
+
+def close_pool():
+    """Close every dataset of the pool."""
+    with _lock:
+        while _pool:
+            _, ds = _pool.popitem()
+            ds.close()
+
+
+def pool_stats():
+    """Hits, opens and evictions of the pool, with the datasets and files it currently holds."""
+    with _lock:
+        return dict(_stats, datasets=len(_pool), files=sum(_files(key) for key in _pool))
@@ -0,0 +1,80 @@
+"""
+Duration-typed indices (cdd, r01mm, nd_thre_*, nhw_*...) decoded to days, lazily.
+
+These indices are stored as durations, so xarray decodes them to timedelta64
+(or leaves numbers with time units if opened with ``decode_timedelta=False``).
+They are registered once here and converted to whole days with element-wise
+operations (``dt.floor`` and a division, or ``np.floor`` of the scaled
+numbers), which stay lazy on dask-backed arrays and are applied block by
+block by the streaming reducers, instead of
+``ds[var].values = ds[var].values.astype('timedelta64[D]')``, which loads
+the whole array.
+
+Usage:
+    from durations import decode_durations, is_duration
+
+    ds = xr.open_mfdataset(files, preprocess=decode_dataset)   # stays lazy
+    days = decode_durations(ds["cdd"])
+"""
+
+import numpy as np
+
+
+# Variables stored as durations (timedelta) that are analysed in days
+DURATION_VARIABLES = ["r01mm", "r10mm", "r20mm", "cdd", "avg_lds_wt1", "max_lds_wt1",
+                      "nd_thre_cold_tn0", "nd_thre_cold_tn20", "nd_thre_hot_tx30",
+                      "nd_thre_rain50", "nd_thre_rain100", "nhw_tx40_dur6", "nhw_tx40_dur3"]
+
+# Days per unit of undecoded durations (CF time units)
+DAYS_PER_UNIT = {"days": 1.0, "day": 1.0, "d": 1.0,
+                 "hours": 1 / 24, "hour": 1 / 24, "h": 1 / 24,
+                 "minutes": 1 / 1440, "minute": 1 / 1440,
+                 "seconds": 1 / 86400, "second": 1 / 86400, "s": 1 / 86400}
+
+
+def register_duration(*variables):
+    """Register further variables stored as durations."""
+    for variable in variables:
+        if variable not in DURATION_VARIABLES:
+            DURATION_VARIABLES.append(variable)
+
+
+def is_duration(variable):
+    return variable in DURATION_VARIABLES
+
+
+def duration_units(ds, variable):
+    """Units of a variable of an open dataset, "days" for the duration variables."""
+    if is_duration(variable):
+        return "days"
+    return ds[variable].attrs["units"]
+
+
+def decode_durations(da, variable=None):
+    """
+    Whole days of a duration variable (``variable``, by default ``da.name``),
+    as float; other variables are returned unchanged.
+
+    Only element-wise operations are used, so a dask-backed array stays lazy
+    and a block of time steps is converted on its own.
+    """
+    variable = variable or da.name
+    if not is_duration(variable):
+        return da
+    if np.issubdtype(da.dtype, np.timedelta64):
+        days = da.dt.floor("D") / np.timedelta64(1, 'D')
+    elif da.attrs.get("units") in DAYS_PER_UNIT:
+        days = np.floor(da * DAYS_PER_UNIT[da.attrs["units"]])
+    else:
+        return da
+    days.name = da.name
+    days.attrs = {**da.attrs, "units": "days"}
+    return days
+
+
+def decode_dataset(ds):
+    """decode_durations of every duration variable of a dataset (e.g. as preprocess of open_mfdataset)."""
+    for variable in ds.data_vars:
+        if is_duration(variable):
+            ds[variable] = decode_durations(ds[variable], variable)
+    return ds
@@ -1,397 +1,160 @@
-import maps
-import matplotlib.pyplot as plt
-import os
-import gc  # Para gestión explícita de memoria
-from load_files import load_root_directories,load_files_year,load_files, load_parameters, load_datasets, check_varin
-from timeseries import plot_timeseries, select_data_point
-from climatology import calculate_climatology_for_period
-import yaml
-import sys
-
-print(sys.argv)
-
-if len(sys.argv) < 2:
-    raise ValueError("Please add a yml file")
-
-file = sys.argv[1]
-
-with open(file,'r') as f:
-    config=yaml.safe_load(f)
-
-globals_cfg=config['globals']
-datasets_cfg=config['datasets']
-
-step = globals_cfg['step']
-unit = globals_cfg['unit']
-project = globals_cfg['project']
-
-# Support for year ranges
-if 'start_year' in globals_cfg and 'end_year' in globals_cfg:
-    start_year = globals_cfg['start_year']
-    end_year = globals_cfg['end_year']
-    year_list = list(range(start_year, end_year + 1))
-else:
-    # Backward compatibility with single year
-    year = globals_cfg['year']
-    year_list = [year]
-
-domain_list = globals_cfg['domain_list']
-experiment = globals_cfg['experiment']
-model = globals_cfg['model']
-
-# Support for multiple plot types
-type_of_plot = globals_cfg.get('type_of_plot', 'triple_map')
-if isinstance(type_of_plot, str):
-    plot_types = [type_of_plot]
-else:
-    plot_types = type_of_plot
-
-# Climatology configuration
-climatology_cfg = globals_cfg.get('climatology', None)
-clim_ref_start = None
-clim_ref_end = None
-climatology_cache = {}  # Cache para almacenar climatologías por dataset/variable
-
-# Check if 'climatology' is in plot_types
-if 'climatology' in plot_types:
-    if climatology_cfg:
-        clim_ref_start = climatology_cfg.get('reference_period_start', None)
-        clim_ref_end = climatology_cfg.get('reference_period_end', None)
-    
-    if clim_ref_start is None or clim_ref_end is None:
-        raise ValueError("'climatology' in type_of_plot but reference period not specified in YML under 'climatology'")
-
-
-# ============================================================
-# CLIMATOLOGY PROCESSING (Runs once, independent of years)
-# ============================================================
-# Process climatology ONLY if requested, before year loop
-if 'climatology' in plot_types:
-    print("Starting Climatology Generation...")
-    
-    start_date = f"{clim_ref_start}-01-01"
-    end_date = f"{clim_ref_end}-12-31"
-
-    for domain in domain_list:
-        #index of domain in domain_list
-        domain_index = domain_list.index(domain)
-
-        print(domain_index, domain_list)
-        dataset_list = [ds['name'] for ds in datasets_cfg]
-        root_dict = load_root_directories(dataset_list, domain, ["CERRA-land", "CERRA"])
-        
-        # We only need to iterate unique variable combinations to avoid redundancy
-        # Assuming first dataset config drives the variables
-        ds_cfg_ref = datasets_cfg[0] 
-        v1_list = ds_cfg_ref['v1_list']
-        v2_list = ds_cfg_ref.get('v2_list', v1_list)
-
-        for v1, v2 in zip(v1_list, v2_list):
-
-            path_dict_all = load_files(root_dict, dataset_list, [v1], model, experiment, domain)
-            
-            save_dir = f"/gpfs/users/garciar/work/Validations/results/{project}/"
-            os.makedirs(save_dir, exist_ok=True)
-            
-            # --- Load/Calc Dataset 1 ---
-            print(f"    Computing climatology for {dataset_list[0]} - {v1}")
-            clim1, unit = calculate_climatology_for_period(
-                path_dict_all[dataset_list[0]][v1],
-                v1,
-                start_date,
-                end_date
-            )
-            
-            # --- TRIPLE MAP (if 2 datasets) ---
-            '''
-            if len(dataset_list) > 1:
-                path_dict_all_2 = load_files(root_dict, dataset_list, [v2], model, experiment, domain) # Ensure v2 files loaded
-                print(f"    Computing climatology for {dataset_list[1]} - {v2}")
-                clim2, unit2 = calculate_climatology_for_period(
-                    path_dict_all_2[dataset_list[1]][v2],
-                    v2,
-                    start_date,
-                    end_date
-                )
-                
-                # Interpolate
-                clim2_interp = clim2.interp(lat=clim1.lat, lon=clim1.lon, method="linear")
-                
-                save_file = f'{save_dir}/{step}_{domain}_{v1}_{model}_{experiment}_climatology_{clim_ref_start}-{clim_ref_end}_triple.png'
-                
-                print(f"    Generating map: {save_file}")
-                fig = maps.triple_map(
-                    data1=clim1,
-                    data2=clim2_interp,
-                    model_name=model,
-                    experiment=experiment,
-                    year=f"Climatology {clim_ref_start}-{clim_ref_end}",
-                    var1_name=v1,
-                    var2_name=v2,
-                    units=unit,
-                    dataset1=f"FAO-{step}",
-                    dataset2=f"CICA-{step}",
-                    diff=True,
-                    vscale_name=f"{v1}_{project}"
-                )
-                plt.savefig(save_file, bbox_inches='tight')
-                plt.close(fig)
-                
-                # CLEANUP MEMORY IMMEDIATELY
-                del clim2, clim2_interp, fig
-                gc.collect()'''
-
-            # --- SINGLE MAP ---
-            # Generate single map for Dataset 1
-            # We will just do Dataset 1 for now to match main flow logic, or iterate if needed.
-            save_file_s1 = f'{save_dir}/{step}_{domain}_{dataset_list[0]}_{v1}_{model}_{experiment}_climatology_{clim_ref_start}-{clim_ref_end}_single.png'
-            fig = maps.single_map(
-                data1=clim1,
-                model_name=model,
-                experiment=experiment,
-                year=f"Climatology {clim_ref_start}-{clim_ref_end}",
-                var1_name=v1,
-                units=unit,
-                dataset1=dataset_list[0],
-                vscale_name=f'{v1}_{project}'
-            )
-            plt.savefig(save_file_s1, bbox_inches='tight')
-            plt.close(fig)
-            del fig, clim1, unit
-            gc.collect()
+"""
+Generate the validation plots of a YAML configuration.
+
+The configuration is expanded into independent plot tasks (plot_tasks.py),
+which are rendered with the Agg backend in a pool of worker processes. Tasks
+whose PNG files already exist are skipped unless --force is given. With
+--color-scales, a pre-pass first reads every map field of the year range once
+and stores global colour limits per (domain, dataset, variable) in a JSON
+(``color_scales`` under ``globals``), so the colour bars of all the years are
+comparable. Each process keeps the datasets it opens in a bounded pool
+(dataset_pool.py, bounded by --pool-files), so the collections read
+by the plots of every year are opened once. In a serial run, the yearly means
+of the maps of the next year are read in a background thread while the
+current year is rendered (prefetch.py, --no-prefetch to disable).
+
+Usage:
+    python generate_plots.py ymls/your_config.yml
+    python generate_plots.py ymls/your_config.yml --workers 8 --max-memory 16 --force
+    python generate_plots.py ymls/your_config.yml --no-cache
+    python generate_plots.py ymls/your_config.yml --color-scales --workers 8
+    python generate_plots.py ymls/your_config.yml --pool-files 128
+"""
+
+import argparse
+import itertools
+import resource
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-            
-            # If dataset 2 exists, generate its single map too
-            '''
-            if len(dataset_list) > 1:
-                # We need to reload/recalc Dataset 2 since we deleted it to save memory for interpolation
-                # Or we could have kept it. For max memory safety, Recalc or load just for Single.
-                # If memory is the issue, recalc is safer.
-                 path_dict_all_2 = load_files(root_dict, dataset_list, [v2], model, experiment, domain)
-                 clim2_single, _ = calculate_climatology_for_period(
-                    path_dict_all_2[dataset_list[1]][v2], 
-                    v2, start_date, end_date
-                 )
-                 save_file_s2 = f'{save_dir}/{step}_{domain}_{dataset_list[1]}_{v2}_{model}_{experiment}_climatology_{clim_ref_start}-{clim_ref_end}_single.png'
-                 fig2 = maps.single_map(
-                    data1=clim2_single,
-                    model_name=model,
-                    experiment=experiment,
-                    year=f"Climatology {clim_ref_start}-{clim_ref_end}",
-                    var1_name=v2,
-                    units=unit,
-                    dataset1=dataset_list[1],
-                    vscale_name=f'{v2}_{project}'
-                )
-                 plt.savefig(save_file_s2, bbox_inches='tight')
-                 plt.close(fig2)
-                 del clim2_single, fig2
-                '''
-           
-
-    print("Climatology processing complete. Memory cleared.")
-    # Remove 'climatology' from plot_types to prevent re-execution in year loop
-    plot_types = [pt for pt in plot_types if pt != 'climatology']
-
-# Process year by year to optimize memory usage
-for year in year_list:
-    print(f"Processing year {year}...")
-    
-    # Process each plot type for the current year
-    for current_plot_type in plot_types:
-        print(f"  - Processing plot type: {current_plot_type}")
-        
-        if current_plot_type in ['triple_map', 'single_map']:
-            for domain in domain_list:
-                dataset_list = [ds['name']for ds in datasets_cfg]
-                root_dict=load_root_directories(dataset_list, domain, ["CERRA-land", "CERRA"])
-                
-                for ds in datasets_cfg:
-                    v1_list = ds['v1_list']
-                    v2_list = ds['v2_list']
-
-                    for v1,v2 in zip(v1_list,v2_list):
-                        print(f"    Processing {current_plot_type}: {v1}, {domain}, {year}, {model}, {experiment}")
-                        
-                        save_dir=f"/gpfs/users/garciar/work/Validations/results/{project}/"
-                        os.makedirs(save_dir, exist_ok=True) 
-                        
-                        
-                        # NORMAL PROCESSING (triple_map, single_map)
-                        path_dict=load_files_year(root_dict, dataset_list, v1_list, model, experiment, domain, year)
-
-                        
-                        if current_plot_type == 'triple_map':
-                            path1=path_dict[dataset_list[0]][v1][0]
-                            path2=path_dict[dataset_list[1]][v2][0]
-                            print(path_dict)
-                            
-                            ds_mean1,unit = maps.load_cds(v1,year,  path1)
-                            ds_mean2,unit = maps.load_cds(v2,year,  path2)
-                            
-                            ds_mean2_interp = ds_mean2.interp(lat=ds_mean1.lat, lon=ds_mean1.lon, method="linear")
-                            ds_mean2=ds_mean2_interp
-                            
-                            save_file=f'{save_dir}/{step}_{domain}_{v1}_{model}_{experiment}_{year}_triple.png'
-
-                            fig = maps.triple_map(
-                                data1=ds_mean1,
-                                data2=ds_mean2,
-                                model_name=model, 
-                                experiment=experiment,
-                                year=year,
-                                var1_name=v1, 
-                                var2_name=v2,
-                                units=unit,
-                                dataset1=f"FAO-{step}",
-                                dataset2=f"CICA-{step}",
-                                diff=True,
-                                vscale_name=f"{v1}_{project}"
-                            )
-                            plt.savefig(save_file,bbox_inches='tight')
-                            plt.close(fig)
-                            
-                            # Liberar memoria explícitamente
-                            del ds_mean1, ds_mean2, ds_mean2_interp, fig
-                            
-                        elif current_plot_type == 'single_map':
-                            for dataset_name in dataset_list:
-                                path = path_dict[dataset_name][v1][0]
-                                ds_mean,unit = maps.load_cds(v1,year,path)
-
-                                save_file= f'{save_dir}/{step}_{domain}_{dataset_name}_{v1}_{model}_{experiment}_{year}_single.png'
-
-                                fig = maps.single_map(
-                                    data1=ds_mean,
-                                    model_name=model,
-                                    experiment=experiment,
-                                    year=year,
-                                    var1_name=v1,
-                                    units=unit,
-                                    dataset1=dataset_name,
-                                    vscale_name=f'{v1}_{project}'
-                                )
-                                plt.savefig(save_file, bbox_inches='tight')
-                                plt.close(fig)
-                                
-                                # Liberar memoria explícitamente
-                                del ds_mean, fig
-                        
-        elif current_plot_type == 'timeseries':
-            version_list = globals_cfg.get('version_list',[])
-            lon_p = globals_cfg.get('lon_point', -3.8)
-            lat_p = globals_cfg.get('lat_point', 40.4)
-
-            for version in version_list:
-                
-                save_dir=f"/gpfs/users/garciar/work/Validations/results/{project}/"
-
-                os.makedirs(save_dir, exist_ok=True)
-
-                params = load_parameters(version)
-                root_dict=load_root_directories(params['dataset_list'], params['domain'],params['project_list'])
-                
-                file_dict=load_files(root_dict,params['dataset_list'], params['var_list'],params['model'],params['experiment'],params['domain'])
-                
-                # Validar que hay archivos antes de intentar cargar datasets
-                has_files = False
-                for dataset in params['dataset_list']:
-                    for var in params['var_list']:
-                        var_check = check_varin(dataset, var)
-                        if dataset in file_dict and var_check in file_dict[dataset]:
-                            if file_dict[dataset][var_check]:
-                                has_files = True
-                                break
-                    if has_files:
-                        break
-                
-                if not has_files:
-                    print(f"\n⚠️  WARNING: No files found for version '{version}'")
-                    print(f"    Datasets: {params['dataset_list']}")
-                    print(f"    Variables: {params['var_list']}")
-                    print(f"    Domain: {params['domain']}")
-                    print(f"    Skipping timeseries for this version...\n")
-                    continue
-                
-                ds_dict=load_datasets(file_dict,params['dataset_list'], params['var_list'])
-                
-                # Verificar que se cargaron datasets
-                if not ds_dict or "ds" not in ds_dict or not ds_dict["ds"]:
-                    print(f"\n⚠️  WARNING: No datasets loaded for version '{version}'")
-                    print(f"    Skipping timeseries for this version...\n")
-                    continue
-                
-                Dict=ds_dict
-                
-
-                dataset_list = params["dataset_list"]
-                var_list = params["var_list"]
-
-                # Ejes lon/lat dinámicos
-                if "CORDEX-CORE" in dataset_list[0] and version == "pre":
-                    lon = "x"
-                    lat = "y"
-                elif "ERA5" in dataset_list[0]:
-                    lon = "lon"
-                    lat = "lat"
-                else:
-                    lon = "lon"
-                    lat = "lat"	
-
-                # Seleccionar punto
-                Dict["ds_point"] = {}
-                for dataset in dataset_list:
-                    if dataset in Dict["ds"]:
-                        Dict["ds_point"][dataset] = select_data_point(Dict["ds"][dataset],dataset,lon_p,lat_p)
-                    else:
-                        print(f"⚠️  WARNING: Dataset '{dataset}' not loaded, skipping point selection")
-
-                # Solo para el primer año, hacer timeseries completa de comparación de datasets
-                if year == year_list[0]:
-                    # Timeseries comparación de datasets
-                    for varin in var_list:
-                        data_list = []
-                        for dataset in dataset_list:
-                            varin = check_varin(dataset, varin)
-                            data_list.append(Dict["ds_point"][dataset][varin])
-                            
-                        title = f"timeseries {varin} dataset comparison for model:{params['model']}, experiment:{params['experiment']}, lon:{lon_p}, lat:{lat_p}"
-                        save_file = f"{save_dir}/timeseries_{varin}_dataset_comparison_lon{lon_p}_lat{lat_p}_{varin}_{version}.png"
-                        plot_timeseries(data_list, varin, dataset_list, title, save_file)
-
-                # Recorte anual para el año actual
-                Dict_year = {"ds_point": {}, "ds": {}}
-                for dataset in dataset_list:
-                    Dict_year["ds_point"][dataset] = Dict["ds_point"][dataset].sel(time=slice(f"{year}-01-01", f"{year}-12-31"))
-                    Dict_year["ds"][dataset] = Dict["ds"][dataset].sel(time=slice(f"{year}-01-01", f"{year}-12-31"))
-
-                # Timeseries anuales
-                for varin in var_list:
-                    data_list = []
-                    for dataset in dataset_list:
-                        varin = check_varin(dataset, varin)
-                        data_list.append(Dict_year["ds_point"][dataset][varin])
-                    title = f"timeseries {varin} dataset comparison for lon:{lon_p}, lat:{lat_p}, year:{year}"
-                    save_file = f"{save_dir}/timeseries_{varin}_dataset_comparison_lon{lon_p}_lat{lat_p}_{varin}_{year}_{version}.png"
-                    plot_timeseries(data_list, varin, dataset_list, title, save_file)
-
-                # Timeseries lonlat mean
-                for varin in var_list:
-                    data_list = []
-                    for dataset in dataset_list:
-                        varin = check_varin(dataset, varin)
-                        data_list.append(Dict_year["ds"][dataset][varin].mean(dim=(lat, lon)))
-                    title = f"timeseries {varin} dataset daily comparison for lonlatmean, year:{year}"
-                    save_file = f"{save_dir}/timeseries_{varin}_dataset_comparison_lonlatmean_{year}_{version}.png"
-                    plot_timeseries(data_list, varin, dataset_list, title, save_file)
-                
-                # Liberar memoria explícitamente
-                del Dict, Dict_year, ds_dict, file_dict
+import yaml
 
-        else:
-            raise ValueError(f"Tipo de plot '{current_plot_type}' no implementado.")
-    
-    print(f"Completed processing for year {year}")
-    # Forzar limpieza de memoria entre años
-    plt.close('all')  # Cerrar cualquier figura que pueda quedar abierta
-    gc.collect()  # Forzar recolección de basura para liberar memoria
+import dataset_pool
+from color_scale import save_color_scales
+from plot_tasks import expand_tasks, field_keys, load_settings, render_task, read_fields, scale_fields, scan_fields
+from prefetch import Prefetcher
+
+
+def init_worker(max_memory_gb, pool_files=None):
+    """
+    Cap the address space of a worker so that one task cannot exhaust the node,
+    and bound its pool of open datasets.
+    """
+    if max_memory_gb:
+        limit = int(max_memory_gb * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    dataset_pool.configure(max_open_files=pool_files)
+
+
+def run_tasks(tasks, settings, workers=1, max_memory_gb=None, pool_files=None, prefetch=True):
+    """
+    Render the tasks, serially or in a pool of ``workers`` processes.
+
+    Serially, with ``prefetch``, the fields of the tasks of the next year are
+    read in a background thread while the tasks of the current year render.
+    Their paths are resolved beforehand in the main thread, so the reader
+    thread does not use the catalog (sqlite connections are per thread) nor
+    the per-process file dicts.
+
+    Returns:
+    - failed: list of (task, error) for the tasks that raised.
+    """
+    failed = []
+    if workers <= 1:
+        init_worker(max_memory_gb, pool_files)
+        years = [list(year_tasks) for _, year_tasks in itertools.groupby(tasks, key=lambda task: task.year)]
+        keys = [field_keys(year_tasks, settings) if prefetch else [] for year_tasks in years]
+        prefetcher = Prefetcher(range(len(years)), lambda group: read_fields(keys[group]))
+        done = 0
+        for group, fields in prefetcher:
+            for task in years[group]:
+                done += 1
+                print(f"[{done}/{len(tasks)}] {task}")
+                task, error = render_task(task, settings, fields)
+                if error:
+                    failed.append((task, error))
+        if prefetch:
+            print(prefetcher.report())
+        stats = dataset_pool.pool_stats()
+        print(f"Dataset pool: {stats['opens']} opened, {stats['hits']} reused, {stats['evictions']} evicted")
+        return failed
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(max_memory_gb, pool_files)) as executor:
+        futures = {executor.submit(render_task, task, settings): task for task in tasks}
+        for i, future in enumerate(as_completed(futures), 1):
+            task = futures[future]
+            try:
+                task, error = future.result()
+            except Exception as exc:
+                # The worker itself died (e.g. killed by the OOM killer)
+                error = f"{type(exc).__name__}: {exc}"
+            print(f"[{i}/{len(tasks)}] {task}{' FAILED: ' + error if error else ''}")
+            if error:
+                failed.append((task, error))
+    return failed
+
+
+def compute_color_scales(tasks, settings, workers=1):
+    """
+    Pre-pass: global colour limits of the fields of the map tasks, one
+    (domain, dataset, variable) per job, stored in settings["color_scales"].
+    """
+    fields = scale_fields(tasks, settings)
+    print(f"Colour scales of {len(fields)} (domain, dataset, variable) from "
+          f"{sum(len(year_fields) for year_fields in fields.values())} fields")
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(scan_fields, key, year_fields, settings): key for key, year_fields in fields.items()}
+        for future in as_completed(futures):
+            try:
+                key, limits = future.result()
+                results[key] = limits
+            except Exception as exc:
+                # The maps of this variable fall back to the scale of each field
+                print(f"Colour scale of {futures[future]} FAILED: {type(exc).__name__}: {exc}")
+    save_color_scales(settings["color_scales"], results)
+    print(f"Colour scales written to {settings['color_scales']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate validation plots from a YAML configuration")
+    parser.add_argument("config", help="YAML configuration file (see ymls/)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--max-memory", type=float, default=None,
+                        help="Memory cap per worker in GB (tasks exceeding it fail with MemoryError)")
+    parser.add_argument("--pool-files", type=int, default=None,
+                        help=f"Files kept open per process by the dataset pool (default {dataset_pool.MAX_OPEN_FILES})")
+    parser.add_argument("--no-prefetch", action="store_true",
+                        help="Do not read the next year's fields in the background of a serial run")
+    parser.add_argument("--force", action="store_true", help="Render tasks whose PNG files already exist")
+    parser.add_argument("--no-cache", action="store_true", help="Recompute climatologies instead of using the disk cache")
+    parser.add_argument("--color-scales", action="store_true",
+                        help="Compute global colour scales of the maps over the year range before rendering")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    settings = load_settings(config)
+    if args.no_cache:
+        settings["clim_cache_dir"] = None
+    tasks = expand_tasks(settings)
+    if args.color_scales:
+        compute_color_scales(tasks, settings, workers=args.workers)
+    pending = tasks if args.force else [task for task in tasks if not task.done()]
+    print(f"{len(tasks)} plot tasks, {len(tasks) - len(pending)} already rendered, "
+          f"{len(pending)} to render with {args.workers} worker(s)")
+
+    failed = run_tasks(pending, settings, workers=args.workers, max_memory_gb=args.max_memory,
+                       pool_files=args.pool_files, prefetch=not args.no_prefetch)
+    for task, error in failed:
+        print(f"FAILED {task}: {error}")
+    if failed:
+        raise SystemExit(f"{len(failed)} of {len(pending)} plot tasks failed")
+
+
+if __name__ == "__main__":
+    main()
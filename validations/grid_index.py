@@ -0,0 +1,124 @@
+"""
+Nearest-cell spatial index of curvilinear and rotated grids.
+
+A KD-tree is built once per grid on the 3D unit vectors of the 2D lat/lon
+coordinates (chord distance is monotonic with great-circle distance, so the
+nearest cell is exact also near the poles and across the dateline). Trees are
+kept in memory per process and cached to disk, and answer vectorised
+nearest-cell queries for many points at once.
+
+Usage:
+    from grid_index import get_grid_index
+
+    index = get_grid_index(ds)
+    iy, ix = index.query(lon_points, lat_points)
+    ds.isel({index.dims[0]: xr.DataArray(iy, dims="point"), index.dims[1]: xr.DataArray(ix, dims="point")})
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cica-atlas-tools", "grid_index")
+EARTH_RADIUS_KM = 6371.0
+
+
+def _unit_vectors(lon, lat):
+    lon, lat = np.deg2rad(np.asarray(lon, dtype="float64")), np.deg2rad(np.asarray(lat, dtype="float64"))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+class GridIndex:
+    """
+    KD-tree over the cells of a grid with 2D (or 1D, expanded) lat/lon coordinates.
+
+    Parameters:
+    - lat, lon: arrays of the cell centres, both 2D (y, x) or both 1D (lat, lon).
+    - dims: tuple, names of the two spatial dimensions (for isel).
+    """
+
+    def __init__(self, lat, lon, dims=("y", "x")):
+        lat, lon = np.asarray(lat, dtype="float64"), np.asarray(lon, dtype="float64")
+        if lat.ndim == 1:
+            lat, lon = np.meshgrid(lat, lon, indexing="ij")
+        self.shape = lat.shape
+        self.dims = tuple(dims)
+        valid = np.isfinite(lat.ravel()) & np.isfinite(lon.ravel())
+        self.cells = np.nonzero(valid)[0]
+        self.tree = cKDTree(_unit_vectors(lon.ravel()[valid], lat.ravel()[valid]))
+
+    def query(self, lon, lat, max_distance_km=None):
+        """
+        Nearest cell of each point.
+
+        Parameters:
+        - lon, lat: scalars or arrays of point coordinates in degrees.
+        - max_distance_km: float, optional; points farther than this from any
+          cell get index -1.
+
+        Returns:
+        - (iy, ix): integer arrays of the cell indices along ``dims``.
+        """
+        lon, lat = np.atleast_1d(lon), np.atleast_1d(lat)
+        distance, nearest = self.tree.query(_unit_vectors(lon, lat))
+        iy, ix = np.unravel_index(self.cells[nearest], self.shape)
+        if max_distance_km is not None:
+            far = distance * EARTH_RADIUS_KM > max_distance_km
+            iy, ix = np.where(far, -1, iy), np.where(far, -1, ix)
+        return iy, ix
+
+
+def grid_spacing_km(lat, lon):
+    """Largest median distance in km between neighbouring cells of a 2D grid, along either dimension."""
+    vectors = _unit_vectors(lon, lat).reshape(*np.shape(lat), 3)
+    spacing = [np.nanmedian(np.linalg.norm(np.diff(vectors, axis=axis), axis=-1)) for axis in (0, 1)]
+    return float(np.nanmax(spacing)) * EARTH_RADIUS_KM
+
+
+def grid_key(lat, lon):
+    digest = hashlib.sha256()
+    for coord in (lat, lon):
+        coord = np.ascontiguousarray(coord, dtype="float64")
+        digest.update(str(coord.shape).encode())
+        digest.update(coord.tobytes())
+    return digest.hexdigest()[:16]
+
+
+_grid_indexes = {}
+
+
+def get_grid_index(ds, lat="lat", lon="lon", cache_dir=CACHE_DIR):
+    """
+    Return the GridIndex of the grid of ``ds`` (Dataset or DataArray).
+
+    The index is built once per grid: reused from memory within a process and
+    from ``cache_dir`` across processes and runs (no disk cache if None).
+    """
+    lat_values, lon_values = ds[lat].values, ds[lon].values
+    key = grid_key(lat_values, lon_values)
+    if key in _grid_indexes:
+        return _grid_indexes[key]
+
+    if ds[lat].ndim == 2:
+        dims = ds[lat].dims
+    else:
+        dims = (ds[lat].dims[0], ds[lon].dims[0])
+
+    cache_file = os.path.join(cache_dir, f"grid_index_{key}.pkl") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            index = pickle.load(f)
+    else:
+        index = GridIndex(lat_values, lon_values, dims=dims)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_file)
+    _grid_indexes[key] = index
+    return index
@@ -3,6 +3,8 @@ import numpy as np
 import glob
 import os
 import xarray as xr
+from time_coverage import files_overlapping
+from dataset_pool import open_pooled
 
 def load_root_directories(dataset_list, domain, project_list):
     """
@@ -158,7 +160,7 @@ def load_parameters(version):
 
 
 
-def load_files(root_dict, dataset_list, var_list, model, experiment, domain):
+def load_files(root_dict, dataset_list, var_list, model, experiment, domain, catalog=None):
     """
     Load file paths for each dataset and variable.
 
@@ -169,6 +171,8 @@ def load_files(root_dict, dataset_list, var_list, model, experiment, domain):
     - model: str, the model name.
     - experiment: str, the experiment name.
     - domain: str, the domain name.
+    - catalog: DatasetCatalog, optional, answer the search patterns from the
+      dataset catalog instead of globbing the file system.
 
     Returns:
     - file_dict: dict, the file paths for each dataset and variable.
@@ -230,20 +234,50 @@ def load_files(root_dict, dataset_list, var_list, model, experiment, domain):
                 search_path = root
             else:
                 search_path = os.path.join(root, pattern)
-                file_list = np.sort(glob.glob(search_path))
+                if catalog is not None:
+                    file_list = np.sort(catalog.glob(search_path))
+                else:
+                    file_list = np.sort(glob.glob(search_path))
 
             file_dict[dataset][varin] = file_list
             #print(dataset, file_dict[dataset][varin], search_path)
 
     return file_dict
-def load_files_year(root_dict, dataset_list, var_list, model, experiment, domain, year):
-    file_dict=load_files(root_dict, dataset_list, var_list, model, experiment, domain)
+def load_files_period(root_dict, dataset_list, var_list, model, experiment, domain, start, end,
+                      catalog=None, file_dict=None, workers=8):
+    """
+    Load the file paths whose time coverage overlaps a period.
+
+    The coverage is read from the time coordinate of each file (see
+    time_coverage.py), not from the file name, so multi-year files are
+    selected correctly.
+
+    Parameters:
+    - start, end: str, period bounds as ``YYYY-MM-DDTHH:MM:SS``.
+    - catalog: DatasetCatalog, optional, passed to load_files.
+    - file_dict: dict, optional, output of load_files to filter instead of
+      searching the files again (e.g. once for all the years of a run).
+    - workers: int, threads reading the file headers.
+
+    Returns:
+    - file_dict: dict, the file paths for each dataset and variable.
+    """
+    if file_dict is None:
+        file_dict = load_files(root_dict, dataset_list, var_list, model, experiment, domain, catalog=catalog)
+    selected = {}
     for dataset in dataset_list:
-        root = root_dict[dataset]
-        for varin in var_list:
-            selected_files = [f for f in  file_dict[dataset][varin]if f"_{year}" in f]
-            file_dict[dataset][varin] = selected_files
-    return file_dict
+        selected[dataset] = {}
+        for varin, files in file_dict[dataset].items():
+            selected[dataset][varin] = files_overlapping(files, start, end, workers=workers)
+    return selected
+
+
+def load_files_year(root_dict, dataset_list, var_list, model, experiment, domain, year, catalog=None, file_dict=None):
+    return load_files_period(root_dict, dataset_list, var_list, model, experiment, domain,
+                             f"{year}-01-01T00:00:00", f"{year}-12-31T23:59:59",
+                             catalog=catalog, file_dict=file_dict)
+
+
 def load_datasets(file_dict, dataset_list, var_list):
     """
     Load datasets for each dataset and variable.
@@ -269,10 +303,11 @@ def load_datasets(file_dict, dataset_list, var_list):
                 print(f"         Skipping this dataset/variable combination")
                 continue
             
+            # Pooled: each collection is opened once per process (copied, as the pool is shared)
             if i == 0:
-                ds = xr.open_mfdataset(dict_varin, concat_dim='time', combine='nested')
+                ds = open_pooled(dict_varin, concat_dim='time', combine='nested').copy()
             else:
-                ds[varin] = xr.open_mfdataset(dict_varin, concat_dim='time', combine='nested')[varin]
+                ds[varin] = open_pooled(dict_varin, concat_dim='time', combine='nested')[varin]
 
             #if varin in ["rsds", "rlds", "sfcwind"]:
             #    ds[varin] = ds[varin].resample(time="MS").mean()
@@ -0,0 +1,164 @@
+"""
+Map figures built once per (grid, layout) and reused for every field.
+
+``maps.single_map`` and ``maps.triple_map`` build a new figure, cartopy axes,
+coastlines, gridlines and colorbars for every map. A MapRenderer builds them
+once for a grid and a layout; rendering a new field only replaces the data
+of the pcolormesh, the colour limits, the colorbar label and the titles,
+then saves the figure. Renderers are kept per process (a small LRU), so the
+maps of all the years of a domain share one figure.
+
+Regular lat/lon grids are drawn as one image coarsened to about one cell per
+output pixel (as ``maps.plot_avg``), other grids as a pcolormesh.
+
+The figures are created without pyplot (``matplotlib.figure.Figure`` on an
+Agg canvas), so ``plt.close('all')`` between tasks does not close them.
+
+Usage:
+    from map_renderer import save_single_map, save_triple_map
+
+    save_single_map("map.png", ds_mean, var1_name="tas", units="K", dataset1="CERRA")
+    save_triple_map("triple.png", ds_mean1, ds_mean2, var1_name="tas", var2_name="tas", diff=True)
+"""
+
+from collections import OrderedDict
+
+import cartopy.crs as ccrs
+import matplotlib
+import numpy as np
+import xarray as xr
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from maps import (check_lonlat, load_scale, common_scale, scale_abs, scale_dif, title_text,
+                  regular_step, raster_factors, raster_image)
+from grid_index import grid_key
+
+
+# Panels (number of rows of the figure, panels drawn, colormap, colorbar shrink) of each layout
+LAYOUTS = {
+    "single": (1, 1, "viridis", 0.3),
+    "double": (3, 2, "RdBu_r", 1),
+    "triple": (3, 3, "RdBu_r", 1),
+}
+FIGSIZE = [20, 30]
+FONTSIZE = 20
+MAX_RENDERERS = 4
+
+
+class MapRenderer:
+    """
+    Figure, axes, coastlines, gridlines, meshes and colorbars of a layout on one grid.
+
+    Parameters:
+    - lat, lon: 1D coordinates of the grid.
+    - layout: str, one of LAYOUTS.
+    - dpi: output resolution the regular grids are coarsened to (default the savefig dpi).
+    """
+
+    def __init__(self, lat, lon, layout="single", dpi=None):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unsupported layout: {layout}. Supported layouts: {list(LAYOUTS)}")
+        nrows, npanels, cmap, shrink = LAYOUTS[layout]
+        self.shape = (len(lat), len(lon))
+        self.figure = Figure(figsize=FIGSIZE)
+        FigureCanvasAgg(self.figure)
+        cmap = matplotlib.colormaps[cmap]
+        extent = [np.min(lon), np.max(lon), np.min(lat), np.max(lat)]
+        self.regular = regular_step(lat) is not None and regular_step(lon) is not None
+        template = xr.DataArray(np.full(self.shape, np.nan), dims=("lat", "lon"), coords={"lat": lat, "lon": lon})
+        self.panels = []
+        with matplotlib.rc_context({'font.size': FONTSIZE}):
+            for i in range(npanels):
+                ax = self.figure.add_subplot(nrows, 1, i + 1, projection=ccrs.PlateCarree())
+                ax.set_extent(extent, crs=ccrs.PlateCarree())
+                if self.regular:
+                    factors = raster_factors(self.shape, ax, dpi)
+                    values, image_extent = raster_image(template, factors)
+                    mesh = ax.imshow(values, extent=image_extent, origin="lower", cmap=cmap,
+                                     interpolation="nearest", transform=ccrs.PlateCarree())
+                    mesh.factors = factors
+                else:
+                    mesh = ax.pcolormesh(lon, lat, np.ma.masked_all(self.shape), cmap=cmap, shading="nearest",
+                                         transform=ccrs.PlateCarree())
+                ax.coastlines(linewidth=1.5, color='k', alpha=0.5, linestyle='-')
+                gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                                  linewidth=0.9, color='gray', alpha=0.5, linestyle='--')
+                gl.top_labels = False
+                gl.right_labels = False
+                colorbar = self.figure.colorbar(mesh, ax=ax, shrink=shrink, extend="both")
+                title = ax.set_title("")
+                self.panels.append((mesh, colorbar, title))
+
+    def render(self, path, fields, vscales, titles, units="units"):
+        """
+        Draw one field per panel and save the figure to ``path``.
+
+        Parameters:
+        - fields: list of 2D DataArrays (lat, lon) on the grid of the renderer.
+        - vscales: list of [vmin, vmax], one per panel.
+        - titles: list of str, one per panel.
+        """
+        for (mesh, colorbar, title), field, vscale, text in zip(self.panels, fields, vscales, titles):
+            lon, lat = check_lonlat(field)
+            if field.transpose(lat, lon).shape != self.shape:
+                raise ValueError(f"Field of shape {field.transpose(lat, lon).shape} on a renderer of shape {self.shape}")
+            if self.regular:
+                mesh.set_data(raster_image(field, mesh.factors, lon=lon, lat=lat)[0])
+            else:
+                values = np.asarray(field.transpose(lat, lon).values, dtype="float64")
+                mesh.set_array(np.ma.masked_invalid(values))
+            mesh.set_clim(*vscale)
+            colorbar.set_label(units)
+            title.set_text(text)
+        self.figure.savefig(path, bbox_inches='tight')
+
+
+_renderers = OrderedDict()
+
+
+def get_renderer(data, layout="single"):
+    """Return the MapRenderer of the grid of ``data`` and a layout, built once per process."""
+    lon, lat = check_lonlat(data)
+    key = (layout, grid_key(data[lat].values, data[lon].values))
+    if key in _renderers:
+        _renderers.move_to_end(key)
+        return _renderers[key]
+    _renderers[key] = MapRenderer(data[lat].values, data[lon].values, layout=layout)
+    while len(_renderers) > MAX_RENDERERS:
+        _renderers.popitem(last=False)
+    return _renderers[key]
+
+
+def _period(year, month):
+    return year if month is None else f"{year}-month:{month}"
+
+
+def save_single_map(path, data1, model_name='model', experiment='experiment', year='year', month=None,
+                    var1_name='var1_name', units="units", dataset1="CICA", vscale_name=None, vscale=None):
+    """Same figure as maps.single_map, saved to ``path`` with a reused renderer."""
+    vscale = scale_abs(vscale_name or var1_name) or vscale
+    if vscale is None:
+        vscale = load_scale(data1)
+    title = title_text(var1_name, var1_name, dataset1, "", model_name, experiment, _period(year, month), step=1)
+    get_renderer(data1, "single").render(path, [data1], [vscale], [title], units=units)
+
+
+def save_triple_map(path, data1, data2, model_name='model', experiment='experiment', year='year', month=None,
+                    var1_name='var1_name', var2_name='var2_name', units="units", dataset1="CICA",
+                    dataset2="v1_dataset", vscale_name=None, diff=False, vscale=None):
+    """Same figure as maps.triple_map, saved to ``path`` with a reused renderer."""
+    vscale_name = vscale_name or var1_name
+    vscale = scale_abs(vscale_name) or vscale
+    if vscale is None:
+        vscale = common_scale(data1, data2)
+    period = _period(year, month)
+    fields, vscales = [data1, data2], [vscale, vscale]
+    titles = [title_text(var1_name, var2_name, dataset1, dataset2, model_name, experiment, period, step=step)
+              for step in (1, 2)]
+    if diff:
+        ds_diff = data1 - data2
+        fields.append(ds_diff)
+        vscales.append(scale_dif(vscale_name) or load_scale(ds_diff))
+        titles.append(title_text(var1_name, var2_name, dataset1, dataset2, model_name, experiment, period, step=3))
+    get_renderer(data1, "triple" if diff else "double").render(path, fields, vscales, titles, units=units)
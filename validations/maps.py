@@ -6,17 +6,29 @@ import xarray as xr
 import warnings
 import numpy as np
 
+from durations import decode_durations, duration_units
+from dataset_pool import open_pooled, close_pool
+
 
 
 import zipfile, os
 warnings.filterwarnings('ignore')
 
-def load_scale(data):
+def value_range(data):
+    """(min, max) of a field ignoring NaN, each computed once."""
+    values = np.asarray(data)
+    return np.nanmin(values), np.nanmax(values)
+
+def load_scale(data, data_range=None):
     """
     Function to get a value scale for plots from max values
+
+    ``data_range`` is the (min, max) of data if already known (value_range).
     """    
-    max_abs = abs_max(data)
-    if np.nanmin(data)<0:
+    if data_range is None:
+        data_range = value_range(data)
+    max_abs = abs_max(data, data_range)
+    if data_range[0]<0:
         vmin = -max_abs * 0.9
     else:
         vmin=0
@@ -24,57 +36,67 @@ def load_scale(data):
     vscale = [vmin, vmax]
     return vscale
 
-def abs_max(data):
+def abs_max(data, data_range=None):
     """
     Function to get max abs value from data
     """
     #Gives abs max from data
     #print(data)
-    if abs(np.nanmax(data))> abs(np.nanmin(data)):
-        max_abs = abs(np.nanmax(data))
+    vmin, vmax = value_range(data) if data_range is None else data_range
+    if abs(vmax)> abs(vmin):
+        max_abs = abs(vmax)
     else:
-        max_abs = abs(np.nanmin(data))
+        max_abs = abs(vmin)
     print(f"max abs is {max_abs}")
     return max_abs
+# Consecutive years read from the same multi-year file reuse one handle of
+# the process-wide dataset pool instead of opening and decoding the file again
+def open_cached(path):
+    """Open a dataset lazily, reusing the handle of the dataset pool."""
+    return open_pooled(path)
+
+
+def close_cached():
+    """Close every dataset held by the dataset pool."""
+    close_pool()
+
+
+def dataset_units(ds, var):
+    """Units of a variable of an open dataset."""
+    return duration_units(ds, var)
+
+
 def load_units(file, var):
     """Load units for a given variable."""
     print(f"Loading units for {var} from {file}")
-    if var == "cdd":
-        return "days"
-    else:
-        with xr.open_dataset(file) as ds:
-            if var in ["avg_lds_wt1","max_lds_wt1","nd_thre_cold_tn0","nd_thre_cold_tn20","nd_thre_hot_tx30","nd_thre_rain50","nd_thre_rain100","nhw_tx40_dur6","nhw_tx40_dur3"]:
-                units="days"
-            else:
-                units=ds[var].attrs["units"]
-            return units
+    return dataset_units(open_cached(file), var)
+
+
 def load_cds(var, year, path,new=False,month=None):
     """
     Function to load cds datasets for var,experiment and year
+
+    The file is opened once (and kept in a small LRU for the following years),
+    the time window is selected lazily and only that window is decoded and
+    averaged. Returns the mean and the units read from the same handle.
     """    
     # C3S DATA
     if new is True:
         var=var.split("_")[1]
     print("path:",path)
-    ds = xr.open_dataset(path)
-    if var in ["cdd","avg_lds_wt1","max_lds_wt1","nd_thre_cold_tn0","nd_thre_cold_tn20","nd_thre_hot_tx30","nd_thre_rain50","nd_thre_rain100","nhw_tx40_dur6","nhw_tx40_dur3"]:
-        ds[var].values = ds[var].values.astype('timedelta64[D]')
-        ds[var].values = ds[var].values / np.timedelta64(1, 'D')
-    units=load_units(path, var)
-    
+    ds = open_cached(path)
+    units = dataset_units(ds, var)
+
     if month==None:
-        ds = ds.sel(time=slice(f'{year}-01', f'{year}-12'))
+        da = ds[var].sel(time=slice(f'{year}-01', f'{year}-12'))
     else:
-        ds = ds.sel(time=slice(f'{year}-{month}', f'{year}-{month}'))
-    #print(ds)    
-    #print(ds[var].shape)
-    ds_mean = ds[var].sel().mean("time")
+        da = ds[var].sel(time=slice(f'{year}-{month}', f'{year}-{month}'))
+    # Whole days, as plotted
+    da = decode_durations(da, var)
+    ds_mean = da.mean("time").load()
 
-    #print(ds_mean.shape)
     # noinspection PyArgumentList
-    print("CDS min :", ds_mean.values.min(), "max:", ds_mean.values.max())
-    ds.close()
-    del ds
+    print("CDS min :", np.nanmin(ds_mean.values), "max:", np.nanmax(ds_mean.values))
     return ds_mean,units
 def unzipall(dir_name,extension=".zip"):
     os.chdir(dir_name) # change directory from working dir to dir with files
@@ -108,9 +130,84 @@ def check_lonlat(ds):
     return lon,lat
 
 
-def plot_avg(data, ax, vscale=None, units="unit", shrink_cb=1,cmap="RdBu_r",grid=True):
+# Draw regular lat/lon grids as one (coarsened) image instead of a pcolormesh
+RASTER_REGULAR_GRIDS = True
+
+
+def regular_step(coord, rtol=1e-3):
+    """Spacing of an equally spaced 1D coordinate, None if the coordinate is not regular."""
+    values = np.asarray(coord, dtype="float64")
+    if values.ndim != 1 or len(values) < 2:
+        return None
+    steps = np.diff(values)
+    if np.allclose(steps, steps[0], rtol=rtol, atol=0) and steps[0] != 0:
+        return steps[0]
+    return None
+
+
+def raster_factors(shape, ax, dpi=None):
+    """
+    Block sizes (lat, lon) that bring a field of ``shape`` to about one cell
+    per output pixel of ``ax`` (at ``dpi``, by default the savefig/figure dpi).
+    """
+    fig = ax.figure
+    if dpi is None:
+        dpi = plt.rcParams['savefig.dpi']
+        if dpi == 'figure':
+            dpi = fig.dpi
+    bbox = ax.get_position()
+    width_px = bbox.width * fig.get_figwidth() * dpi
+    height_px = bbox.height * fig.get_figheight() * dpi
+    return max(1, int(shape[0] // max(height_px, 1))), max(1, int(shape[1] // max(width_px, 1)))
+
+
+def coarsen_blocks(data, factors, lon="lon", lat="lat"):
+    """
+    NaN-aware block mean of a 2D (lat, lon) field over blocks of ``factors``
+    cells; the last blocks are partial (padded with NaN), so the extent is kept.
+    """
+    fy, fx = factors
+    if fy == 1 and fx == 1:
+        return data
+    data = data.transpose(lat, lon)
+    ny, nx = data.shape
+    pad = ((0, -ny % fy), (0, -nx % fx))
+    values = np.pad(np.asarray(data.values, dtype="float64"), pad, constant_values=np.nan)
+    blocks = values.reshape(values.shape[0] // fy, fy, values.shape[1] // fx, fx)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        means = np.nanmean(blocks, axis=(1, 3))
+        lat_values = np.nanmean(np.pad(data[lat].values.astype("float64"), pad[0], constant_values=np.nan).reshape(-1, fy), axis=1)
+        lon_values = np.nanmean(np.pad(data[lon].values.astype("float64"), pad[1], constant_values=np.nan).reshape(-1, fx), axis=1)
+    return xr.DataArray(means, dims=(lat, lon), coords={lat: lat_values, lon: lon_values}, name=data.name, attrs=data.attrs)
+
+
+def raster_image(data, factors=(1, 1), lon="lon", lat="lat"):
+    """
+    Values and extent of a regular field for imshow(origin="lower"), block-mean
+    coarsened by ``factors``; the extent covers whole blocks, so cells keep
+    their exact position.
+
+    Returns:
+    - (values, extent): masked 2D array and [left, right, bottom, top].
+    """
+    data = data.transpose(lat, lon).sortby(lat).sortby(lon)
+    dlat, dlon = abs(regular_step(data[lat])), abs(regular_step(data[lon]))
+    coarse = coarsen_blocks(data, factors, lon=lon, lat=lat)
+    left = float(data[lon][0]) - dlon / 2
+    bottom = float(data[lat][0]) - dlat / 2
+    extent = [left, left + coarse.sizes[lon] * factors[1] * dlon,
+              bottom, bottom + coarse.sizes[lat] * factors[0] * dlat]
+    return np.ma.masked_invalid(coarse.values), extent
+
+
+def plot_avg(data, ax, vscale=None, units="unit", shrink_cb=1,cmap="RdBu_r",grid=True, dpi=None):
     """
     Function to get plot map from 2d data
+
+    Regular lat/lon grids are drawn as one image, block-mean coarsened to
+    about one cell per output pixel (``dpi``, default the savefig dpi);
+    other grids go through pcolormesh.
     """
     
     
@@ -123,15 +220,23 @@ def plot_avg(data, ax, vscale=None, units="unit", shrink_cb=1,cmap="RdBu_r",grid
     lon,lat=check_lonlat(data)
     #print(lon,lat)
     #print(lon)
-    p = data.plot(ax=ax, x=lon, y=lat,
-                  vmin=vmin, vmax=vmax,
-                  cmap=cmap,
-                  #cmap="viridis",
-                  cbar_kwargs={'label': units,"shrink":shrink_cb},
-                  transform=ccrs.PlateCarree(),
-                  extend="both")
-    p.axes.coastlines(linewidth=1.5, color='k', alpha=0.5, linestyle='-')
-    gl = p.axes.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+    if RASTER_REGULAR_GRIDS and regular_step(data[lon]) is not None and regular_step(data[lat]) is not None:
+        values, extent = raster_image(data, raster_factors(data.transpose(lat, lon).shape, ax, dpi), lon=lon, lat=lat)
+        image = ax.imshow(values, extent=extent, origin="lower", cmap=cmap, vmin=vmin, vmax=vmax, interpolation="nearest",
+                          transform=ccrs.PlateCarree())
+        ax.figure.colorbar(image, ax=ax, label=units, shrink=shrink_cb, extend="both")
+        axes = ax
+    else:
+        p = data.plot(ax=ax, x=lon, y=lat,
+                      vmin=vmin, vmax=vmax,
+                      cmap=cmap,
+                      #cmap="viridis",
+                      cbar_kwargs={'label': units,"shrink":shrink_cb},
+                      transform=ccrs.PlateCarree(),
+                      extend="both")
+        axes = p.axes
+    axes.coastlines(linewidth=1.5, color='k', alpha=0.5, linestyle='-')
+    gl = axes.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
                             linewidth=0.9, color='gray', alpha=0.5, linestyle='--')
     gl.xlabels_top = False
     gl.ylabels_right = False
@@ -201,14 +306,17 @@ def scale_dif(var):
 
     
 def single_map(data1, model_name='model', experiment='experiment', year='year',month=None, var1_name='var1_name',
-               units="units",dataset1="CICA",vscale_name=None):
+               units="units",dataset1="CICA",vscale_name=None,vscale=None):
     """
     Function to plot in a figure a map for a var: cds data, atlas data and cds - atlas
+
+    ``vscale`` (e.g. global limits of color_scale) is used when scale_abs has
+    no entry for vscale_name; otherwise the scale of data1.
     """  
     print(f"var1 {var1_name}  mean('CICA) {experiment} [ model:{model_name};year{year}")
     if vscale_name==None:
         vscale_name=var1_name
-    vscale=scale_abs(vscale_name)
+    vscale=scale_abs(vscale_name) or vscale
     #print(data1,data2)
     if vscale==None:
             vscale=load_scale(data1)
@@ -234,21 +342,30 @@ def single_map(data1, model_name='model', experiment='experiment', year='year',m
 
 
 
+def common_scale(data1, data2):
+    """load_scale of the field with the largest absolute value, each field scanned once."""
+    range1, range2 = value_range(data1), value_range(data2)
+    if abs_max(data1, range1) >= abs_max(data2, range2):
+        return load_scale(data1, range1)
+    return load_scale(data2, range2)
+
+
 def triple_map(data1, data2, model_name='model', experiment='experiment', year='year',month=None, var1_name='var1_name',
-               var2_name='var2_name',units="units",dataset1="CICA",dataset2="v1_dataset",vscale_name=None,diff=False):
+               var2_name='var2_name',units="units",dataset1="CICA",dataset2="v1_dataset",vscale_name=None,diff=False,
+               vscale=None):
     """
     Function to plot in a figure 3 maps for a var: cds data, atlas data and cds - atlas
+
+    ``vscale`` (e.g. global limits of color_scale) is used for the first two
+    maps when scale_abs has no entry for vscale_name.
     """  
     print(f"var1 {var1_name} var2 {var2_name} mean('CICA) {experiment} [ model:{model_name};year{year}")
     if vscale_name==None:
         vscale_name=var1_name
-    vscale=scale_abs(vscale_name)
+    vscale=scale_abs(vscale_name) or vscale
     #print(data1,data2)
     if vscale==None:
-        if abs_max(data1) >= abs_max(data2):
-            vscale=load_scale(data1)
-        else:
-            vscale=load_scale(data2)
+        vscale=common_scale(data1, data2)
     print(var1_name,var2_name)
     if month == None:
         period = year
@@ -282,7 +399,8 @@ def triple_map(data1, data2, model_name='model', experiment='experiment', year='
 
     return fig
 
-def check_title(var1_name, var2_name,dataset1,dataset2,model_name,experiment,period,step=1):
+def title_text(var1_name, var2_name,dataset1,dataset2,model_name,experiment,period,step=1):
+    """Title of the panel ``step`` (1, 2 or 3 for the difference) of a map figure."""
     if dataset1=="original:no BA":
         if step==1:
             title=(f"{var1_name} mean('{dataset1}') difference for periods: {period} [ model:{model_name};experiment:{experiment}]")
@@ -297,7 +415,8 @@ def check_title(var1_name, var2_name,dataset1,dataset2,model_name,experiment,per
             title=(f"{var2_name} mean('{dataset2}') [ model:{model_name};period:{period};experiment:{experiment}]")
         if step==3:
             title=(f"Diff ({dataset1}) - ({dataset2})') [ model:{model_name};period:{period};experiment:{experiment}]")
+    return title
 
-        
-    plt.title(title)
 
+def check_title(var1_name, var2_name,dataset1,dataset2,model_name,experiment,period,step=1):
+    plt.title(title_text(var1_name, var2_name,dataset1,dataset2,model_name,experiment,period,step=step))
@@ -0,0 +1,548 @@
+"""
+Independent plot tasks of a validation YAML configuration.
+
+``expand_tasks`` turns the configuration into one task per output figure (or
+per group of figures sharing their input data, for timeseries), and
+``render_task`` renders one task. Tasks do not share state, so
+``generate_plots.py`` can run them in a process pool and skip the ones whose
+PNG files already exist.
+"""
+
+import gc
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+import maps
+from load_files import load_root_directories, load_files_year, load_files, load_parameters, load_datasets, check_varin
+from timeseries import plot_timeseries, select_data_point
+from climatology import calculate_climatology_for_period, ClimatologyCache, CACHE_DIR
+from regrid import get_regridder
+from spatial_mean import spatial_mean_series, series_year
+from map_renderer import save_single_map, save_triple_map
+from color_scale import ScaleAccumulator, scale_key, merge_limits, scale_from_limits, load_color_scales
+
+# The dataset catalog lives at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from catalog import DatasetCatalog
+
+
+SAVE_DIR = "/gpfs/users/garciar/work/Validations/results/{project}/"
+ROOT_PROJECTS = ["CERRA-land", "CERRA"]
+
+
+@dataclass
+class PlotTask:
+    """One unit of rendering work and the PNG files it writes."""
+    kind: str
+    outputs: List[str]
+    domain: Optional[str] = None
+    year: Optional[int] = None
+    v1: Optional[str] = None
+    v2: Optional[str] = None
+    v1_list: Tuple[str, ...] = field(default_factory=tuple)
+    dataset: Optional[str] = None
+    version: Optional[str] = None
+    first_year: bool = False
+
+    def done(self):
+        return all(os.path.exists(output) for output in self.outputs)
+
+    def __str__(self):
+        details = [str(value) for value in (self.domain, self.version, self.dataset, self.v1, self.year) if value is not None]
+        return f"{self.kind}({', '.join(details)})"
+
+
+def load_settings(config):
+    """
+    Read the ``globals`` and ``datasets`` sections of a validation configuration.
+
+    Parameters:
+    - config: dict, the parsed YAML configuration.
+
+    Returns:
+    - settings: dict, plain values (picklable, shared by all the tasks).
+    """
+    globals_cfg = config['globals']
+    settings = {
+        "step": globals_cfg['step'],
+        "unit": globals_cfg['unit'],
+        "project": globals_cfg['project'],
+        "domain_list": globals_cfg['domain_list'],
+        "experiment": globals_cfg['experiment'],
+        "model": globals_cfg['model'],
+        "datasets": config['datasets'],
+        "catalog": globals_cfg.get('catalog'),
+        "version_list": globals_cfg.get('version_list', []),
+        "lon_point": globals_cfg.get('lon_point', -3.8),
+        "lat_point": globals_cfg.get('lat_point', 40.4),
+        "regrid_method": globals_cfg.get('regrid_method', 'bilinear'),
+        "regrid_weights_dir": globals_cfg.get('regrid_weights_dir'),
+        "reuse_figures": globals_cfg.get('reuse_figures', True),
+    }
+    settings["save_dir"] = globals_cfg.get('save_dir', SAVE_DIR.format(project=settings["project"]))
+    # Global colour scales of the maps (generate_plots.py --color-scales), used when scale_abs has no entry
+    settings["color_scales"] = globals_cfg.get('color_scales', os.path.join(settings["save_dir"], "color_scales.json"))
+    settings["robust_scales"] = globals_cfg.get('robust_scales', True)
+
+    # Support for year ranges, with backward compatibility with a single year
+    if 'start_year' in globals_cfg and 'end_year' in globals_cfg:
+        settings["year_list"] = list(range(globals_cfg['start_year'], globals_cfg['end_year'] + 1))
+    else:
+        settings["year_list"] = [globals_cfg['year']]
+
+    # Support for multiple plot types
+    type_of_plot = globals_cfg.get('type_of_plot', 'triple_map')
+    settings["plot_types"] = [type_of_plot] if isinstance(type_of_plot, str) else list(type_of_plot)
+
+    climatology_cfg = globals_cfg.get('climatology') or {}
+    settings["clim_ref_start"] = climatology_cfg.get('reference_period_start')
+    settings["clim_ref_end"] = climatology_cfg.get('reference_period_end')
+    settings["clim_workers"] = climatology_cfg.get('workers', 1)
+    settings["clim_cache_dir"] = climatology_cfg.get('cache_dir', CACHE_DIR)
+    settings["clim_cache_max_gb"] = climatology_cfg.get('cache_max_gb', 20)
+    if 'climatology' in settings["plot_types"] and (settings["clim_ref_start"] is None or settings["clim_ref_end"] is None):
+        raise ValueError("'climatology' in type_of_plot but reference period not specified in YML under 'climatology'")
+
+    for plot_type in settings["plot_types"]:
+        if plot_type not in RENDERERS:
+            raise ValueError(f"Tipo de plot '{plot_type}' no implementado.")
+    return settings
+
+
+def _dataset_list(settings):
+    return [ds['name'] for ds in settings["datasets"]]
+
+
+def _plot_varin(dataset_list, varin):
+    """Variable name used in the timeseries file names (after check_varin for every dataset)."""
+    for dataset in dataset_list:
+        varin = check_varin(dataset, varin)
+    return varin
+
+
+def expand_tasks(settings):
+    """
+    Expand the configuration into independent plot tasks.
+
+    Tasks writing the same files (e.g. the same variable listed by several
+    datasets) are only kept once.
+
+    Returns:
+    - tasks: list of PlotTask, in the order of the original serial loops.
+    """
+    s = settings
+    save_dir = s["save_dir"]
+    step, model, experiment = s["step"], s["model"], s["experiment"]
+    dataset_list = _dataset_list(s)
+    tasks = []
+
+    if 'climatology' in s["plot_types"]:
+        period = f"{s['clim_ref_start']}-{s['clim_ref_end']}"
+        ds_cfg_ref = s["datasets"][0]
+        for domain in s["domain_list"]:
+            for v1 in ds_cfg_ref['v1_list']:
+                output = f'{save_dir}/{step}_{domain}_{dataset_list[0]}_{v1}_{model}_{experiment}_climatology_{period}_single.png'
+                tasks.append(PlotTask("climatology", [output], domain=domain, v1=v1))
+
+    for year in s["year_list"]:
+        for plot_type in s["plot_types"]:
+            if plot_type in ['triple_map', 'single_map']:
+                for domain in s["domain_list"]:
+                    for ds in s["datasets"]:
+                        v1_list = tuple(ds['v1_list'])
+                        for v1, v2 in zip(ds['v1_list'], ds['v2_list']):
+                            if plot_type == 'triple_map':
+                                output = f'{save_dir}/{step}_{domain}_{v1}_{model}_{experiment}_{year}_triple.png'
+                                tasks.append(PlotTask("triple_map", [output], domain=domain, year=year,
+                                                      v1=v1, v2=v2, v1_list=v1_list))
+                            else:
+                                for dataset_name in dataset_list:
+                                    output = f'{save_dir}/{step}_{domain}_{dataset_name}_{v1}_{model}_{experiment}_{year}_single.png'
+                                    tasks.append(PlotTask("single_map", [output], domain=domain, year=year,
+                                                          v1=v1, v1_list=v1_list, dataset=dataset_name))
+            elif plot_type == 'timeseries':
+                lon_p, lat_p = s["lon_point"], s["lat_point"]
+                first_year = year == s["year_list"][0]
+                for version in s["version_list"]:
+                    params = load_parameters(version)
+                    outputs = []
+                    for varin in params["var_list"]:
+                        varin = _plot_varin(params["dataset_list"], varin)
+                        if first_year:
+                            outputs.append(f"{save_dir}/timeseries_{varin}_dataset_comparison_lon{lon_p}_lat{lat_p}_{varin}_{version}.png")
+                        outputs.append(f"{save_dir}/timeseries_{varin}_dataset_comparison_lon{lon_p}_lat{lat_p}_{varin}_{year}_{version}.png")
+                        outputs.append(f"{save_dir}/timeseries_{varin}_dataset_comparison_lonlatmean_{year}_{version}.png")
+                    tasks.append(PlotTask("timeseries", outputs, year=year, version=version, first_year=first_year))
+
+    unique = {}
+    for task in tasks:
+        unique.setdefault(tuple(task.outputs), task)
+    return list(unique.values())
+
+
+# Per-process state: one catalog connection and the files of every year, searched
+# once per domain and variable list and then filtered per year by time coverage
+_catalog = None
+_year_file_dicts = {}
+
+
+def _get_catalog(settings):
+    global _catalog
+    if settings["catalog"] and _catalog is None:
+        _catalog = DatasetCatalog(settings["catalog"])
+    return _catalog
+
+
+def _year_path_dict(settings, domain, v1_list, year):
+    dataset_list = _dataset_list(settings)
+    root_dict = load_root_directories(dataset_list, domain, ROOT_PROJECTS)
+    key = (domain, v1_list)
+    if key not in _year_file_dicts:
+        _year_file_dicts[key] = load_files(root_dict, dataset_list, list(v1_list), settings["model"],
+                                           settings["experiment"], domain, catalog=_get_catalog(settings))
+    return load_files_year(root_dict, dataset_list, list(v1_list), settings["model"], settings["experiment"],
+                           domain, year, file_dict=_year_file_dicts[key])
+
+
+def scale_fields(tasks, settings):
+    """
+    Fields read by the map tasks, grouped by colour scale.
+
+    Returns:
+    - dict, {(domain, dataset, variable): [(year, v1_list), ...]}.
+    """
+    dataset_list = _dataset_list(settings)
+    fields = {}
+    for task in tasks:
+        if task.kind == "triple_map":
+            pairs = [(dataset_list[0], task.v1), (dataset_list[1], task.v2)]
+        elif task.kind == "single_map":
+            pairs = [(task.dataset, task.v1)]
+        else:
+            continue
+        for dataset, variable in pairs:
+            year_fields = fields.setdefault((task.domain, dataset, variable), [])
+            if (task.year, task.v1_list) not in year_fields:
+                year_fields.append((task.year, task.v1_list))
+    return fields
+
+
+def task_fields(task, settings):
+    """Yearly means (variable, year, path) read by a map task, [] for the other plot types."""
+    dataset_list = _dataset_list(settings)
+    if task.kind == "triple_map":
+        pairs = [(dataset_list[0], task.v1), (dataset_list[1], task.v2)]
+    elif task.kind == "single_map":
+        pairs = [(task.dataset, task.v1)]
+    else:
+        return []
+    path_dict = _year_path_dict(settings, task.domain, task.v1_list, task.year)
+    return [(variable, task.year, path_dict[dataset][variable][0]) for dataset, variable in pairs]
+
+
+def field_keys(tasks, settings):
+    """
+    Yearly means (variable, year, path) read by a group of tasks (e.g. the map tasks of one year).
+
+    Run in the main thread: the paths come from the catalog and the per-process
+    file dicts, which are not shared with the reader thread of a Prefetcher.
+    Tasks whose files cannot be resolved are left out; they report the error
+    when rendered.
+    """
+    keys = []
+    for task in tasks:
+        try:
+            keys.extend(key for key in task_fields(task, settings) if key not in keys)
+        except Exception:
+            continue
+    return keys
+
+
+def read_fields(keys):
+    """
+    Read yearly means ahead of their rendering (in the reader thread of a Prefetcher).
+
+    Fields that cannot be read are left out; their task reads them again
+    and reports the error.
+
+    Returns:
+    - fields: dict, {(variable, year, path): (ds_mean, units)}.
+    """
+    fields = {}
+    for key in keys:
+        try:
+            fields[key] = maps.load_cds(*key)
+        except Exception:
+            continue
+    return fields
+
+
+def scan_fields(key, year_fields, settings):
+    """
+    Read every yearly field of a (domain, dataset, variable) once into a ScaleAccumulator.
+
+    Returns:
+    - (key, limits): key of color_scale.scale_key and the limits of the fields.
+    """
+    domain, dataset, variable = key
+    accumulator = ScaleAccumulator()
+    for year, v1_list in year_fields:
+        path_dict = _year_path_dict(settings, domain, v1_list, year)
+        ds_mean, _ = maps.load_cds(variable, year, path_dict[dataset][variable][0])
+        accumulator.add(ds_mean.values)
+    maps.close_cached()
+    return scale_key(domain, dataset, variable), accumulator.limits()
+
+
+_color_scales = None
+
+
+def _task_vscale(settings, domain, *pairs):
+    """Global [vmin, vmax] of the (dataset, variable) pairs of a map, None without pre-pass limits."""
+    global _color_scales
+    if _color_scales is None:
+        _color_scales = load_color_scales(settings["color_scales"])
+    limits = merge_limits(*[_color_scales.get(scale_key(domain, dataset, variable)) for dataset, variable in pairs])
+    return scale_from_limits(limits, robust=settings["robust_scales"])
+
+
+# Yearly means read ahead by generate_plots.py (read_fields in a Prefetcher), for the task being rendered
+_fields = {}
+
+
+def _load_cds(variable, year, path):
+    """maps.load_cds, unless the field was prefetched."""
+    if (variable, year, path) in _fields:
+        return _fields[(variable, year, path)]
+    return maps.load_cds(variable, year, path)
+
+
+def _reuse_figure(settings, data):
+    """Whether the map of ``data`` is drawn with a reused map_renderer figure (1D lat/lon grids only)."""
+    lon, lat = maps.check_lonlat(data)
+    return settings["reuse_figures"] and data[lat].ndim == 1 and data[lon].ndim == 1
+
+
+def render_climatology(task, settings):
+    s = settings
+    dataset_list = _dataset_list(s)
+    root_dict = load_root_directories(dataset_list, task.domain, ROOT_PROJECTS)
+    path_dict_all = load_files(root_dict, dataset_list, [task.v1], s["model"], s["experiment"], task.domain,
+                               catalog=_get_catalog(s))
+    print(f"    Computing climatology for {dataset_list[0]} - {task.v1}")
+    clim1, unit = calculate_climatology_for_period(
+        path_dict_all[dataset_list[0]][task.v1],
+        task.v1,
+        f"{s['clim_ref_start']}-01-01",
+        f"{s['clim_ref_end']}-12-31",
+        workers=s["clim_workers"],
+        dataset=dataset_list[0],
+        cache=ClimatologyCache(s["clim_cache_dir"], s["clim_cache_max_gb"]) if s["clim_cache_dir"] else None
+    )
+    map_args = dict(
+        data1=clim1,
+        model_name=s["model"],
+        experiment=s["experiment"],
+        year=f"Climatology {s['clim_ref_start']}-{s['clim_ref_end']}",
+        var1_name=task.v1,
+        units=unit,
+        dataset1=dataset_list[0],
+        vscale_name=f'{task.v1}_{s["project"]}'
+    )
+    if _reuse_figure(s, clim1):
+        save_single_map(task.outputs[0], **map_args)
+        return
+    fig = maps.single_map(**map_args)
+    plt.savefig(task.outputs[0], bbox_inches='tight')
+    plt.close(fig)
+
+
+def render_triple_map(task, settings):
+    s = settings
+    dataset_list = _dataset_list(s)
+    path_dict = _year_path_dict(s, task.domain, task.v1_list, task.year)
+    path1 = path_dict[dataset_list[0]][task.v1][0]
+    path2 = path_dict[dataset_list[1]][task.v2][0]
+
+    ds_mean1, unit = _load_cds(task.v1, task.year, path1)
+    ds_mean2, unit = _load_cds(task.v2, task.year, path2)
+    # Same result as ds_mean2.interp(lat=ds_mean1.lat, lon=ds_mean1.lon, method="linear"),
+    # with the weights computed once per pair of grids
+    regridder = get_regridder(ds_mean2, ds_mean1, method=s["regrid_method"], cache_dir=s["regrid_weights_dir"])
+    ds_mean2 = regridder.regrid(ds_mean2)
+
+    map_args = dict(
+        data1=ds_mean1,
+        data2=ds_mean2,
+        model_name=s["model"],
+        experiment=s["experiment"],
+        year=task.year,
+        var1_name=task.v1,
+        var2_name=task.v2,
+        units=unit,
+        dataset1=f"FAO-{s['step']}",
+        dataset2=f"CICA-{s['step']}",
+        diff=True,
+        vscale_name=f"{task.v1}_{s['project']}",
+        vscale=_task_vscale(s, task.domain, (dataset_list[0], task.v1), (dataset_list[1], task.v2))
+    )
+    if _reuse_figure(s, ds_mean1):
+        save_triple_map(task.outputs[0], **map_args)
+        return
+    fig = maps.triple_map(**map_args)
+    plt.savefig(task.outputs[0], bbox_inches='tight')
+    plt.close(fig)
+
+
+def render_single_map(task, settings):
+    s = settings
+    path_dict = _year_path_dict(s, task.domain, task.v1_list, task.year)
+    path = path_dict[task.dataset][task.v1][0]
+    ds_mean, unit = _load_cds(task.v1, task.year, path)
+
+    map_args = dict(
+        data1=ds_mean,
+        model_name=s["model"],
+        experiment=s["experiment"],
+        year=task.year,
+        var1_name=task.v1,
+        units=unit,
+        dataset1=task.dataset,
+        vscale_name=f'{task.v1}_{s["project"]}',
+        vscale=_task_vscale(s, task.domain, (task.dataset, task.v1))
+    )
+    if _reuse_figure(s, ds_mean):
+        save_single_map(task.outputs[0], **map_args)
+        return
+    fig = maps.single_map(**map_args)
+    plt.savefig(task.outputs[0], bbox_inches='tight')
+    plt.close(fig)
+
+
+def render_timeseries(task, settings):
+    s = settings
+    version, year = task.version, task.year
+    lon_p, lat_p = s["lon_point"], s["lat_point"]
+    save_dir = s["save_dir"]
+
+    params = load_parameters(version)
+    root_dict = load_root_directories(params['dataset_list'], params['domain'], params['project_list'])
+    file_dict = load_files(root_dict, params['dataset_list'], params['var_list'], params['model'],
+                           params['experiment'], params['domain'], catalog=_get_catalog(s))
+
+    has_files = any(
+        file_dict.get(dataset, {}).get(check_varin(dataset, var)) is not None
+        and len(file_dict[dataset][check_varin(dataset, var)]) > 0
+        for dataset in params['dataset_list'] for var in params['var_list']
+    )
+    if not has_files:
+        print(f"\n⚠️  WARNING: No files found for version '{version}'")
+        print(f"    Datasets: {params['dataset_list']}")
+        print(f"    Variables: {params['var_list']}")
+        print(f"    Domain: {params['domain']}")
+        print(f"    Skipping timeseries for this version...\n")
+        return
+
+    ds_dict = load_datasets(file_dict, params['dataset_list'], params['var_list'])
+    if not ds_dict or "ds" not in ds_dict or not ds_dict["ds"]:
+        print(f"\n⚠️  WARNING: No datasets loaded for version '{version}'")
+        print(f"    Skipping timeseries for this version...\n")
+        return
+
+    dataset_list = params["dataset_list"]
+    var_list = params["var_list"]
+
+    # Dynamic lon/lat axes
+    if "CORDEX-CORE" in dataset_list[0] and version == "pre":
+        lon, lat = "x", "y"
+    else:
+        lon, lat = "lon", "lat"
+
+    # Select the point
+    ds_dict["ds_point"] = {}
+    for dataset in dataset_list:
+        if dataset in ds_dict["ds"]:
+            ds_dict["ds_point"][dataset] = select_data_point(ds_dict["ds"][dataset], dataset, lon_p, lat_p)
+        else:
+            print(f"⚠️  WARNING: Dataset '{dataset}' not loaded, skipping point selection")
+
+    # Only for the first year, full timeseries comparing the datasets
+    if task.first_year:
+        for varin in var_list:
+            data_list = []
+            for dataset in dataset_list:
+                varin = check_varin(dataset, varin)
+                data_list.append(ds_dict["ds_point"][dataset][varin])
+            title = f"timeseries {varin} dataset comparison for model:{params['model']}, experiment:{params['experiment']}, lon:{lon_p}, lat:{lat_p}"
+            save_file = f"{save_dir}/timeseries_{varin}_dataset_comparison_lon{lon_p}_lat{lat_p}_{varin}_{version}.png"
+            plot_timeseries(data_list, varin, dataset_list, title, save_file)
+
+    # Yearly subset
+    period = slice(f"{year}-01-01", f"{year}-12-31")
+    ds_year = {
+        "ds_point": {dataset: ds_dict["ds_point"][dataset].sel(time=period) for dataset in dataset_list},
+    }
+
+    # Yearly timeseries at the point
+    for varin in var_list:
+        data_list = []
+        for dataset in dataset_list:
+            varin = check_varin(dataset, varin)
+            data_list.append(ds_year["ds_point"][dataset][varin])
+        title = f"timeseries {varin} dataset comparison for lon:{lon_p}, lat:{lat_p}, year:{year}"
+        save_file = f"{save_dir}/timeseries_{varin}_dataset_comparison_lon{lon_p}_lat{lat_p}_{varin}_{year}_{version}.png"
+        plot_timeseries(data_list, varin, dataset_list, title, save_file)
+
+    # Yearly timeseries of the lon-lat mean, sliced from the cached cos(lat)-weighted series
+    for varin in var_list:
+        data_list = []
+        for dataset in dataset_list:
+            varin = check_varin(dataset, varin)
+            daily, _ = spatial_mean_series(file_dict[dataset][varin], varin, dataset=dataset, domain=params['domain'],
+                                           lat=lat, lon=lon, workers=1)
+            # As an xarray series, plotted as the point series (cftime calendars included)
+            data_list.append(series_year(daily, year).to_xarray())
+        title = f"timeseries {varin} dataset daily comparison for lonlatmean, year:{year}"
+        save_file = f"{save_dir}/timeseries_{varin}_dataset_comparison_lonlatmean_{year}_{version}.png"
+        plot_timeseries(data_list, varin, dataset_list, title, save_file)
+
+
+RENDERERS = {
+    "climatology": render_climatology,
+    "triple_map": render_triple_map,
+    "single_map": render_single_map,
+    "timeseries": render_timeseries,
+}
+
+
+def render_task(task, settings, fields=None):
+    """
+    Render one task, catching its errors so that the other tasks carry on.
+
+    Parameters:
+    - fields: optional dict of prefetched yearly means (read_fields).
+
+    Returns:
+    - (task, error): error is None on success, otherwise a short description.
+    """
+    os.makedirs(settings["save_dir"], exist_ok=True)
+    global _fields
+    _fields = fields or {}
+    error = None
+    try:
+        RENDERERS[task.kind](task, settings)
+    except MemoryError:
+        error = "MemoryError (per-worker memory cap reached)"
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    finally:
+        _fields = {}
+        plt.close('all')
+        gc.collect()
+    return task, error
@@ -0,0 +1,223 @@
+"""
+Extraction of time series at many points (stations) from lists of files.
+
+The nearest grid cell of every point is computed once per grid and only the
+rows and columns holding those cells are read from each file, in blocks of
+time steps, with a thread pool over files. Points outside the grid (farther
+than about one grid spacing from its cells) are left out with a warning. The
+result is a tidy table with one row per (point, time, variable, dataset).
+
+Each file is opened and decoded once for all the points, but the data read is
+the box of every row and column holding a point: up to len(points)**2 cells
+per time step for scattered points (and, for chunked files, every chunk this
+box intersects), against a single cell per time step for one point.
+
+Usage:
+    python point_extraction.py stations.csv CERRA_test_finals --output stations_CERRA.csv --workers 8
+
+Points files are CSV (columns ``name``, ``lon``, ``lat``) or YAML (a list of
+``{name, lon, lat}`` or a mapping ``name: {lon, lat}``).
+"""
+
+import argparse
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from grid_index import get_grid_index, grid_spacing_km
+from load_files import load_root_directories, load_files, load_parameters, check_varin
+
+
+# Time steps read at once from a file
+TIME_BLOCK = 366
+LON_NAMES = ["lon", "longitude", "x"]
+LAT_NAMES = ["lat", "latitude", "y"]
+
+
+def load_points(path):
+    """
+    Read a points file into a DataFrame with columns name, lon, lat.
+    """
+    if path.endswith((".yml", ".yaml")):
+        with open(path) as f:
+            content = yaml.safe_load(f)
+        if isinstance(content, dict):
+            content = [{"name": name, **coords} for name, coords in content.items()]
+        points = pd.DataFrame(content)
+    else:
+        points = pd.read_csv(path)
+    points = points.rename(columns={"longitude": "lon", "latitude": "lat", "id": "name", "station": "name"})
+    if "name" not in points:
+        points["name"] = [f"point_{i}" for i in range(len(points))]
+    missing = {"lon", "lat"} - set(points.columns)
+    if missing:
+        raise ValueError(f"Points file {path} has no {sorted(missing)} column(s).")
+    return points[["name", "lon", "lat"]].reset_index(drop=True)
+
+
+def _coordinate_name(ds, names):
+    for name in names:
+        if name in ds.coords or name in ds.variables:
+            return name
+    raise ValueError(f"No coordinate among {names} in the dataset.")
+
+
+def _nearest_1d(coord, values):
+    """Index of the nearest element of a monotonic 1D coordinate for each value."""
+    coord = np.asarray(coord, dtype="float64")
+    order = np.argsort(coord)
+    sorted_coord = coord[order]
+    right = np.clip(np.searchsorted(sorted_coord, values), 1, len(coord) - 1)
+    left = right - 1
+    nearest = np.where(np.abs(values - sorted_coord[left]) <= np.abs(values - sorted_coord[right]), left, right)
+    return order[nearest]
+
+
+def _inside_1d(coord, values):
+    """Whether each value lies on a 1D coordinate, extended by half a spacing at both ends."""
+    coord = np.asarray(coord, dtype="float64")
+    half = np.abs(np.diff(coord)).max() / 2 if len(coord) > 1 else 0.0
+    return (values >= np.nanmin(coord) - half) & (values <= np.nanmax(coord) + half)
+
+
+def _wrap_lon(lon, grid_lon):
+    """Express point longitudes in the convention of the grid (-180..180 or 0..360)."""
+    lon = np.asarray(lon, dtype="float64")
+    if np.nanmax(grid_lon) > 180:
+        return lon % 360
+    return (lon + 180) % 360 - 180
+
+
+_grid_indices = {}
+
+
+def grid_indices(ds, points):
+    """
+    Nearest cell of every point on the grid of ``ds``, computed once per grid.
+
+    Points outside the grid get index -1 (and a warning): on a 1D grid those
+    beyond half a grid spacing from its first or last coordinate, on a 2D grid
+    those farther than one grid spacing from the nearest cell.
+
+    Returns:
+    - (dims, iy, ix): the two spatial dimensions and the index arrays of the points.
+    """
+    lat_name, lon_name = _coordinate_name(ds, LAT_NAMES), _coordinate_name(ds, LON_NAMES)
+    lat, lon = ds[lat_name].values, ds[lon_name].values
+    digest = hashlib.sha256(lat.tobytes() + lon.tobytes() + points[["lon", "lat"]].values.tobytes())
+    key = digest.hexdigest()
+    if key not in _grid_indices:
+        if lat.ndim == 1:
+            point_lon = _wrap_lon(points["lon"].values, lon)
+            iy = _nearest_1d(lat, points["lat"].values)
+            ix = _nearest_1d(lon, point_lon)
+            # A global grid wraps around: every longitude is on it
+            global_lon = np.abs(np.diff(lon)).max() + np.ptp(lon) >= 360
+            inside = _inside_1d(lat, points["lat"].values) & (global_lon | _inside_1d(lon, point_lon))
+            iy, ix = np.where(inside, iy, -1), np.where(inside, ix, -1)
+            dims = (ds[lat_name].dims[0], ds[lon_name].dims[0])
+        else:
+            # Curvilinear/rotated grid: KD-tree on the 2D coordinates
+            index = get_grid_index(ds, lat=lat_name, lon=lon_name)
+            dims = index.dims
+            iy, ix = index.query(points["lon"].values, points["lat"].values,
+                                 max_distance_km=grid_spacing_km(lat, lon))
+        outside = points["name"].values[iy < 0]
+        if len(outside):
+            print(f"Warning: {len(outside)} point(s) outside the grid left out: {', '.join(map(str, outside))}")
+        _grid_indices[key] = (dims, iy, ix)
+    return _grid_indices[key]
+
+
+def extract_file(path, variable, points):
+    """
+    Values of ``variable`` at the points for every time step of one file.
+
+    Only the rows and columns holding the points are read (orthogonal
+    indexing), one block of TIME_BLOCK time steps at a time: a box of
+    len(rows) x len(cols) cells per time step. Points outside the grid are
+    left out.
+
+    Returns:
+    - DataFrame with columns point, time, variable, value.
+    """
+    with xr.open_dataset(path) as ds:
+        (ydim, xdim), iy, ix = grid_indices(ds, points)
+        inside = iy >= 0
+        names, iy, ix = points["name"].values[inside], iy[inside], ix[inside]
+        rows, row_pos = np.unique(iy, return_inverse=True)
+        cols, col_pos = np.unique(ix, return_inverse=True)
+        da = ds[variable].isel({ydim: rows, xdim: cols}).transpose("time", ydim, xdim)
+        times, values = [], []
+        for start in range(0, da.sizes["time"], TIME_BLOCK):
+            block = da.isel(time=slice(start, start + TIME_BLOCK))
+            data = block.values
+            values.append(data[:, row_pos, col_pos])
+            times.append(block["time"].values)
+    times = np.concatenate(times)
+    values = np.concatenate(values)
+    return pd.DataFrame({
+        "point": np.tile(names, len(times)),
+        "time": np.repeat(times, len(names)),
+        "variable": variable,
+        "value": values.ravel(),
+    })
+
+
+def extract_points(file_dict, points, workers=8):
+    """
+    Extract the points from every dataset and variable of a file dictionary.
+
+    Parameters:
+    - file_dict: dict, {dataset: {variable: [files]}} as returned by load_files.
+    - points: DataFrame, as returned by load_points.
+    - workers: int, threads reading files.
+
+    Returns:
+    - DataFrame with columns point, time, variable, dataset, value.
+    """
+    jobs = [(dataset, variable, path)
+            for dataset, variables in file_dict.items()
+            for variable, files in variables.items()
+            for path in files]
+    if not jobs:
+        return pd.DataFrame(columns=["point", "time", "variable", "dataset", "value"])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tables = list(executor.map(lambda job: extract_file(job[2], job[1], points).assign(dataset=job[0]), jobs))
+    table = pd.concat(tables, ignore_index=True)
+    return table[["point", "time", "variable", "dataset", "value"]].sort_values(
+        ["dataset", "variable", "point", "time"], ignore_index=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract point time series from the files of a validation version")
+    parser.add_argument("points", help="Points file (CSV or YAML) with name, lon, lat")
+    parser.add_argument("version", help="Version of load_files.load_parameters (datasets, variables, domain)")
+    parser.add_argument("--output", default=None, help="Output CSV (default: <points>_<version>.csv)")
+    parser.add_argument("--workers", type=int, default=8, help="Threads reading files")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    points = load_points(args.points)
+    params = load_parameters(args.version)
+    root_dict = load_root_directories(params["dataset_list"], params["domain"], params["project_list"])
+    file_dict = load_files(root_dict, params["dataset_list"], params["var_list"], params["model"],
+                           params["experiment"], params["domain"])
+    file_dict = {dataset: {check_varin(dataset, var): file_dict[dataset][check_varin(dataset, var)]
+                           for var in params["var_list"]}
+                 for dataset in params["dataset_list"]}
+    table = extract_points(file_dict, points, workers=args.workers)
+    output = args.output or f"{os.path.splitext(args.points)[0]}_{args.version}.csv"
+    table.to_csv(output, index=False)
+    print(f"{len(points)} points, {len(table)} values written to {output}")
+
+
+if __name__ == "__main__":
+    main()
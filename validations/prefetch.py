@@ -0,0 +1,89 @@
+"""
+Background prefetching of the data of the next group of tasks (e.g. the next year).
+
+A serial validation run alternates reading (Lustre I/O, decoding, yearly
+means) and rendering (matplotlib, CPU), so the CPU idles during the reads and
+the disk during the rendering. A Prefetcher runs the loading function of the
+groups in a reader thread, one group ahead of the consumer: group N+1 is read
+and reduced while group N is rendered. At most ``depth + 1`` groups are held
+(the one being consumed and ``depth`` loaded or loading ahead), so memory
+stays bounded by two groups of data with the default depth of 1.
+
+The Prefetcher measures the time spent loading in the reader thread and the
+time the consumer waited for it; the difference is the loading time hidden
+behind the consumer (``overlap_seconds``).
+
+Usage:
+    from prefetch import Prefetcher
+
+    prefetcher = Prefetcher(year_groups, load=read_year)
+    for group, data in prefetcher:
+        render(group, data)
+    print(prefetcher.report())
+"""
+
+import queue
+import threading
+import time
+
+
+class Prefetcher:
+    """
+    Iterate over (group, load(group)), loading the next groups in a background thread.
+
+    Parameters:
+    - groups: list of the groups to load, in the order they are consumed.
+    - load: function of a group returning its data (run in the reader thread).
+    - depth: number of groups loaded ahead of the one being consumed.
+    """
+
+    def __init__(self, groups, load, depth=1):
+        self.groups = list(groups)
+        self.load = load
+        self.depth = depth
+        self.load_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _reader(self, loaded, slots, stop):
+        for group in self.groups:
+            slots.acquire()
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                item = (group, self.load(group), None)
+            except Exception as exc:
+                item = (group, None, exc)
+            self.load_seconds += time.perf_counter() - start
+            loaded.put(item)
+
+    def __iter__(self):
+        loaded = queue.Queue(maxsize=self.depth)
+        # Groups held at once: the one being consumed and `depth` ahead
+        slots = threading.Semaphore(self.depth + 1)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._reader, args=(loaded, slots, stop), daemon=True)
+        reader.start()
+        try:
+            for _ in self.groups:
+                start = time.perf_counter()
+                group, data, error = loaded.get()
+                self.wait_seconds += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                yield group, data
+                del data
+                slots.release()
+        finally:
+            stop.set()
+            slots.release()
+
+    @property
+    def overlap_seconds(self):
+        """Loading time hidden behind the consumer."""
+        return max(self.load_seconds - self.wait_seconds, 0.0)
+
+    def report(self):
+        share = self.overlap_seconds / self.load_seconds if self.load_seconds else 0.0
+        return (f"Prefetch: {len(self.groups)} groups, {self.load_seconds:.1f} s loading, "
+                f"{self.wait_seconds:.1f} s waited, {self.overlap_seconds:.1f} s overlapped ({share:.0%})")
@@ -0,0 +1,307 @@
+"""
+Region means of many regions in one pass, with sparse fractional masks.
+
+The polygons of a region set (the GeoJSON files of ``REGION_MASKS``: AR6,
+EUCRA, european-countries, megacities...) are rasterised once per target grid
+into a sparse (regions x cells) matrix of the fraction of each cell inside
+each region. The matrix is kept in memory per process and cached on disk
+(``.npz``), so the means of all the regions of a set are one sparse matrix
+product per block of time steps, weighted by cos(lat) or cell area as
+``spatial_mean``.
+
+On rectilinear grids, the fraction is 1 for the cells whose box lies inside
+the region and 0 for the cells whose box does not intersect it; the cells
+crossed by the border (box intersecting the region without being inside it)
+get the share of ``supersample`` x ``supersample`` points inside the region.
+Grids with 2D (curvilinear) coordinates use the cell centres only. A region
+that no sample point or centre falls in (e.g. a city smaller than a cell)
+gets weight 1 in the cell holding its representative point (the nearest
+centre on 2D grids), so its mean is never empty.
+
+Usage:
+    from region_mask import load_region_mask, region_mean_series
+
+    mask = load_region_mask("AR6", ds)
+    means = mask.mean(ds["tas"])                      # (time, region)
+    europe = mask.combine(AR6_REGIONS["groups"])      # one row per group
+    table = region_mean_series(files, "tas", "AR6")   # DataFrame time x region
+"""
+
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import shapely
+import xarray as xr
+from shapely.geometry import shape
+
+from durations import decode_durations
+from grid_index import grid_key
+from spatial_mean import spatial_weights
+
+# The region sets are defined in the products parameters at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from products.parameters import REGION_MASKS
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cica-atlas-tools", "region_mask")
+NAME_PROPERTIES = ["Acronym", "acronym", "Abbrev", "abbrev", "name", "Name", "NAME"]
+TIME_BLOCK = 366
+
+
+def resolve_regions(regions):
+    """Path of the GeoJSON of a region set of REGION_MASKS, or ``regions`` itself if it is a path."""
+    if regions in REGION_MASKS:
+        return REGION_MASKS[regions]
+    if os.path.exists(regions):
+        return regions
+    raise ValueError(f"Unknown region set: {regions}. Supported sets: {list(REGION_MASKS)} or a GeoJSON path.")
+
+
+def read_regions(path, name_property=None):
+    """
+    Read the polygons of a GeoJSON file.
+
+    Returns:
+    - (names, geometries): region names (``name_property`` or the first of
+      NAME_PROPERTIES found in the properties) and shapely geometries.
+    """
+    with open(path) as f:
+        features = json.load(f)["features"]
+    names, geometries = [], []
+    for i, feature in enumerate(features):
+        properties = feature.get("properties") or {}
+        keys = [name_property] if name_property else NAME_PROPERTIES
+        name = next((properties[key] for key in keys if key in properties), f"region_{i}")
+        geometry = shape(feature["geometry"])
+        shapely.prepare(geometry)
+        names.append(str(name))
+        geometries.append(geometry)
+    return names, geometries
+
+
+def _wrap_lon(lon):
+    return (np.asarray(lon, dtype="float64") + 180) % 360 - 180
+
+
+def _cell_bounds(centers):
+    centers = np.asarray(centers, dtype="float64")
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - mid[0]], mid, [2 * centers[-1] - mid[-1]]])
+
+
+def _fractions_rectilinear(geometry, lat, lon, supersample):
+    """Flat cell indices and fractions of a region on a (lat, lon) grid."""
+    lat_bounds, lon_bounds = _cell_bounds(lat), _cell_bounds(lon)
+    minx, miny, maxx, maxy = geometry.bounds
+    lat_lo, lat_hi = np.minimum(lat_bounds[:-1], lat_bounds[1:]), np.maximum(lat_bounds[:-1], lat_bounds[1:])
+    rows = np.nonzero((lat_hi >= miny) & (lat_lo <= maxy))[0]
+    half_width = np.abs(np.diff(lon_bounds)) / 2
+    wrapped = _wrap_lon(lon)
+    cols = np.nonzero((wrapped + half_width >= minx) & (wrapped - half_width <= maxx))[0]
+    if rows.size == 0 or cols.size == 0:
+        return np.zeros(0, dtype="int64"), np.zeros(0)
+
+    # Boxes of the cells of the bounds window
+    iy, ix = np.meshgrid(rows, cols, indexing="ij")
+    iy, ix = iy.ravel(), ix.ravel()
+    boxes = shapely.box(wrapped[ix] - half_width[ix], lat_lo[iy], wrapped[ix] + half_width[ix], lat_hi[iy])
+    intersecting = shapely.intersects(geometry, boxes)
+    inside = intersecting & shapely.contains(geometry, boxes)
+    fractions = inside.astype("float64")
+
+    border = intersecting & ~inside
+    if border.any():
+        offsets = (np.arange(supersample) + 0.5) / supersample
+        by, bx = iy[border], ix[border]
+        sub_lat = lat_bounds[by, None, None] + offsets[None, :, None] * (lat_bounds[by + 1] - lat_bounds[by])[:, None, None]
+        sub_lon = lon_bounds[bx, None, None] + offsets[None, None, :] * (lon_bounds[bx + 1] - lon_bounds[bx])[:, None, None]
+        sub_lat, sub_lon = np.broadcast_arrays(sub_lat, sub_lon)
+        sub_inside = shapely.contains_xy(geometry, _wrap_lon(sub_lon.ravel()), sub_lat.ravel())
+        fractions[border] = sub_inside.reshape(len(by), -1).mean(axis=1)
+
+    if not fractions.any() and intersecting.any():
+        # Region between the sample points (smaller or thinner than the supersampling)
+        point = geometry.representative_point()
+        holding = np.nonzero(shapely.intersects(point, boxes))[0]
+        fractions[holding[0] if holding.size else np.nonzero(intersecting)[0][0]] = 1.0
+
+    selected = fractions > 0
+    return np.ravel_multi_index((iy[selected], ix[selected]), (len(lat), len(lon))), fractions[selected]
+
+
+def _fractions_centres(geometry, lat, lon):
+    """Flat cell indices of a region on a 2D grid, from the cell centres."""
+    inside = shapely.contains_xy(geometry, _wrap_lon(lon.ravel()), lat.ravel())
+    cells = np.nonzero(inside)[0]
+    if cells.size == 0:
+        # Region between the cell centres: the centre nearest to its representative point
+        point = geometry.representative_point()
+        distance = (_wrap_lon(lon.ravel() - point.x) * np.cos(np.deg2rad(point.y))) ** 2 + (lat.ravel() - point.y) ** 2
+        cells = np.array([np.argmin(distance)])
+    return cells, np.ones(len(cells))
+
+
+class RegionMask:
+    """
+    Sparse (regions x cells) matrix of the fraction of each cell in each region.
+
+    Parameters:
+    - names: list of str, region names (rows).
+    - fractions: scipy.sparse matrix, shape (len(names), number of cells).
+    - dims: tuple, names of the two spatial dimensions of the grid.
+    - shape: tuple, shape of the grid.
+    """
+
+    def __init__(self, names, fractions, dims, shape):
+        self.names = list(names)
+        self.fractions = sp.csr_matrix(fractions)
+        self.dims = tuple(dims)
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_geometries(cls, names, geometries, lat, lon, dims, supersample=10):
+        lat, lon = np.asarray(lat, dtype="float64"), np.asarray(lon, dtype="float64")
+        shape = lat.shape if lat.ndim == 2 else (len(lat), len(lon))
+        rows, cols, data = [], [], []
+        for row, geometry in enumerate(geometries):
+            if lat.ndim == 2:
+                cells, fractions = _fractions_centres(geometry, lat, lon)
+            else:
+                cells, fractions = _fractions_rectilinear(geometry, lat, lon, supersample)
+            rows.append(np.full(len(cells), row))
+            cols.append(cells)
+            data.append(fractions)
+        fractions = sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                  shape=(len(names), shape[0] * shape[1]))
+        return cls(names, fractions, dims, shape)
+
+    def save(self, path):
+        tmp = f"{path}.{os.getpid()}.npz"
+        np.savez(tmp, data=self.fractions.data, indices=self.fractions.indices, indptr=self.fractions.indptr,
+                 matrix_shape=self.fractions.shape, names=np.array(self.names), dims=np.array(self.dims),
+                 shape=np.array(self.shape))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            fractions = sp.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["matrix_shape"]))
+            return cls(f["names"].tolist(), fractions, f["dims"].tolist(), tuple(f["shape"]))
+
+    def select(self, names):
+        """RegionMask of a subset of the regions, in the given order."""
+        rows = [self.names.index(name) for name in names]
+        return RegionMask(names, self.fractions[rows], self.dims, self.shape)
+
+    def combine(self, groups):
+        """
+        RegionMask with one row per group of regions (e.g. AR6_REGIONS["groups"]),
+        the sum of the fractions of its regions (regions of a set do not overlap).
+        """
+        index = {name: row for row, name in enumerate(self.names)}
+        combination = sp.lil_matrix((len(groups), len(self.names)))
+        for row, members in enumerate(groups.values()):
+            for name in members:
+                if name in index:
+                    combination[row, index[name]] = 1.0
+        fractions = combination.tocsr() @ self.fractions
+        fractions.data = np.minimum(fractions.data, 1.0)
+        return RegionMask(list(groups), fractions, self.dims, self.shape)
+
+    def mean(self, da, weighting="coslat", lat="lat", lon="lon"):
+        """
+        NaN-aware weighted mean of every region for every time step of ``da``.
+
+        One sparse matrix product per block of TIME_BLOCK time steps.
+
+        Returns:
+        - DataArray (time, region), or (region,) if ``da`` has no time dimension.
+        """
+        weights = spatial_weights(da, lat=lat, lon=lon, weighting=weighting)
+        weights = weights.broadcast_like(da.isel(time=0, drop=True) if "time" in da.dims else da)
+        weights = weights.transpose(*self.dims).values.ravel()
+        weighted = self.fractions @ sp.diags(weights)
+
+        has_time = "time" in da.dims
+        if not has_time:
+            da = da.expand_dims("time")
+        da = da.transpose("time", *self.dims)
+        blocks = []
+        for start in range(0, da.sizes["time"], TIME_BLOCK):
+            block = decode_durations(da.isel(time=slice(start, start + TIME_BLOCK)))
+            values = np.asarray(block.values, dtype="float64").reshape(block.sizes["time"], -1)
+            valid = ~np.isnan(values)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                blocks.append(((weighted @ np.where(valid, values, 0.0).T) / (weighted @ valid.T.astype("float64"))).T)
+        result = xr.DataArray(np.concatenate(blocks), dims=("time", "region"),
+                              coords={"time": da["time"].values, "region": self.names}, name=da.name, attrs=da.attrs)
+        return result if has_time else result.isel(time=0, drop=True)
+
+
+_region_masks = {}
+
+
+def load_region_mask(regions, ds, lat="lat", lon="lon", name_property=None, supersample=10, cache_dir=CACHE_DIR):
+    """
+    Return the RegionMask of a region set (REGION_MASKS key or GeoJSON path) on the grid of ``ds``.
+
+    The mask is built once per (GeoJSON file, grid): reused from memory within
+    a process and from ``cache_dir`` across processes and runs (no disk cache
+    if None).
+    """
+    path = resolve_regions(regions)
+    digest = hashlib.sha256(f"{os.path.abspath(path)}|{os.stat(path).st_mtime}|{name_property}|{supersample}|"
+                            f"{grid_key(ds[lat].values, ds[lon].values)}".encode())
+    key = digest.hexdigest()[:16]
+    if key in _region_masks:
+        return _region_masks[key]
+
+    cache_file = os.path.join(cache_dir, f"region_mask_{key}.npz") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        mask = RegionMask.load(cache_file)
+    else:
+        dims = ds[lat].dims if ds[lat].ndim == 2 else (ds[lat].dims[0], ds[lon].dims[0])
+        names, geometries = read_regions(path, name_property=name_property)
+        mask = RegionMask.from_geometries(names, geometries, ds[lat].values, ds[lon].values, dims,
+                                          supersample=supersample)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            mask.save(cache_file)
+    _region_masks[key] = mask
+    return mask
+
+
+def file_region_means(path, variable, regions, weighting="coslat", lat="lat", lon="lon", names=None):
+    """
+    Means of all the regions (or of ``names``) for every time step of one file.
+
+    Returns:
+    - DataFrame indexed by time, one column per region.
+    """
+    with xr.open_dataset(path) as ds:
+        mask = load_region_mask(regions, ds, lat=lat, lon=lon)
+        if names is not None:
+            mask = mask.select(names)
+        return mask.mean(ds[variable], weighting=weighting, lat=lat, lon=lon).to_pandas()
+
+
+def region_mean_series(files, variable, regions, weighting="coslat", lat="lat", lon="lon", names=None, workers=4):
+    """
+    Region means of a variable over a list of files, one file per task in a process pool.
+
+    Returns:
+    - DataFrame indexed by time, one column per region.
+    """
+    args = [(path, variable, regions, weighting, lat, lon, names) for path in sorted(files)]
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(file_region_means, *zip(*args)))
+    else:
+        parts = [file_region_means(*arg) for arg in args]
+    return pd.concat(parts).sort_index()
@@ -0,0 +1,211 @@
+"""
+Regridding between rectilinear lat/lon grids with precomputed sparse weights.
+
+``ds2.interp(lat=ds1.lat, lon=ds1.lon, method="linear")`` recomputes the
+interpolation indices and weights between the same two grids for every year
+and variable. A Regridder computes them once per (source grid, target grid,
+method), as a sparse matrix, so regridding a field is one sparse
+matrix-vector product. Weights are kept in memory per process and optionally
+cached on disk (``.npz``).
+
+Methods:
+- ``bilinear``: matches ``xarray.interp(method="linear")`` (NaN outside the
+  source grid or next to a missing value).
+- ``conservative``: area-weighted overlap of the grid cells, normalised by the
+  valid (non-NaN) overlap.
+
+Usage:
+    from regrid import get_regridder
+
+    regridder = get_regridder(ds_mean2, ds_mean1, method="bilinear", cache_dir="/lustre/.../weights")
+    ds_mean2 = regridder.regrid(ds_mean2)
+
+    python regrid.py    # check the bilinear weights against xarray.interp
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+
+
+SUPPORTED_METHODS = ["bilinear", "conservative"]
+
+
+def _linear_weights_1d(src, dst):
+    """
+    1D linear interpolation weights, shape (len(dst), len(src)).
+
+    Rows of targets outside the source range are empty. ``support`` has a 1
+    for both neighbours of each target (also when one weight is 0), to
+    propagate missing values as scipy/xarray do.
+    """
+    src = np.asarray(src, dtype="float64")
+    dst = np.asarray(dst, dtype="float64")
+    order = np.argsort(src)
+    sorted_src = src[order]
+    inside = (dst >= sorted_src[0]) & (dst <= sorted_src[-1])
+    rows = np.nonzero(inside)[0]
+    i = np.clip(np.searchsorted(sorted_src, dst[rows], side="left") - 1, 0, len(src) - 2)
+    frac = (dst[rows] - sorted_src[i]) / (sorted_src[i + 1] - sorted_src[i])
+
+    row_index = np.concatenate([rows, rows])
+    col_index = np.concatenate([order[i], order[i + 1]])
+    shape = (len(dst), len(src))
+    weights = sp.csr_matrix((np.concatenate([1 - frac, frac]), (row_index, col_index)), shape=shape)
+    support = sp.csr_matrix((np.ones(len(row_index)), (row_index, col_index)), shape=shape)
+    return weights, support
+
+
+def _cell_bounds(centers):
+    """Cell bounds of a 1D coordinate from the midpoints between centres."""
+    centers = np.asarray(centers, dtype="float64")
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - mid[0]], mid, [2 * centers[-1] - mid[-1]]])
+
+
+def _overlap_weights_1d(src, dst, transform=None):
+    """1D overlap lengths between the cells of two coordinates, shape (len(dst), len(src))."""
+    src_bounds, dst_bounds = _cell_bounds(src), _cell_bounds(dst)
+    if transform is not None:
+        src_bounds, dst_bounds = transform(src_bounds), transform(dst_bounds)
+    src_lo, src_hi = np.minimum(src_bounds[:-1], src_bounds[1:]), np.maximum(src_bounds[:-1], src_bounds[1:])
+    dst_lo, dst_hi = np.minimum(dst_bounds[:-1], dst_bounds[1:]), np.maximum(dst_bounds[:-1], dst_bounds[1:])
+    overlap = np.minimum(dst_hi[:, None], src_hi[None, :]) - np.maximum(dst_lo[:, None], src_lo[None, :])
+    return sp.csr_matrix(np.clip(overlap, 0, None))
+
+
+def _sin_lat(bounds):
+    return np.sin(np.deg2rad(np.clip(bounds, -90, 90)))
+
+
+def grid_key(src_lat, src_lon, dst_lat, dst_lon, method):
+    """Hash identifying a (source grid, target grid, method) combination."""
+    digest = hashlib.sha256(method.encode())
+    for coord in (src_lat, src_lon, dst_lat, dst_lon):
+        digest.update(np.ascontiguousarray(coord, dtype="float64").tobytes())
+    return digest.hexdigest()[:16]
+
+
+class Regridder:
+    """
+    Sparse regridding weights from a source to a target lat/lon grid.
+
+    Parameters:
+    - src_lat, src_lon, dst_lat, dst_lon: 1D coordinates of the grids.
+    - method: str, one of SUPPORTED_METHODS.
+    - cache_dir: str, optional, directory where the weights are stored and
+      reused across runs.
+    """
+
+    def __init__(self, src_lat, src_lon, dst_lat, dst_lon, method="bilinear", cache_dir=None):
+        if method not in SUPPORTED_METHODS:
+            raise ValueError(f"Unsupported regridding method: {method}. Supported methods: {SUPPORTED_METHODS}")
+        self.method = method
+        self.src_shape = (len(src_lat), len(src_lon))
+        self.dst_lat = np.asarray(dst_lat)
+        self.dst_lon = np.asarray(dst_lon)
+        self.key = grid_key(src_lat, src_lon, dst_lat, dst_lon, method)
+
+        cache_file = os.path.join(cache_dir, f"regrid_{method}_{self.key}.npz") if cache_dir else None
+        if cache_file and os.path.exists(cache_file):
+            stacked = sp.load_npz(cache_file).tocsr()
+            n_dst = len(self.dst_lat) * len(self.dst_lon)
+            self.weights, self.support = stacked[:n_dst], stacked[n_dst:]
+            return
+
+        if method == "bilinear":
+            lat_weights, lat_support = _linear_weights_1d(src_lat, dst_lat)
+            lon_weights, lon_support = _linear_weights_1d(src_lon, dst_lon)
+            self.weights = sp.kron(lat_weights, lon_weights, format="csr")
+            self.support = sp.kron(lat_support, lon_support, format="csr")
+        else:
+            lat_weights = _overlap_weights_1d(src_lat, dst_lat, transform=_sin_lat)
+            lon_weights = _overlap_weights_1d(src_lon, dst_lon)
+            self.weights = sp.kron(lat_weights, lon_weights, format="csr")
+            self.support = self.weights
+
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}.npz"
+            sp.save_npz(tmp, sp.vstack([self.weights, self.support], format="csr"))
+            os.replace(tmp, cache_file)
+
+    def regrid(self, da, lat="lat", lon="lon"):
+        """
+        Regrid a DataArray with trailing (lat, lon) dimensions to the target grid.
+
+        Returns:
+        - DataArray on the target grid, same leading dimensions and attributes.
+        """
+        da = da.transpose(..., lat, lon)
+        lead_dims = da.dims[:-2]
+        lead_shape = da.shape[:-2]
+        values = np.asarray(da.values, dtype="float64").reshape(-1, self.src_shape[0] * self.src_shape[1]).T
+        missing = np.isnan(values)
+        filled = np.where(missing, 0.0, values)
+
+        if self.method == "bilinear":
+            result = self.weights @ filled
+            result[(self.support @ missing.astype("float64")) > 0] = np.nan
+            result[np.asarray(self.support.sum(axis=1)).ravel() == 0] = np.nan
+        else:
+            valid = self.weights @ (~missing).astype("float64")
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = (self.weights @ filled) / valid
+            result[valid == 0] = np.nan
+
+        result = result.T.reshape(*lead_shape, len(self.dst_lat), len(self.dst_lon))
+        coords = {name: coord for name, coord in da.coords.items() if lat not in coord.dims and lon not in coord.dims
+                  and name not in (lat, lon)}
+        coords[lat] = self.dst_lat
+        coords[lon] = self.dst_lon
+        return xr.DataArray(result, dims=(*lead_dims, lat, lon), coords=coords, name=da.name, attrs=da.attrs)
+
+
+_regridders = {}
+
+
+def get_regridder(source, target, method="bilinear", cache_dir=None, lat="lat", lon="lon"):
+    """
+    Return the Regridder from the grid of ``source`` to the grid of ``target``.
+
+    Regridders are built once per (source grid, target grid, method) and
+    reused by the following calls of the same process.
+    """
+    key = grid_key(source[lat].values, source[lon].values, target[lat].values, target[lon].values, method)
+    if key not in _regridders:
+        _regridders[key] = Regridder(source[lat].values, source[lon].values,
+                                     target[lat].values, target[lon].values,
+                                     method=method, cache_dir=cache_dir)
+    return _regridders[key]
+
+
+def check_bilinear(seed=0):
+    """
+    Compare the bilinear Regridder with ``xarray.interp(method="linear")``.
+
+    The source field has a patch of missing values, and the targets are a
+    subset of the source nodes (including nodes next to the patch) and a grid
+    extending beyond the source. Raises AssertionError if the missing values
+    or the interpolated values differ.
+    """
+    rng = np.random.default_rng(seed)
+    lat2, lon2 = np.linspace(30, 60, 31), np.linspace(-10, 30, 41)
+    d2 = rng.normal(size=(len(lat2), len(lon2)))
+    d2[5:9, 10:20] = np.nan
+    source = xr.DataArray(d2, dims=("lat", "lon"), coords={"lat": lat2, "lon": lon2})
+    targets = [(lat2[::2], lon2[::3]), (lat2[::-2], lon2[::3]),
+               (np.linspace(29, 61, 50), np.linspace(-11, 31, 77))]
+    for dst_lat, dst_lon in targets:
+        expected = source.interp(lat=dst_lat, lon=dst_lon, method="linear").values
+        result = Regridder(lat2, lon2, dst_lat, dst_lon).regrid(source).values
+        assert np.array_equal(np.isnan(expected), np.isnan(result)), "missing values differ from xarray.interp"
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-12, equal_nan=True)
+    print(f"Bilinear regridding matches xarray.interp on {len(targets)} target grids")
+
+
+if __name__ == "__main__":
+    check_bilinear()
@@ -3,6 +3,7 @@ import xarray as xr
 import matplotlib.pyplot as plt
 from load_files import load_root_directories, load_files, load_parameters, load_datasets,check_varin
 from timeseries import select_data_point, plot_timeseries
+from spatial_mean import spatial_mean_series, series_year
 import numpy as np
 
 import os
@@ -77,12 +78,14 @@ for version in version_list:
         plot_timeseries(data_list, varin, dataset_list,  title,  save_file)
 
 
-    ## plot timeseries for lonlat mean
+    ## plot timeseries for lonlat mean (cos(lat)-weighted, cached per dataset and variable)
     for varin in var_list:
         data_list=[]
         for dataset in  dataset_list:
             varin=check_varin(dataset,varin)
-            data_list.append(Dict["ds"][dataset][varin].mean(dim=(lat,lon)))
+            daily, _ = spatial_mean_series(file_dict[dataset][varin], varin, dataset=dataset, domain=params["domain"], lat=lat, lon=lon)
+            # As an xarray series, plotted as the point series (cftime calendars included)
+            data_list.append(series_year(daily, year).to_xarray())
         print(f"plotting for mean lonlat {varin}")
         title=f"timeseries {varin} dataset daily comparison for lonlatmean, year:{year}"
         save_file=f"{save_dir}/timeseries_{varin}_dataset_comparison:lonlatmean_{year}_{version}.png"
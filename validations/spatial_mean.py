@@ -0,0 +1,170 @@
+"""
+Area-weighted spatial-mean series, reduced file by file and cached.
+
+The mean over the domain of every time step is weighted by cos(lat), as
+``stripes.area_lat_weight``, or by the cell area, and computed one file (and
+one block of time steps) at a time in a process pool, instead of an
+unweighted ``ds[var].mean(dim=(lat, lon))`` over the whole open_mfdataset.
+The daily and annual series of each (dataset, variable, domain) are cached
+on disk, so the per-year plots only slice the cached series. Series of
+non-standard calendars (360_day, noleap... of CORDEX) keep their cftime dates
+(xarray.CFTimeIndex), written as ISO strings with the calendar in the header.
+
+Usage:
+    from spatial_mean import spatial_mean_series
+
+    daily, annual = spatial_mean_series(files, "tas", dataset="CERRA", domain="EUR")
+    series_year(daily, 1990)
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cftime
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from durations import decode_durations
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cica-atlas-tools", "spatial_mean")
+WEIGHTINGS = ["coslat", "area", "none"]
+TIME_BLOCK = 366
+
+
+def spatial_weights(da, lat="lat", lon="lon", weighting="coslat"):
+    """
+    Weights of the cells of ``da`` over its (lat, lon) dimensions.
+
+    - ``coslat``: cos(lat), as stripes.area_lat_weight.
+    - ``area``: cell area from the latitude bounds (sin(lat) differences)
+      and the longitude spacing of a rectilinear grid.
+    - ``none``: equal weights.
+    """
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"Unsupported weighting: {weighting}. Supported weightings: {WEIGHTINGS}")
+    if weighting == "none" or lat not in da.coords:
+        return xr.DataArray(1.0, name="weights")
+    if weighting == "coslat" or da[lat].ndim == 2:
+        weights = np.cos(np.deg2rad(da[lat]))
+    else:
+        lat_values = da[lat].values.astype("float64")
+        mid = (lat_values[1:] + lat_values[:-1]) / 2
+        bounds = np.clip(np.concatenate([[2 * lat_values[0] - mid[0]], mid, [2 * lat_values[-1] - mid[-1]]]), -90, 90)
+        band = np.abs(np.diff(np.sin(np.deg2rad(bounds))))
+        lon_values = da[lon].values.astype("float64")
+        dlon = np.abs(np.gradient(lon_values)) if len(lon_values) > 1 else np.ones(1)
+        weights = xr.DataArray(band, dims=da[lat].dims) * xr.DataArray(np.deg2rad(dlon), dims=da[lon].dims)
+    weights.name = "weights"
+    return weights
+
+
+def time_index(times):
+    """
+    pandas index of time values: DatetimeIndex for numpy datetimes, CFTimeIndex
+    for cftime dates (360_day, noleap...), so that ``.year`` works on both.
+    """
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return pd.DatetimeIndex(times, name="time")
+    return xr.CFTimeIndex(times, name="time")
+
+
+def series_year(series, year):
+    """Values of a time series in one year (any calendar)."""
+    return series[np.asarray(series.index.year) == int(year)]
+
+
+def write_series(series, path):
+    """Write a time series to CSV atomically, dates as ISO strings and the calendar in the header."""
+    index = series.index
+    if isinstance(index, xr.CFTimeIndex):
+        header = f"time:{index.calendar}"
+        dates = [date.isoformat() for date in index]
+    else:
+        header = "time"
+        dates = [date.isoformat() for date in pd.DatetimeIndex(index)]
+    frame = pd.DataFrame({series.name: series.values}, index=pd.Index(dates, name=header))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    frame.to_csv(tmp, header=True)
+    os.replace(tmp, path)
+
+
+def read_series(path):
+    """Time series written by write_series, with its DatetimeIndex or CFTimeIndex."""
+    frame = pd.read_csv(path, index_col=0)
+    header = str(frame.index.name)
+    if ":" in header:
+        calendar = header.split(":", 1)[1]
+        index = xr.CFTimeIndex([cftime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f" if "." in date else "%Y-%m-%dT%H:%M:%S",
+                                                         calendar=calendar) for date in frame.index], name="time")
+    else:
+        index = pd.DatetimeIndex(pd.to_datetime(frame.index), name="time")
+    return pd.Series(frame.iloc[:, 0].values, index=index, name=frame.columns[0])
+
+
+def file_spatial_mean(path, variable, lat="lat", lon="lon", weighting="coslat"):
+    """
+    Weighted, NaN-aware mean over (lat, lon) of every time step of one file.
+
+    Returns:
+    - pandas.Series indexed by time (time_index: cftime dates for non-standard calendars).
+    """
+    with xr.open_dataset(path) as ds:
+        da = ds[variable]
+        weights = spatial_weights(da, lat=lat, lon=lon, weighting=weighting)
+        spatial_dims = [dim for dim in da.dims if dim != "time"]
+        weights = weights.broadcast_like(da.isel(time=0, drop=True)).transpose(*spatial_dims).values
+        times, means = [], []
+        for start in range(0, da.sizes["time"], TIME_BLOCK):
+            block = decode_durations(da.isel(time=slice(start, start + TIME_BLOCK)), variable).transpose("time", *spatial_dims)
+            values = block.values.astype("float64").reshape(block.sizes["time"], -1)
+            valid = ~np.isnan(values)
+            w = weights.ravel()
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means.append(np.where(valid, values, 0.0) @ w / (valid @ w))
+            times.append(block["time"].values)
+    return pd.Series(np.concatenate(means), index=time_index(np.concatenate(times)), name=variable)
+
+
+def _cache_file(dataset, variable, domain, weighting, files, cache_dir):
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        digest.update(f"{path}|{os.stat(path).st_mtime}|".encode())
+    return os.path.join(cache_dir, f"{dataset}_{variable}_{domain}_{weighting}_{digest.hexdigest()[:16]}.csv")
+
+
+def spatial_mean_series(files, variable, dataset="", domain="", lat="lat", lon="lon", weighting="coslat",
+                        workers=4, cache_dir=CACHE_DIR):
+    """
+    Daily and annual spatial-mean series of a variable over a list of files.
+
+    Files are reduced in parallel (``workers`` processes). The result is cached
+    per (dataset, variable, domain, weighting) and input files (paths and
+    mtimes) under ``cache_dir`` (no cache if None).
+
+    Returns:
+    - (daily, annual): pandas.Series indexed by time (time_index) and by year.
+    """
+    files = sorted(files)
+    cache_file = _cache_file(dataset, variable, domain, weighting, files, cache_dir) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        daily = read_series(cache_file).rename(variable)
+    else:
+        args = [(path, variable, lat, lon, weighting) for path in files]
+        if workers > 1 and len(files) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(file_spatial_mean, *zip(*args)))
+        else:
+            parts = [file_spatial_mean(*arg) for arg in args]
+        daily = pd.concat(parts).sort_index()
+        # pd.concat drops the CFTimeIndex of cftime series
+        daily.index = time_index(daily.index)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            write_series(daily, cache_file)
+    annual = daily.groupby(np.asarray(daily.index.year)).mean()
+    annual.index.name = "year"
+    return daily, annual
@@ -2,7 +2,7 @@
 """
 Script to generate stripe-plots for the ATLAS.
 Usage:
-  stripeplots_ATLAS.py --project PROJECT --var VAR --experiment EXPERIMENT --domain DOMAIN --dest DEST --log_dest LOGDEST
+  stripeplots_ATLAS.py --project PROJECT --var VAR --experiment EXPERIMENT --domain DOMAIN --dest DEST --log_dest LOGDEST [--workers WORKERS] [--cache_dir CACHEDIR]
   stripeplots_ATLAS.py (-h | --help)
   stripeplots_ATLAS.py --version
 Arguments:
@@ -21,12 +21,15 @@ Options:
   --domain DOMAIN 
   --dest DEST
   --log_dest LOGDEST
+  --workers WORKERS  Number of processes computing annual means [default: 8]
+  --cache_dir CACHEDIR  Directory of the per-file annual means cache, "none" to disable [default: ~/.cache/cica-atlas-tools/stripes]
 """
 __version__ = '0.0.2'
 __authors__ = "JavierDiezSierra - Chantreux"
 __date__ = "2024-01-29"
 
 import glob
+import hashlib
 from collections import defaultdict
 import logging
 import os
@@ -35,49 +38,22 @@ from datetime import date
 import numpy as np
 import xarray as xr
 import pandas as pd
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import copy
 
+from spatial_mean import file_spatial_mean
+from durations import duration_units
+
 def setup_logging(log_dest):
     logging.basicConfig(filename=log_dest, level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
 
-def area_lat_weight(ds):
-    """Function to apply lat area weight to dataset."""
-    weights = np.cos(np.deg2rad(ds.lat))
-    weights.name = "weights"
-    return weights
-
 def load_units(file, var):
     """Load units for a given variable."""
     print(f"Loading units for {var} from {file}")
-    if var == "cdd":
-        return "days"
-    else:
-        with xr.open_dataset(file) as ds:
-            if var in ["avg_lds_wt1","max_lds_wt1","nd_thre_cold_tn0","nd_thre_cold_tn20","nd_thre_hot_tx30","nd_thre_rain50","nd_thre_rain100","nhw_tx40_dur6","nhw_tx40_dur3"]:
-                units="days"
-            else:
-                units=ds[var].attrs["units"]
-            return units
-
-def preprocess(ds, var="t", weighted=True):
-    """Function to aggregate files to yearly resolution and calculate the weighted mean over the domain."""
-    if var in ["cdd","avg_lds_wt1","max_lds_wt1","nd_thre_cold_tn0","nd_thre_cold_tn20","nd_thre_hot_tx30","nd_thre_rain50","nd_thre_rain100","nhw_tx40_dur6","nhw_tx40_dur3"]:
-        ds[var].values = ds[var].values.astype('timedelta64[D]')
-        ds[var].values = ds[var].values / np.timedelta64(1, 'D')
-
-    if weighted:
-        weights = area_lat_weight(ds)
-        ds_weighted = ds[[var]].weighted(weights)
-        var_mean = ds_weighted.mean(dim=("lat", "lon"), skipna=True)
-    else:
-        var_mean = ds[[var]].mean(dim=("lat", "lon"), skipna=True)
-
-    res = var_mean.groupby("time.year").mean(dim="time")
-    res = res.rename(year="time")
-    return res
+    with xr.open_dataset(file) as ds:
+        return duration_units(ds, var)
 
 def check_models_consistency(files_dict):
     """Check if all experiments have the same number of models and the same model names."""
@@ -113,27 +89,113 @@ def check_period(hist_period, fut_period, expe):
     """Function to associate historical period to historical and future period to other experiments."""
     return hist_period if expe == 'historical' else fut_period
 
-def calculate_annual_mean_1model(files_list, period, var, weighted=True):
-    """Calculate the annual mean for a single model."""
-    partial_func = partial(preprocess, var=var, weighted=weighted)
-    dataframe_model = pd.DataFrame(index=period, columns=[var])
-    for file in files_list:
-        with xr.open_mfdataset(file, preprocess=partial_func, concat_dim='time', combine='nested') as ds:
-            year = ds.time.data[0]
-            dataframe_model.loc[year] = ds[var][:].values[0]
-    return dataframe_model
-
-def calculate_annual_mean(files_dict, hist_period, fut_period, var, expe, weighted=True):
+ROOT_DIR = '/gpfs/projects/meteo/DATA/FAO/final_products/indices/Global/CORDEX/'
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cica-atlas-tools", "stripes")
+
+
+def annual_cache_file(file, var, weighted, cache_dir):
+    """Cache entry of the annual means of one file, keyed by path, mtime, variable and weighting."""
+    weighting = "coslat" if weighted else "none"
+    key = f"{os.path.abspath(file)}|{os.stat(file).st_mtime}|{var}|{weighting}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, var, f"annual_{var}_{weighting}_{digest}.csv")
+
+
+def read_annual_cache(file, var, weighted, cache_dir):
+    """Cached (years, values) of one file, or None."""
+    if not cache_dir:
+        return None
+    cache_file = annual_cache_file(file, var, weighted, cache_dir)
+    if not os.path.exists(cache_file):
+        return None
+    annual = pd.read_csv(cache_file, index_col=0).iloc[:, 0]
+    return annual.index.values, annual.values
+
+
+def annual_means_files(files, var, weighted=True, cache_dir=None):
+    """
+    Weighted annual domain means of a subset of files (one worker task).
+
+    The means of every file are written to ``cache_dir`` (if given), so they
+    are only reduced once across experiments, colormaps and added models.
+
+    Returns:
+    - list of (years, values) arrays, one per file.
+    """
+    results = []
+    for file in files:
+        series = file_spatial_mean(file, var, weighting="coslat" if weighted else "none")
+        # index.year of the DatetimeIndex or CFTimeIndex (360_day, noleap... CORDEX calendars)
+        annual = series.groupby(np.asarray(series.index.year)).mean()
+        annual.index.name = "year"
+        if cache_dir:
+            cache_file = annual_cache_file(file, var, weighted, cache_dir)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}.tmp"
+            annual.to_csv(tmp, header=True)
+            os.replace(tmp, cache_file)
+        results.append((annual.index.values, annual.values))
+    return results
+
+
+def calculate_annual_means_batch(files_dict_domain, experiments, hist_period, fut_period, var, weighted=True,
+                                 workers=8, files_per_task=10, cache_dir=None, executor=None):
+    """
+    Annual means of every member of several experiments in one process pool.
+
+    Files already in ``cache_dir`` are read from the cache; the others are
+    split into tasks of ``files_per_task`` files; workers return arrays, which
+    are assembled into one DataFrame (period x members) per experiment at the end.
+
+    Parameters:
+    - files_dict_domain: dict, {experiment: {member: [files]}}.
+    - experiments: list of str, experiments to compute.
+    - executor: optional ProcessPoolExecutor shared between calls (otherwise
+      a pool of ``workers`` processes is created for the call).
+
+    Returns:
+    - dict, {experiment: DataFrame}.
+    """
+    values = {expe: defaultdict(dict) for expe in experiments}
+    jobs = []
+    for expe in experiments:
+        for mem, files in files_dict_domain[expe].items():
+            for file in files:
+                cached = read_annual_cache(file, var, weighted, cache_dir)
+                if cached is None:
+                    jobs.append((expe, mem, file))
+                else:
+                    values[expe][mem].update(zip(cached[0].tolist(), cached[1].tolist()))
+    tasks = [jobs[i:i + files_per_task] for i in range(0, len(jobs), files_per_task)]
+    print(f"Calculating yearly means for {var} {experiments}: {len(jobs)} new files in {len(tasks)} tasks")
+
+    task_files = [[file for _, _, file in task] for task in tasks]
+    if executor is not None and tasks:
+        results = list(executor.map(annual_means_files, task_files, [var] * len(tasks),
+                                    [weighted] * len(tasks), [cache_dir] * len(tasks)))
+    elif workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(annual_means_files, task_files, [var] * len(tasks),
+                                        [weighted] * len(tasks), [cache_dir] * len(tasks)))
+    else:
+        results = [annual_means_files(files, var, weighted, cache_dir) for files in task_files]
+
+    for task, task_results in zip(tasks, results):
+        for (expe, mem, _), (years, means) in zip(task, task_results):
+            values[expe][mem].update(zip(years.tolist(), means.tolist()))
+
+    dataframes = {}
+    for expe in experiments:
+        period = check_period(hist_period, fut_period, expe)
+        members = list(files_dict_domain[expe].keys())
+        dataframes[expe] = pd.DataFrame(values[expe], columns=members).reindex(period)
+    return dataframes
+
+
+def calculate_annual_mean(files_dict, hist_period, fut_period, var, expe, weighted=True, workers=8, cache_dir=None):
     """Calculate the annual mean for all models in an experiment."""
-    print(f"Calculating yearly mean for {var} {expe}")
-    period = check_period(hist_period, fut_period, expe)
-    members = files_dict.keys()
-    dataframe_exp = pd.DataFrame(index=period, columns=members)
-    print(members)
-    for mem in members:
-        print(mem)
-        dataframe_exp[mem] = calculate_annual_mean_1model(files_dict[mem], period, var, weighted=weighted)
-    return dataframe_exp
+    return calculate_annual_means_batch({expe: files_dict}, [expe], hist_period, fut_period, var,
+                                        weighted=weighted, workers=workers, cache_dir=cache_dir)[expe]
 
 def plot_and_save_results(hist_sce, args, filename, units):
     """Plot and save the results."""
@@ -150,10 +212,10 @@ def plot_and_save_results(hist_sce, args, filename, units):
     name_file = args['--dest'] + filename
 
     year_line = 2006
-    index_year = np.where(hist_sce.index.values == year_line)
+    index_year = np.where(hist_sce.index.values == year_line)[0]
 
-    if any(index_year):
-        index_year = index_year[0][0]
+    if index_year.size > 0:
+        index_year = index_year[0]
         ax.axvline(x=index_year, color='k', linewidth=0.5)
         plt.xticks([0, index_year, len(mat.index)], (str(np.min(mat.index)), str(year_line), str(np.max(mat.index))))
     else:
@@ -199,6 +261,73 @@ def print_model_info(files_dict):
                 num_models = len(models)
                 print(f"Variable: {var}, Domain: {domain}, Experiment: {experiment}, Number of Models: {num_models} {models.keys()}")
 
+def discover_files(root_dir=ROOT_DIR, var="all", domain="all"):
+    """
+    One discovery pass over ``root_dir/<domain>/mon/<var>/**/*.nc``.
+
+    Returns:
+    - dict, {var: {domain: {experiment: {model: [files]}}}}.
+    """
+    pattern = os.path.join(root_dir, "*" if domain == "all" else domain, "mon", "*" if var == "all" else var, "**", "*.nc")
+    files_by_var = defaultdict(list)
+    for file in sorted(glob.glob(pattern, recursive=True)):
+        files_by_var[os.path.relpath(file, root_dir).split(os.sep)[2]].append(file)
+    files_dict = {}
+    for file_var, file_list in files_by_var.items():
+        files_dict.update(create_files_dict(file_list, file_var))
+    return files_dict
+
+def run_stripes(files_dict, project, experiment, args, workers=8, cache_dir=None):
+    """
+    Stripes of every (variable, domain, experiment) of a files dictionary.
+
+    For each (variable, domain), the missing experiments and their historical
+    run are computed in one batch, so the historical annual means are shared
+    by all scenarios; the batches share one process pool. A batch that fails
+    (e.g. on an unreadable file) is logged and the others go on.
+
+    Returns:
+    - failed: list of the (variable, domain) batches that raised.
+    """
+    hist_period, fut_period = load_period(project)
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for var, var_dict in files_dict.items():
+            for domain, domain_dict in var_dict.items():
+                if "historical" not in domain_dict:
+                    logging.warning(f"No historical run for {var} {domain}, skipping")
+                    continue
+                experiments = sorted(domain_dict) if experiment == "all" else [experiment]
+                pending = []
+                for expe in experiments:
+                    name_file = args['--dest'] + f"{project}_{domain}_{var}_{expe}"
+                    if expe not in domain_dict:
+                        logging.warning(f"No files for {var} {domain} {expe}, skipping")
+                    elif os.path.isfile(name_file + '.pdf'):
+                        logging.info(f"File {name_file}.pdf already exists, skipping")
+                    else:
+                        pending.append(expe)
+                if not pending or 'CORDEX' not in project:
+                    continue
+                try:
+                    members = list(domain_dict["historical"].keys())
+                    units = load_units(domain_dict["historical"][members[0]][0], var)
+                    needed = ["historical"] + [expe for expe in pending if expe != "historical"]
+                    dic_res = calculate_annual_means_batch(domain_dict, needed, hist_period, fut_period, var,
+                                                           weighted=True, workers=workers, cache_dir=cache_dir,
+                                                           executor=executor)
+                    for expe in pending:
+                        if expe != 'historical':
+                            hist_sce = pd.concat([dic_res['historical'], dic_res[expe]])
+                        else:
+                            hist_sce = pd.concat([dic_res['historical']])
+                        plot_and_save_results(hist_sce, args, f"{project}_{domain}_{var}_{expe}", units)
+                except Exception as exc:
+                    logging.exception(f"Stripes of {var} {domain} failed, skipping")
+                    print(f"FAILED {var} {domain}: {type(exc).__name__}: {exc}")
+                    failed.append((var, domain))
+    return failed
+
 def main():
     args = docopt(__doc__, version=__version__)
     print(args['--dest'])
@@ -206,41 +335,19 @@ def main():
     setup_logging(args['--log_dest'])
     project = args['--project']
     var = args['--var']
-    experiments = [args['--experiment']]
+    experiment = args['--experiment']
     domain = args['--domain']
-    base_dir = f'/gpfs/projects/meteo/DATA/FAO/final_products/indices/Global/CORDEX/{domain}/mon/{var}/'
-    file_pattern = base_dir + '**/*.nc'
-    file_list = np.sort(glob.glob(file_pattern, recursive=True))
 
-    files_dict = create_files_dict(file_list,var)
+    files_dict = discover_files(ROOT_DIR, var=var, domain=domain)
     print_model_info(files_dict)
-
     check_models_consistency(files_dict)
-    hist_period, fut_period = load_period(project)
-    members = list(files_dict[var][domain]["historical"].keys())
-    print(members)
-    print(files_dict.keys())
-    print(files_dict[var].keys())
-    print(files_dict[var][domain].keys())
-    units = load_units(files_dict[var][domain]["historical"][members[0]][0], var)
-
-    for experiment in experiments:
-        filename = f"{project}_{domain}_{var}_{experiment}"
-        name_file = args['--dest'] + filename
-        if os.path.isfile(name_file + '.pdf'):
-            logging.info(f"File {name_file}.pdf already exists, skipping")
-            continue
-        dic_res = {}
-        if 'CORDEX' in project:
-            dic_res[experiment] = calculate_annual_mean(files_dict[var][domain][experiment], hist_period, fut_period, var, experiment, weighted=True)
-            if experiment != 'historical':
-                if "historical" not in dic_res:
-                    dic_res["historical"] = calculate_annual_mean(files_dict[var][domain]["historical"], hist_period, fut_period, var, "historical", weighted=True)
-                hist_sce = pd.concat([dic_res['historical'], dic_res[experiment]])
-            else:
-                hist_sce = pd.concat([dic_res['historical']])
-
-            plot_and_save_results(hist_sce, args, filename, units)
+
+    workers = int(args['--workers'])
+    cache_dir = None if args['--cache_dir'].lower() == "none" else os.path.expanduser(args['--cache_dir'])
+    failed = run_stripes(files_dict, project, experiment, args, workers=workers, cache_dir=cache_dir)
+    if failed:
+        raise SystemExit(f"Stripes failed for {len(failed)} (variable, domain) batches: "
+                         + ", ".join(f"{var} {domain}" for var, domain in failed))
 
 if __name__ == "__main__":
     main()
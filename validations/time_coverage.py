@@ -0,0 +1,203 @@
+"""
+Time coverage of NetCDF files read from their time coordinate.
+
+Instead of guessing the period of a file from its name (``f"_{year}" in f``,
+wrong for multi-year files such as ``pr_gr006_mon_CERRA_day_198501_198512.nc``),
+the first and last time steps (or time bounds) are read from the file header
+with netCDF4, without loading any data. Files are read in a thread pool and
+the result is cached under ``~/.cache/cica-atlas-tools/time_coverage/`` (one
+index per data directory, nothing is written into the data archive), keyed
+by file name, size and mtime. Files whose time coordinate cannot be read
+fall back to the old file name filter (``_{year}`` in the name).
+
+Usage:
+    from time_coverage import files_overlapping
+
+    files = files_overlapping(file_list, "1985-01-01T00:00:00", "1985-12-31T23:59:59")
+"""
+
+import bisect
+import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import cftime
+import netCDF4
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cica-atlas-tools", "time_coverage")
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def find_time_variable(nc, time_name="time"):
+    """
+    Name of the time coordinate of an open netCDF4.Dataset: ``time_name`` if
+    present, otherwise the variable with standard_name "time" or axis "T".
+    """
+    if time_name in nc.variables:
+        return time_name
+    for name, variable in nc.variables.items():
+        if getattr(variable, "standard_name", None) == "time" or getattr(variable, "axis", None) == "T":
+            return name
+    raise KeyError(f"No time coordinate in {nc.filepath()}")
+
+
+def read_time_coverage(path, time_name="time"):
+    """
+    Read the [start, end] of a file from its time coordinate only.
+
+    Parameters:
+    - path: str, path of the NetCDF file.
+    - time_name: str, name of the time coordinate (found by find_time_variable
+      if the file has no such variable).
+
+    Returns:
+    - (start, end): tuple of ISO strings (``YYYY-MM-DDTHH:MM:SS``), from the
+      time bounds if present (the end bound is exclusive, so one second is
+      taken off), otherwise from the first and last time steps.
+    """
+    with netCDF4.Dataset(path) as nc:
+        time = nc.variables[find_time_variable(nc, time_name)]
+        units = time.units
+        calendar = getattr(time, "calendar", "standard")
+        bounds_name = getattr(time, "bounds", None)
+        has_bounds = bounds_name in nc.variables
+        if has_bounds:
+            bounds = nc.variables[bounds_name]
+            first, last = bounds[0, 0], bounds[-1, -1]
+        else:
+            first, last = time[0], time[-1]
+    start, end = cftime.num2date([float(first), float(last)], units, calendar=calendar,
+                                 only_use_cftime_datetimes=True)
+    if has_bounds:
+        end = end - datetime.timedelta(seconds=1)
+    return start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)
+
+
+def index_path(directory):
+    """Return the cached coverage index of a data directory (under CACHE_DIR)."""
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _load_index(directory):
+    try:
+        with open(index_path(directory)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_index(directory, entries):
+    path = index_path(directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so concurrent readers never see a partial index
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp, path)
+
+
+def _safe_time_coverage(path):
+    """read_time_coverage, or (None, None) if the file cannot be read."""
+    try:
+        return read_time_coverage(path)
+    except Exception as exc:
+        print(f"WARNING: no time coverage for {path} ({type(exc).__name__}: {exc}), selected by file name")
+        return None, None
+
+
+def harvest_time_coverage(files, workers=8):
+    """
+    Return the time coverage of each file, reading only the files not yet indexed.
+
+    Parameters:
+    - files: list of str, NetCDF files.
+    - workers: int, number of threads reading headers.
+
+    Returns:
+    - coverage: dict, path -> (start, end); (None, None) for the files whose
+      time coordinate cannot be read (also cached, until the file changes).
+    """
+    by_directory = {}
+    for path in files:
+        by_directory.setdefault(os.path.dirname(os.path.abspath(path)), []).append(path)
+
+    coverage, pending, indexes = {}, [], {}
+    for directory, paths in by_directory.items():
+        entries = indexes[directory] = _load_index(directory)
+        for path in paths:
+            stat = os.stat(path)
+            entry = entries.get(os.path.basename(path))
+            if entry and entry[2] == stat.st_size and entry[3] == stat.st_mtime:
+                coverage[path] = (entry[0], entry[1])
+            else:
+                pending.append((path, directory, stat))
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_safe_time_coverage, [path for path, _, _ in pending])
+            for (path, directory, stat), (start, end) in zip(pending, results):
+                coverage[path] = (start, end)
+                indexes[directory][os.path.basename(path)] = [start, end, stat.st_size, stat.st_mtime]
+        for directory in {directory for _, directory, _ in pending}:
+            _save_index(directory, indexes[directory])
+
+    return coverage
+
+
+class TimeCoverageIndex:
+    """
+    Interval index answering "files overlapping [start, end]".
+
+    Files are sorted by start date; together with the running maximum of the
+    end dates, two binary searches bound the candidates, so a query costs
+    O(log n + k) for k matching files (exact for non-overlapping files, as in
+    a time series split by year or month). Files without coverage are
+    matched by the years in their name (``_{year}``), as before the index.
+    """
+
+    def __init__(self, coverage):
+        self.unknown = sorted(path for path, (start, _) in coverage.items() if start is None)
+        items = sorted((start, end, path) for path, (start, end) in coverage.items() if start is not None)
+        self.starts = [start for start, _, _ in items]
+        self.ends = [end for _, end, _ in items]
+        self.paths = [path for _, _, path in items]
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+
+    @classmethod
+    def from_files(cls, files, workers=8):
+        return cls(harvest_time_coverage(files, workers=workers))
+
+    def overlapping(self, start, end):
+        """
+        Return the files whose coverage overlaps [start, end] (``YYYY-MM-DDTHH:MM:SS``),
+        sorted by start, followed by the files without coverage matched by name.
+        """
+        first = bisect.bisect_left(self.max_ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        selected = [self.paths[i] for i in range(first, last) if self.ends[i] >= start]
+        years = range(int(start[:4]), int(end[:4]) + 1)
+        return selected + [path for path in self.unknown if any(f"_{year}" in path for year in years)]
+
+
+@lru_cache(maxsize=256)
+def _cached_index(files, workers):
+    return TimeCoverageIndex.from_files(list(files), workers=workers)
+
+
+def files_overlapping(files, start, end, workers=8):
+    """
+    Return the files of ``files`` whose time coverage overlaps [start, end].
+
+    The index of a given file list is built once per process and reused by
+    later queries (e.g. one query per year).
+    """
+    if len(files) == 0:
+        return []
+    return _cached_index(tuple(files), workers).overlapping(start, end)
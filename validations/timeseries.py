@@ -2,11 +2,16 @@ import xarray as xr
 #import xoak
 import matplotlib.pyplot as plt
 from load_files import check_varin
+from grid_index import get_grid_index
 
 def select_data_point(data,dataset, lon_p, lat_p):
     """
     Select data for a specific point.
 
+    Grids with 2D lat/lon coordinates (rotated CORDEX, curvilinear) are
+    searched with a KD-tree built once per grid (grid_index.py); rectilinear
+    grids with a nearest selection on their lat/lon axes.
+
     Parameters:
     - dataset: xarray.Dataset, the dataset to select data from.
     - lon_p: float, the longitude of the point.
@@ -15,7 +20,12 @@ def select_data_point(data,dataset, lon_p, lat_p):
     Returns:
     - xarray.Dataset, the dataset with data selected for the point.
     """
+    if "lat" in data.coords and data["lat"].ndim == 2:
+        index = get_grid_index(data)
+        iy, ix = index.query(lon_p, lat_p)
+        return data.isel({index.dims[0]: int(iy[0]), index.dims[1]: int(ix[0])})
     if dataset == "CORDEX-CORE_CICA":
+        # Geographic x/y axes without 2D lat/lon coordinates
         return data.sel(x=lon_p, y=lat_p, method="nearest")
     else:
         return data.sel(lat=lat_p, lon=lon_p, method="nearest")
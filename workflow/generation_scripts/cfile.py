@@ -1,16 +1,24 @@
 import load_parameters
-from variables import temporal_agg, MONTHLY_INPUT_INDEXES,BASE_PROJECT_VARIABLES
+from variables import temporal_agg, output_encoding, MONTHLY_INPUT_INDEXES,BASE_PROJECT_VARIABLES, RECHUNK_BEFORE_STEPS, RECHUNK_FORMAT, RECHUNK_CHUNKS
 from cluster import get_cluster_config, get_job_parameters, SUPPORTED_CLUSTERS
 from aliases import PROJECT_STEPS,SUPPORTED_PROJECTS, PROJECT_ALIASES
 
 import yaml
 import os
 from pathlib import Path
+from functools import lru_cache
+import hashlib
+import copy
 import importlib
 import shutil
 from dataclasses import dataclass
 import argparse
 import logging
+import sys
+
+# The dataset catalog lives at the repository root
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from catalog import DatasetCatalog
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -19,9 +27,15 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+INTERPOLATION_METHOD = "conservative_normed"
+
+# Dataset catalog used to check existing inputs (set with --catalog)
+DATASET_CATALOG = None
+
 SUPPORTED_STEPS = [
     "homogenization",
     "interpolation",
+    "rechunk",
     "biasadjustment",
     "indices",
     "range-skewness",
@@ -41,6 +55,9 @@ for proj, steps in PROJECT_STEPS.items():
             PROJECT_STEP_VARIABLES[proj][step] = BASE_PROJECT_VARIABLES[proj]["homogenization"]
         else:
             PROJECT_STEP_VARIABLES[proj][step] = BASE_PROJECT_VARIABLES[proj][step]
+    # 'rechunk' is inserted by insert_rechunk, not listed in PROJECT_STEPS; only the
+    # indices reading full monthly time series per grid cell need rechunked inputs
+    PROJECT_STEP_VARIABLES[proj]["rechunk"] = [var for var in BASE_PROJECT_VARIABLES[proj]["indices"] if var in MONTHLY_INPUT_INDEXES]
 
 
 def load_template(project,step):
@@ -117,7 +134,16 @@ def write_jfile(project,experiment,varout,domain,model="None",step="homogenizati
     replace_string_in_file(jfile_in, jfile_out, replacements)
 
 
-def load_existing_input(root,project,experiment,varin_list,domain,model="None",step="homogenization",varout=None):
+def load_existing_input(root,project,experiment,varin_list,domain,model="None",step="homogenization",varout=None,catalog=None):
+    """
+    Return the directory holding the existing input of a step.
+
+    If a dataset catalog is given (or DATASET_CATALOG is set), it is queried
+    for the input files of ``varin_list[0]`` below that directory and a
+    warning is logged when there are none, instead of the step failing later
+    in the pipeline.
+    """
+    catalog = catalog if catalog is not None else DATASET_CATALOG
     truncate=False
     varin=varin_list[0]
     project = PROJECT_ALIASES.get(project, project)
@@ -149,6 +175,9 @@ def load_existing_input(root,project,experiment,varin_list,domain,model="None",s
                 path=build_step_path(root, "final_products")
             else:
                 path=build_step_path(root, "interpolation")
+    elif step=="biasadjustment_sim":
+        # Simulations to adjust: the regridded output of the model (input of the 'rechunk' step)
+        path=build_step_path(root, "interpolation")
     else:
         raise ValueError(f"Unsupported step for existing input: {step}")
 
@@ -160,6 +189,8 @@ def load_existing_input(root,project,experiment,varin_list,domain,model="None",s
             path = Path(*parts[:index])
         except ValueError:
             print("The value of 'varin' is not in the path.")
+    if catalog is not None and not catalog.query(root=str(path), variable=varin):
+        logger.warning("No %s input files catalogued under %s (step %s)", varin, path, step)
     return str(path)
    
 
@@ -207,6 +238,7 @@ def general_parameters(root,project,experiment,varout,domain,model="None",step="
     else:
         varin_list = get_index_varin(varout)
     template["requests"][0]["configuration"]["variables"] = varin_list    
+    template["requests"][0]["encoding"] = {varout: output_encoding(varout)}
     return template
 
 
@@ -236,21 +268,146 @@ def interpolation(template,root,project,experiment,varout,domain,model="None",ex
     template["directories"]["interpolation"] = out_dir
     template["requests"][0]["interpolation"]["grid_type"]["custom_grid"] = "None"
     template["requests"][0]["interpolation"]["grid_type"]["grid_path"] = grid_path
-    template["requests"][0]["interpolation"]["method"] = "conservative_normed"
+    template["requests"][0]["interpolation"]["method"] = INTERPOLATION_METHOD
     template["requests"][0]["interpolation"]["apply_reference_mask"] = False
+    if grid_path is not None:
+        # Every cfile sharing the (source grid, target grid) pair applies the same cached weights;
+        # until the weight job has written them, the interpolation computes its own
+        key = interpolation_weights_key(project, domain, grid_path, INTERPOLATION_METHOD, model)
+        weights_path = interpolation_weights_path(root, key, INTERPOLATION_METHOD)
+        template["requests"][0]["interpolation"]["weights"] = {
+            "path": weights_path,
+            "generate": not os.path.exists(weights_path),
+        }
     if existing_input == "interpolation" and interpolation_step=="previous":
         template["directories"]["existing_input"] =load_existing_input(root,project,experiment,varout_list,domain,model=model,step="interpolation")
     elif existing_input == "interpolation" and interpolation_step=="posterior":
         template["directories"]["existing_input"] =load_existing_input(root,project,experiment,varout_list,domain,model=model,step="indices")
     return template
 
+@lru_cache(maxsize=None)
+def file_digest(path):
+    """Return the sha256 of a file's content (or of its path if it is not a regular file)."""
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        digest.update(str(path).encode())
+    return digest.hexdigest()
+
+
+def interpolation_weights_key(project, domain, grid_path, method, model="None"):
+    """
+    Return the content address of the regridding weights of a (source grid, target grid) pair.
+
+    The source grid is identified by the dataset id, the domain and the model
+    (models of a CORDEX domain do not share a grid: rotated or regular, with
+    different extents; all variables and experiments of a model or
+    observational dataset do) and the target grid by the content of its grid
+    file, so the key only changes when one of the grids or the method changes.
+    """
+    parameters = load_parameters.Dataset(project)
+    digest = hashlib.sha256()
+    digest.update(f"{parameters.load_project_id()}|{domain}|{method}|".encode())
+    if model != "None":
+        digest.update(f"{model}|".encode())
+    digest.update(file_digest(grid_path).encode())
+    return digest.hexdigest()[:16]
+
+
+def interpolation_weights_path(root, key, method):
+    """Get the path of the cached regridding weights for a weights key."""
+    return f"{build_step_path(root, 'interpolation_weights')}{key}/weights_{method}.nc"
+
+
+def interpolation_weights(template,root,project,experiment,varout,domain,model="None"):
+    """Prepare the one-off weight-generation configuration of a (source grid, target grid) pair."""
+    template = interpolation(template, root, project, experiment, varout, domain, model, existing_input="interpolation")
+    weights = template["requests"][0]["interpolation"]["weights"]
+    weights["generate"] = True
+    weights["only"] = True
+    key = Path(weights["path"]).parent.name
+    template["directories"]["temporal"] = f"{root}temporal_files/interpolation_weights/{project}/{domain}/{key}/"
+    template["requests"][0]["identifier"] = f"{project}_{domain}_{key}_interpolation_weights_C3S-ATLAS"
+    template["requests"][0]["STAGES"] = ["interpolation"]
+    return template
+
+
+def schedule_interpolation_weights(cfile_dict, scheduled, root, project, experiment, var, domain, model="None", cluster_cfg=None):
+    """
+    Write the weight-generation cfile and job for the weights used by ``cfile_dict``.
+
+    Only one job is written per weights file: pairs already scheduled in this
+    run (``scheduled``) or already present in the cache directory are skipped.
+    Interpolation cfiles written before the weights exist generate their own,
+    so they only apply the cached weights once regenerated after the weight jobs.
+    """
+    weights = cfile_dict["requests"][0]["interpolation"].get("weights")
+    if weights is None or weights["path"] in scheduled:
+        return
+    scheduled.add(weights["path"])
+    if os.path.exists(weights["path"]):
+        logger.info("Interpolation weights already cached in %s", weights["path"])
+        return
+
+    key = Path(weights["path"]).parent.name
+    template = general_parameters(root, project, experiment, var, domain, model=model, step="interpolation")
+    template = interpolation_weights(template, root, project, experiment, var, domain, model)
+    path_out = load_cfile_path("interpolation_weights", project, domain, key, "None", "None")
+    write_cfile(path_out, template)
+    write_jfile(project, "None", key, domain, step="interpolation_weights", model="None", cluster_cfg=cluster_cfg)
+
+
+def rechunk_target(varout):
+    """Return the step reading the rechunked store of ``varout``."""
+    return "indices" if varout in MONTHLY_INPUT_INDEXES else "biasadjustment"
+
+def rechunk_store_dir(root, project, domain, experiment, varout, model="None"):
+    """
+    Get the directory holding the rechunked stores (one per input variable) read by the step consuming ``varout``.
+
+    Each consumer (bias adjustment of a variable, or an index) gets its own
+    directory, so stores of the same variable with different chunks, or
+    written by concurrent jobs, do not overwrite each other.
+    """
+    return f"{build_step_path(root, 'rechunk')}Global/{project}/{domain}/{model}/{experiment}/{rechunk_target(varout)}/{varout}/"
+
+def rechunk(template,root,project,experiment,varout,domain,model="None",existing_input="step"):
+    """
+    Prepare rechunking configuration.
+
+    The time-sliced files of each input variable of ``varout`` are converted
+    into one time-contiguous store chunked along x/y, so the following
+    per-pixel time-series step (bias adjustment or monthly-input index) reads
+    each tile from a single chunk instead of touching every file.
+    """
+    target_step = rechunk_target(varout)
+    varin_list = get_index_varin(varout) if target_step == "indices" else [varout]
+    template["requests"][0]["configuration"]["variables"] = varin_list
+    if existing_input == "rechunk":
+        if target_step == "indices":
+            template["directories"]["existing_input"] = load_existing_input(root,project,experiment,varin_list,domain,model=model,step="indices",varout=varout)
+        else:
+            template["directories"]["existing_input"] = load_existing_input(root,project,experiment,varin_list,domain,model=model,step="biasadjustment_sim")
+    store_dir = rechunk_store_dir(root, project, domain, experiment, varout, model)
+    template["directories"]["rechunk"] = build_step_path(root, "rechunk")
+    template["requests"][0]["rechunk"] = {
+        "format": RECHUNK_FORMAT,
+        "chunks": dict(RECHUNK_CHUNKS[target_step]),
+        "stores": {varin: f"{store_dir}{varin}.{RECHUNK_FORMAT}" for varin in varin_list},
+    }
+    return template
+
 def biasadjustment(template,root,project,experiment,varout,domain,model="None",existing_input="step"):
     """Prepare bias adjustment configuration."""
     varout_list=[varout]
     out_dir = build_step_path(root, "biasadjustment")
     template["directories"]["biasadjustment"] = out_dir
     if existing_input == "biasadjustment":
-        template["directories"]["existing_input"] =load_existing_input(root,project,experiment,varout_list,domain,model=model,step="biasadjustment_sim")
+        # Simulations are read from the time-contiguous store written by the 'rechunk' step
+        template["directories"]["existing_input"] = rechunk_store_dir(root, project, domain, experiment, varout, model)
     template["requests"][0]["bias_adjustment"]["method"] = "ibicus-isimip"
     if experiment=="historical":
         n_procesors=4
@@ -300,7 +457,10 @@ def indices(template,root,project,experiment,varout,domain,model="None",step="in
     varin_list = get_index_varin(varout)
     template["requests"][0]["configuration"]["variables"] = varin_list    
     template["requests"][0]["configuration"]["filter_paths"] = True
-    if existing_input in ["indices","range-skewness","tasmaxba-tasminba"]:
+    if existing_input == "indices" and varout in MONTHLY_INPUT_INDEXES:
+        # Monthly-input indices read the time-contiguous store written by the 'rechunk' step
+        template["directories"]["existing_input"] = rechunk_store_dir(root, project, domain, experiment, varout, model)
+    elif existing_input in ["indices","range-skewness","tasmaxba-tasminba"]:
         template["directories"]["existing_input"] =load_existing_input(root,project,experiment,varin_list,domain,model=model,step=step,varout= varout)
     out_dir = build_step_path(root, final_folder)
     template["directories"]["indices"] = out_dir
@@ -311,6 +471,63 @@ def indices(template,root,project,experiment,varout,domain,model="None",step="in
 
     return template
 
+def group_indices(index_list):
+    """
+    Group indices that can be computed from a single read of their inputs.
+
+    Indices are grouped by their input variables (``get_index_varin``) and
+    temporal aggregation. Indices reading monthly inputs are kept apart from
+    the daily ones because their input directory differs.
+
+    Returns
+    -------
+    dict
+        Group label (e.g. ``tasmax_MS``) -> list of indices in the group.
+    """
+    groups = {}
+    for index in index_list:
+        varin_list = sorted(get_index_varin(index))
+        label = f"{'-'.join(varin_list)}_{'-'.join(temporal_agg(index))}"
+        if index in MONTHLY_INPUT_INDEXES:
+            label = f"{label}_monthly-input"
+        groups.setdefault(label, []).append(index)
+    return groups
+
+def fused_indices(template,root,project,experiment,index_list,domain,model="None",label=None):
+    """Prepare a single indices configuration computing every index of ``index_list``."""
+    template = indices(template, root, project, experiment, index_list[0], domain, model,
+                       step="indices", existing_input="indices")
+    base_entry = template["requests"][0]["indices"][0]
+    entries = []
+    for index in index_list:
+        entry = copy.deepcopy(base_entry)
+        entry["name"] = index
+        entries.append(entry)
+    template["requests"][0]["indices"] = entries
+    template["requests"][0]["encoding"] = {index: output_encoding(index) for index in index_list}
+    label = label or "-".join(index_list)
+    template["directories"]["temporal"] = f"{root}temporal_files/indices/{project}/{domain}/{model}/{experiment}/{label}/"
+    template["requests"][0]["identifier"] = f"{project}_{domain}_{label}_{model}_{experiment}_indices_C3S-ATLAS"
+    return template
+
+def produce_fused_indices(root, project, experiment, index_list, domain, model="None", cluster_cfg=None):
+    """Write one indices cfile and job per group of indices sharing their inputs."""
+    for label, group in group_indices(index_list).items():
+        logger.info("Fusing indices %s into one request (%s)", group, label)
+        template = general_parameters(root, project, experiment, group[0], domain, model="None", step="indices")
+        cfile_dict = fused_indices(template, root, project, experiment, group, domain, model, label=label)
+        cfile_dict["requests"][0]["STAGES"] = ["indices"]
+        path_out = load_cfile_path("indices", project, domain, label, experiment, model)
+        write_cfile(path_out, cfile_dict)
+        write_jfile(project, experiment, label, domain, step="indices", model=model, cluster_cfg=cluster_cfg)
+        if group[0] in MONTHLY_INPUT_INDEXES:
+            # The group shares its inputs, so a single rechunked store feeds all its indices
+            template = general_parameters(root, project, experiment, group[0], domain, model="None", step="rechunk")
+            cfile_dict = rechunk(template, root, project, experiment, group[0], domain, model, existing_input="rechunk")
+            cfile_dict["requests"][0]["STAGES"] = ["rechunk"]
+            write_cfile(load_cfile_path("rechunk", project, domain, label, experiment, model), cfile_dict)
+            write_jfile(project, experiment, label, domain, step="rechunk", model=model, cluster_cfg=cluster_cfg)
+
 def load_cfile_path(step, project, domain, var, experiment, model):
     """Get the path for the configuration file."""
     return Path(f"../{step}/cfiles/{project}/{var}/cfile_{project}_{domain}_{var}_{experiment}_{model}.yml")
@@ -319,17 +536,38 @@ def load_jfile_path(step, project, domain, var, experiment, model):
     """Get the path for the job file."""
     return Path(f"../{step}/jfiles/{project}/{var}/Job_{project}_{domain}_{var}_{experiment}_{model}.job")
 
+def insert_rechunk(steps, variable):
+    """
+    Place a 'rechunk' step right before the steps that need a time-contiguous input.
+
+    These are the steps in RECHUNK_BEFORE_STEPS and the indices of monthly-input
+    variables. A 'rechunk' step listed anywhere else is dropped.
+    """
+    expanded = []
+    for cur_step in steps:
+        if cur_step == "rechunk":
+            continue
+        if cur_step in RECHUNK_BEFORE_STEPS or (cur_step == "indices" and variable in MONTHLY_INPUT_INDEXES):
+            expanded.append("rechunk")
+        expanded.append(cur_step)
+    return expanded
+
 def expand_steps(project, step,variable):
     """Return the list of steps and the existing input step based on project and step."""
-    if step != "all":
+    if step == "rechunk":
         return [step], step
 
-    if variable in MONTHLY_INPUT_INDEXES:
-        return ["indices"], "indices"
-    if project not in PROJECT_STEPS:
+    if step != "all":
+        steps = [step]
+    elif variable in MONTHLY_INPUT_INDEXES:
+        steps = ["indices"]
+    elif project not in PROJECT_STEPS:
         raise ValueError(f"Unsupported project for 'all' steps: {project}")
+    else:
+        steps = PROJECT_STEPS[project]
 
-    return PROJECT_STEPS[project], "homogenization"
+    steps = insert_rechunk(steps, variable)
+    return steps, steps[0]
 
 def get_var_list(parameters, step):
     """Return the variable list corresponding to the given processing step."""
@@ -338,6 +576,7 @@ def get_var_list(parameters, step):
         "homogenization": parameters.homogenization_list,
         "biasadjustment": parameters.bias_correction_list,
         "interpolation": parameters.homogenization_list,
+        "rechunk": parameters.rechunk_list,
         "indices": parameters.indices_list,
         "range-skewness": parameters.range_list,
         "tasmaxba-tasminba": parameters.tasmaxba_list,
@@ -358,6 +597,8 @@ def build_cfile(cfile_dict, step, root, project, experiment, var, domain, model,
         update = homogenization(cfile_dict,root, project, experiment, var, domain, model, existing_input)
     elif step == "interpolation":
         update = interpolation(cfile_dict,root, project, experiment, var, domain, model, existing_input)
+    elif step == "rechunk":
+        update = rechunk(cfile_dict,root, project, experiment, var, domain, model, existing_input)
     elif step == "biasadjustment":
         update = biasadjustment(cfile_dict,root, project, experiment, var, domain, model, existing_input)
     elif step in ["indices", "range-skewness", "tasmaxba-tasminba"]:
@@ -378,12 +619,20 @@ def write_cfile(path_out, cfile_dict):
     logger.info("Configuration file written to %s", os.path.abspath(path_out))
 
 
-def produce_cfile(project, step="homogenization", cluster_cfg=None):
-    """Produce configuration files for all processing steps."""
+def produce_cfile(project, step="homogenization", cluster_cfg=None, fuse_indices=False):
+    """
+    Produce configuration files for all processing steps.
+
+    With ``fuse_indices`` the indices step writes one cfile per group of
+    indices sharing their input variables and temporal aggregation (see
+    ``group_indices``) instead of one cfile per index, so each input is read
+    once per group.
+    """
     parameters = load_parameters.Dataset(project)
     root= parameters.root
     var_list = get_var_list(parameters, step)
     logger.info("Producing cfiles for project: %s, step: %s", project, step)
+    scheduled_weights = set()
     for domain in parameters.domain_list:
         # Select model list based on project
         if project == "CORDEX-CORE":
@@ -393,7 +642,11 @@ def produce_cfile(project, step="homogenization", cluster_cfg=None):
 
         for experiment in parameters.available_exp:
             for model in model_list:
-                
+
+                if fuse_indices and step == "indices":
+                    produce_fused_indices(root, project, experiment, var_list, domain, model, cluster_cfg=cluster_cfg)
+                    continue
+
                 for var in var_list:
                     steps_to_run, existing_input = expand_steps(project, step, var)
 
@@ -424,6 +677,10 @@ def produce_cfile(project, step="homogenization", cluster_cfg=None):
                             cur_step, root, project, experiment, varin, domain, model, cur_step
                         )
 
+                        if cur_step == "interpolation":
+                            schedule_interpolation_weights(cfile_dict, scheduled_weights, root, project, experiment,
+                                varin, domain, model=model, cluster_cfg=cluster_cfg)
+
                         cfile_dict["requests"][0]["STAGES"] = [cur_step]
                         path_out = load_cfile_path(cur_step, project, domain, varin, experiment, model)
                         write_cfile(path_out, cfile_dict)
@@ -451,11 +708,15 @@ def parse_args():
         The processing step to run. Must be one of SUPPORTED_STEPS, e.g., "homogenization", "indices", or "all".
     cluster : str
         The HPC cluster where jobs will run. Must be one of SUPPORTED_CLUSTERS.
+    --fuse-indices : flag
+        Group indices by input variables and temporal aggregation, one request per group.
+    --catalog : str
+        Path of a sqlite dataset catalog used to check the existing inputs.
 
     Returns
     -------
     argparse.Namespace
-        Namespace object containing the parsed arguments: project, step, and cluster.
+        Namespace object containing the parsed arguments: project, step, cluster, fuse_indices and catalog.
 
     """
     parser = argparse.ArgumentParser(
@@ -479,6 +740,16 @@ def parse_args():
         choices=SUPPORTED_CLUSTERS,
         help="HPC cluster where jobs will run"
     )
+    parser.add_argument(
+        "--fuse-indices",
+        action="store_true",
+        help="Compute all indices sharing inputs and temporal aggregation in a single request"
+    )
+    parser.add_argument(
+        "--catalog",
+        default=None,
+        help="Sqlite dataset catalog used to check existing inputs instead of the file system"
+    )
     return parser.parse_args()
 
 
@@ -494,6 +765,10 @@ def main():
             The processing step to run. Must be one of SUPPORTED_STEPS, e.g., "homogenization", "indices", or "all".
         cluster : str
             The HPC cluster where jobs will be executed. Must be one of SUPPORTED_CLUSTERS.
+        --fuse-indices : flag, optional
+            Write one indices cfile per group of indices sharing inputs and temporal aggregation.
+        --catalog : str, optional
+            Sqlite dataset catalog; existing inputs without catalogued files are reported.
 
     For each project, step, experiment, variable, domain, and model, the function:
         1. Loads the appropriate YAML configuration template.
@@ -504,6 +779,8 @@ def main():
 
     Example usage from command line:
         python produce_cfile.py E-OBS homogenization gpfs
+        python produce_cfile.py E-OBS indices lustre --fuse-indices
+        python produce_cfile.py E-OBS interpolation lustre --catalog /lustre/.../catalog.sqlite
 
     Returns
     -------
@@ -515,13 +792,17 @@ def main():
     step = args.step
     cluster = args.cluster
     cluster_cfg = get_cluster_config(cluster)
+    if args.catalog:
+        global DATASET_CATALOG
+        DATASET_CATALOG = DatasetCatalog(args.catalog)
     logger.info("====================================")
     logger.info("Project : %s | Step : %s | Cluster : %s", project, step, cluster)
     logger.info("====================================")
     produce_cfile(
         project=project,
         step=step,
-        cluster_cfg=cluster_cfg
+        cluster_cfg=cluster_cfg,
+        fuse_indices=args.fuse_indices
     )
 
 
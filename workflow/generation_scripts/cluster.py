@@ -20,6 +20,16 @@ JOB_PARAMETERS = {
         "time_limit": "72:00:00",
         "ram": "20G"
     },
+    "interpolation_weights": {
+        "procs": "1",
+        "time_limit": "12:00:00",
+        "ram": "20G"
+    },
+    "rechunk": {
+        "procs": "1",
+        "time_limit": "24:00:00",
+        "ram": "30G"
+    },
     "biasadjustment": {
         "historical": {
             "procs": "4",
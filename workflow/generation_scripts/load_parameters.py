@@ -42,6 +42,10 @@ class Dataset:
     def indices_list(self):
         return self.get_step_variables("indices")
 
+    @property
+    def rechunk_list(self):
+        return self.get_step_variables("rechunk")
+
     @property
     def range_list(self):
         return self.get_step_variables("range-skewness")
@@ -1,3 +1,10 @@
+import sys
+from pathlib import Path
+
+# The output encoding policy lives in products/parameters at the repository root
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from products.parameters import get_output_encoding
+
 
 # In variables.py or a similar config file
 TEMPORAL_AGG_MAPPING = {
@@ -31,8 +38,25 @@ TEMPORAL_AGG_MAPPING = {
 }
 
 
+# Output encoding policy emitted into every cfile: the table of
+# products/parameters/variables_workflow.py, with chunks keyed by the x/y
+# dimensions the workflow steps use (as the bias adjustment, indices and
+# rechunk chunks)
+WORKFLOW_OUTPUT_DIMS = ("time", "y", "x")
+
 MONTHLY_INPUT_INDEXES = ["spei6cica","spi6cica"]
 
+# Steps working along time per grid cell. The generator inserts a 'rechunk' step
+# before them (and before the monthly-input indices) that converts the
+# time-sliced input files into a time-contiguous chunked store.
+RECHUNK_BEFORE_STEPS = ["biasadjustment"]
+RECHUNK_FORMAT = "zarr"  # or "nc" (NetCDF4)
+# Store chunks match the x/y chunks used by the step reading the store
+RECHUNK_CHUNKS = {
+    "biasadjustment": {"time": -1, "x": 50, "y": 50},
+    "indices": {"time": -1, "x": 60, "y": 60},
+}
+
 def temporal_agg(var: str):
     """
     Return the temporal aggregation for a given variable.
@@ -58,6 +82,23 @@ def temporal_agg(var: str):
     return agg
 
 
+def output_encoding(var: str):
+    """
+    Return the output encoding for a given variable.
+
+    Parameters
+    ----------
+    var : str
+        The variable name to get the output encoding for (pipeline names such as "pslcica" included).
+
+    Returns
+    -------
+    dict
+        get_output_encoding of products/parameters, chunked along WORKFLOW_OUTPUT_DIMS.
+    """
+    return get_output_encoding(var, dims=WORKFLOW_OUTPUT_DIMS)
+
+
 # Step definitions per project
 PROJECT_STEPS = {
     "ERA5": ["homogenization", "indices"],
@@ -1,30 +1,191 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+from datetime import datetime
+import glob
+import logging
+import traceback
 
 import fire
 from climate_data_pipeline.main import ClimateDataPipeline
 
 
-def main(config_file: str):
+logger = logging.getLogger(__name__)
+
+
+def expand_config_files(config_file):
+    """
+    Expand the ``config_file`` argument into an ordered list of configuration files.
+
+    Parameters
+    ----------
+    config_file : str or list of str
+        A configuration file, a glob pattern (e.g. ``cfiles/E-OBS/tx35/*.yml``),
+        a comma-separated list, a list of any of those, or a manifest file
+        (``.txt``/``.lst``) with one configuration path or pattern per line.
+        Blank lines and lines starting with ``#`` are ignored in manifests.
+
+    Returns
+    -------
+    list of str
+        Configuration files in the order given, without duplicates.
+
+    Raises
+    ------
+    RuntimeError
+        If an entry neither exists nor matches any file.
+    """
+    if isinstance(config_file, (list, tuple)):
+        entries = [str(entry) for entry in config_file]
+    else:
+        entries = [entry.strip() for entry in str(config_file).split(",") if entry.strip()]
+
+    config_files = []
+    for entry in entries:
+        if Path(entry).suffix in [".txt", ".lst"] and Path(entry).exists():
+            # Manifest: one configuration file (or pattern) per line, relative to the manifest
+            with open(entry) as f:
+                lines = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+            lines = [line if Path(line).is_absolute() else str(Path(entry).parent / line) for line in lines]
+            config_files.extend(expand_config_files(lines))
+        elif glob.has_magic(entry):
+            matches = sorted(glob.glob(entry))
+            if not matches:
+                raise RuntimeError(f"{entry} does not match any configuration file.")
+            config_files.extend(matches)
+        elif Path(entry).exists():
+            config_files.append(entry)
+        else:
+            raise RuntimeError(f"{entry} does not exist.")
+
+    return list(dict.fromkeys(config_files))
+
+
+def config_log_file(config_file, log_dir=None):
+    """Return the log file path of one configuration file (``<config>_<date>.log``)."""
+    log_dir = Path(log_dir) if log_dir else Path(config_file).resolve().parent
+    log_dir.mkdir(parents=True, exist_ok=True)
+    date = datetime.now().strftime("%Y%m%d%H%M%S")
+    return str(log_dir / f"{Path(config_file).stem}_{date}.log")
+
+
+def run_config(config_file, log_file):
     """
-    Execute the Climate Data Pipeline with the specified configuration file.
+    Run the pipeline for one configuration file, writing its output to ``log_file``.
+
+    Everything printed or logged while the pipeline runs goes to the log file so
+    that configurations sharing one process keep separate logs. Errors are
+    caught and reported in the returned status instead of being raised, so a
+    failing configuration does not stop the rest of the batch.
+
+    Returns
+    -------
+    tuple
+        ``(config_file, log_file, error)`` where ``error`` is None on success.
+    """
+    root_logger = logging.getLogger()
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    root_logger.addHandler(handler)
+    error = None
+    try:
+        with open(log_file, "a") as log, redirect_stdout(log), redirect_stderr(log):
+            try:
+                ClimateDataPipeline(config_file).run()
+            except Exception as exc:
+                traceback.print_exc()
+                error = f"{type(exc).__name__}: {exc}"
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+    return config_file, log_file, error
+
+
+def run_batch(config_files, workers=1, log_dir=None):
+    """
+    Run several configuration files in one interpreter.
 
     Parameters
     ----------
-    config_file : str
-        Path to the configuration file required to run the pipeline.
+    config_files : list of str
+        Configuration files to run.
+    workers : int
+        Number of worker processes. With 1 the configurations run sequentially
+        in this process; otherwise a pool of at most ``workers`` processes is used.
+    log_dir : str, optional
+        Directory for the per-configuration log files. Defaults to the
+        directory of each configuration file.
+
+    Returns
+    -------
+    list of tuple
+        ``(config_file, log_file, error)`` for each configuration, in input order.
+    """
+    tasks = [(config_file, config_log_file(config_file, log_dir)) for config_file in config_files]
+    results = {}
+    if workers <= 1:
+        for config_file, log_file in tasks:
+            logger.info("Running %s (log: %s)", config_file, log_file)
+            results[config_file] = run_config(config_file, log_file)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            futures = {executor.submit(run_config, config_file, log_file): config_file
+                       for config_file, log_file in tasks}
+            for future in as_completed(futures):
+                config_file = futures[future]
+                try:
+                    results[config_file] = future.result()
+                except Exception as exc:
+                    # The worker itself died (e.g. killed for memory); record it and carry on
+                    results[config_file] = (config_file, dict(tasks)[config_file], f"{type(exc).__name__}: {exc}")
+                logger.info("Done %s", config_file)
+    return [results[config_file] for config_file, _ in tasks]
+
+
+def main(config_file, workers: int = 1, log_dir: str = None):
+    """
+    Execute the Climate Data Pipeline with the specified configuration file(s).
+
+    A single configuration file runs exactly as before. Several configuration
+    files (a list, a glob pattern or a manifest, see ``expand_config_files``)
+    run in this one process, sequentially or with a bounded worker pool, so the
+    interpreter start-up and the pipeline imports are paid only once. Each
+    configuration gets its own log file and failures are isolated per
+    configuration.
+
+    Parameters
+    ----------
+    config_file : str or list of str
+        Path, glob pattern, list or manifest of the configuration files required
+        to run the pipeline.
+    workers : int
+        Number of configurations run in parallel in batch mode.
+    log_dir : str, optional
+        Directory for the per-configuration log files in batch mode.
 
     Raises
     ------
     RuntimeError
-        If the specified configuration file does not exist.
+        If a specified configuration file does not exist, or if any
+        configuration of a batch failed.
     """
-    # Ensure the configuration file exists
-    if not Path(config_file).exists():
-        raise RuntimeError(f"{config_file} does not exist.")
+    config_files = expand_config_files(config_file)
+
+    if len(config_files) == 1 and log_dir is None:
+        # Initialize and run the ClimateDataPipeline
+        ClimateDataPipeline(config_files[0]).run()
+        return
 
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger.info("Running %d configuration files with %d worker(s)", len(config_files), workers)
+    results = run_batch(config_files, workers=workers, log_dir=log_dir)
 
-    # Initialize and run the ClimateDataPipeline
-    ClimateDataPipeline(config_file).run()
+    failed = [(cfile, log_file, error) for cfile, log_file, error in results if error is not None]
+    for cfile, log_file, error in failed:
+        logger.error("Failed %s: %s (see %s)", cfile, error, log_file)
+    logger.info("Finished %d/%d configuration files", len(results) - len(failed), len(results))
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} configuration files failed.")
 
 
 if __name__ == "__main__":